@@ -0,0 +1,74 @@
+##############################################################################
+#
+# Copyright (c) 2013 Zope Corporation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Compare blob-record detection with unpickling class pickles
+
+Usage: python benchmarks/blob_records.py [iterations]
+
+Times zc.zrs.primary.is_blob_record against the unpickling check it
+replaced, for blob and non-blob records in each pickle protocol,
+including records of classes that can't be imported, as on primaries
+without application code, and checks that they agree.
+"""
+from six.moves import cPickle
+import binascii
+import persistent.mapping
+import sys
+import timeit
+import zc.zrs.primary
+import ZODB.blob
+
+def unpickling_is_blob_record(record):
+    try:
+        return cPickle.loads(record) is ZODB.blob.Blob
+    except (MemoryError, KeyboardInterrupt, SystemExit):
+        raise
+    except Exception:
+        return False
+
+def records():
+    state = cPickle.dumps({'data': b'x' * 1000}, 3)
+    for protocol in range(2, cPickle.HIGHEST_PROTOCOL + 1):
+        yield ('blob, protocol %s' % protocol,
+               cPickle.dumps(ZODB.blob.Blob, protocol) + state)
+        yield ('mapping, protocol %s' % protocol,
+               cPickle.dumps(persistent.mapping.PersistentMapping, protocol)
+               + state)
+
+    # A class that can't be imported:
+    yield ('missing class', b'\x80\x03capp.content\nDocument\nq\x00.' + state)
+
+    record = cPickle.dumps(ZODB.blob.Blob, 3) + state
+    yield 'transformed', b'.h' + binascii.b2a_hex(record)
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    iterations = int(args[0]) if args else 100000
+
+    print("%-22s %12s %12s %8s" % ('record', 'unpickle us', 'sniff us', 'ratio'))
+    for name, record in records():
+        expected = unpickling_is_blob_record(record)
+        if zc.zrs.primary.is_blob_record(record) != expected:
+            raise AssertionError("Disagreement for %s" % name)
+
+        old = min(timeit.repeat(
+            lambda: unpickling_is_blob_record(record),
+            number=iterations, repeat=3)) / iterations * 1e6
+        new = min(timeit.repeat(
+            lambda: zc.zrs.primary.is_blob_record(record),
+            number=iterations, repeat=3)) / iterations * 1e6
+        print("%-22s %12.2f %12.2f %8.1f" % (name, old, new, old / new))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+##############################################################################
+#
+# Copyright (c) 2013 Zope Corporation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Compare committing small transactions with and without group syncs
+
+Usage: python benchmarks/group_sync.py [transactions [interval]]
+
+Restores transactions of one small record each into a file storage, as
+a secondary catching up does, syncing the file for each transaction,
+and then with zc.zrs.groupsync syncing it for groups of transactions,
+interval seconds apart.  The file storage is created in the current
+directory's temporary subdirectory, so run this on the file system
+secondaries use.
+"""
+import shutil
+import sys
+import tempfile
+import time
+from ZODB.Connection import TransactionMetaData
+import ZODB.FileStorage
+import ZODB.utils
+import zc.zrs.groupsync
+
+def restore(fs, transactions):
+    start = time.monotonic()
+    for i in range(1, transactions + 1):
+        trans = TransactionMetaData()
+        tid = ZODB.utils.p64(i)
+        fs.tpc_begin(trans, tid, ' ')
+        fs.restore(ZODB.utils.p64(i % 100), tid, b'x' * 100, '', None, trans)
+        fs.tpc_vote(trans)
+        fs.tpc_finish(trans)
+    return time.monotonic() - start
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    transactions = int(args[0]) if args else 1000
+    interval = float(args[1]) if len(args) > 1 else 0.01
+
+    tmp = tempfile.mkdtemp(dir='.')
+    try:
+        fs = ZODB.FileStorage.FileStorage(tmp + '/each.fs')
+        each = restore(fs, transactions)
+        fs.close()
+
+        fs = ZODB.FileStorage.FileStorage(tmp + '/group.fs')
+        group_sync = zc.zrs.groupsync.GroupSync(fs, interval)
+        grouped = restore(fs, transactions)
+        group_sync.close()
+        fs.close()
+    finally:
+        shutil.rmtree(tmp)
+
+    print("%-12s %12s %12s" % ('syncs', 'seconds', 'txn/s'))
+    print("%-12s %12.3f %12.0f" % ('each', each, transactions / each))
+    print("%-12s %12.3f %12.0f" % ('grouped', grouped, transactions / grouped))
+    print("%d syncs for %d transactions, %.1f times as fast" % (
+        group_sync.syncs, group_sync.synced, each / grouped))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+##############################################################################
+#
+# Copyright (c) 2013 Zope Corporation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Limit the number of secondaries catching up at once
+
+Secondaries that are far behind have to read much of the primary's
+storage file.  Several doing so at once cause random I/O, so we admit
+a limited number at a time.  The rest wait, those least far behind
+first, because they'll be done soonest.  Secondaries that are less
+than min_lag seconds behind don't wait.
+"""
+
+import bisect
+import itertools
+import threading
+import time
+
+class Ticket:
+
+    admitted = False
+
+    def __init__(self, lag, sequence, wake):
+        self.lag = lag
+        self.sequence = sequence
+        self.wake = wake
+        self.requested = time.time()
+
+    def __lt__(self, other):
+        return (self.lag, self.sequence) < (other.lag, other.sequence)
+
+    def waited(self):
+        return time.time() - self.requested
+
+class AdmissionScheduler:
+
+    def __init__(self, limit=None, min_lag=60):
+        self.limit = limit
+        self.min_lag = min_lag
+        self.lock = threading.Lock()
+        self.admitted = set()
+        # Waiting tickets, in the order they'll be admitted:
+        self.waiting = []
+        self.sequence = itertools.count()
+
+    def request(self, lag, wake):
+        """Ask to catch up, lag seconds behind
+
+        None is returned if we needn't wait.  Otherwise, a ticket is
+        returned, which is admitted, now or later, and must be
+        released when we're done catching up.  The wake function is
+        called when the ticket is admitted or its position changes.
+        """
+        if lag < self.min_lag:
+            return None
+        ticket = Ticket(lag, next(self.sequence), wake)
+        with self.lock:
+            index = bisect.bisect(self.waiting, ticket)
+            self.waiting.insert(index, ticket)
+            self._admit(index + 1)
+        return ticket
+
+    def _index(self, ticket):
+        # Return a waiting ticket's index.  Called with the lock held.
+        index = bisect.bisect_left(self.waiting, ticket)
+        if index < len(self.waiting) and self.waiting[index] is ticket:
+            return index
+        return None
+
+    def position(self, ticket):
+        """Return a ticket's position in the queue, or 0 if admitted
+        """
+        with self.lock:
+            if ticket.admitted:
+                return 0
+            index = self._index(ticket)
+            if index is None:
+                raise ValueError("Unknown ticket", ticket)
+            return index + 1
+
+    def release(self, ticket):
+        with self.lock:
+            if ticket.admitted:
+                self.admitted.discard(ticket)
+                self._admit(len(self.waiting))
+            else:
+                index = self._index(ticket)
+                if index is not None:
+                    del self.waiting[index]
+                    self._admit(index)
+
+    def set_limit(self, limit):
+        with self.lock:
+            self.limit = limit
+            self._admit(len(self.waiting))
+
+    def stats(self):
+        with self.lock:
+            return dict(limit=self.limit, admitted=len(self.admitted),
+                        waiting=len(self.waiting))
+
+    def _admit(self, moved):
+        # Called with the lock held.  Admit as many tickets as we can,
+        # and let those whose positions changed know.  The tickets
+        # from index moved on have moved already.
+        waiting = self.waiting
+        admit = len(waiting)
+        if self.limit:
+            admit = min(admit, max(self.limit - len(self.admitted), 0))
+        if admit:
+            admitted = waiting[:admit]
+            del waiting[:admit]
+            for ticket in admitted:
+                ticket.admitted = True
+                self.admitted.add(ticket)
+                ticket.wake()
+            moved = 0 # Everyone left moved up.
+        for ticket in waiting[moved:]:
+            ticket.wake()
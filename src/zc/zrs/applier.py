@@ -0,0 +1,261 @@
+##############################################################################
+#
+# Copyright (c) 2013 Zope Corporation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Applying replicated transactions off the reactor thread
+
+A secondary receives transactions in its reactor thread, which it
+shares with its other connections, and with other storages' secondaries
+and servers.  Committing a transaction means writing it and syncing the
+file, and maybe moving blob files, and while that's done, nothing else
+in the process gets network input or output.
+
+Secondaries can instead hand the transactions they receive to an
+applier, which commits them, in order, in a separate thread.  An
+applier stands in for the secondary's storage while transactions are
+received, recording the calls made for each transaction, like a blob
+channel queue.  Received transactions are queued until the applier's
+thread makes the calls on the storage.
+
+When more than max_queued bytes of record data are queued, receiving
+is paused, until half of them have been committed.
+
+An applier outlives connections to the primary.  A secondary that
+reconnects asks for the transactions after the last one it queued,
+whether or not that was committed yet.  If committing a transaction
+fails, the transactions queued after it are discarded, and the
+secondary has to reconnect to get them again.
+"""
+
+import collections
+import os
+import sys
+import threading
+import time
+import zc.zrs.rawtxn
+
+class Transaction:
+    """A received transaction, and the storage calls to commit it
+    """
+
+    def __init__(self, tid):
+        self.tid = tid
+        self.calls = []
+        self.size = 0
+        self.received = None
+
+    def apply(self, storage):
+        transaction = self.calls[0][1][0]
+        try:
+            for name, args in self.calls:
+                if name == 'write_raw':
+                    zc.zrs.rawtxn.write(
+                        zc.zrs.rawtxn.file_storage(storage), *args)
+                else:
+                    getattr(storage, name)(*args)
+        except:
+            storage.tpc_abort(transaction)
+            raise
+
+    def discard(self):
+        for name, args in self.calls:
+            if name == 'restoreBlob':
+                try:
+                    os.remove(args[3])
+                except OSError:
+                    pass # restored already
+
+class Applier:
+
+    max_queued = 1 << 24
+    paused = False
+    current = None
+    committing = None
+
+    # The last transaction queued, if it may not be committed yet:
+    received = None
+
+    # Set when a transaction can't be committed, until we reconnect:
+    failed = False
+
+    def __init__(self, storage, reactor, max_queued, pause, resume,
+                 failed):
+        self.storage = storage
+        self.reactor = reactor
+        if max_queued:
+            self.max_queued = max_queued
+        self.pause = pause
+        self.resume = resume
+        self.fail = failed
+        self.condition = threading.Condition()
+        self.transactions = collections.deque()
+        self.queued = 0
+        self.applied = 0
+        self.latency = self.total_latency = 0.0
+        self.closed = False
+        self.thread = thread = threading.Thread(
+            target=self.run, name='Applier(%s)' % storage.getName())
+        thread.daemon = True
+        thread.start()
+
+    def lastTransaction(self):
+        return self.storage.lastTransaction()
+
+    def last_received(self):
+        """Return the id of the last transaction received
+
+        Committed or not, so that's where we pick up after reconnecting.
+        """
+        with self.condition:
+            if self.received is not None:
+                return self.received
+            return self.storage.lastTransaction()
+
+    # Called in the reactor thread, as we connect and disconnect:
+
+    def connected(self):
+        with self.condition:
+            self.failed = False
+
+    def disconnected(self):
+        self.tpc_abort(None)
+        self.paused = False
+
+    # Storage methods, for the transaction being received:
+
+    def tpc_begin(self, transaction, tid, status):
+        self.current = Transaction(tid)
+        self.current.calls.append(('tpc_begin', (transaction, tid, status)))
+
+    def restore(self, oid, serial, data, version, prev_txn, transaction):
+        self.current.calls.append(
+            ('restore', (oid, serial, data, version, prev_txn, transaction)))
+        self.current.size += len(data or b'')
+
+    def restoreBlob(self, oid, serial, data, blobfilename, prev_txn,
+                    transaction):
+        self.current.calls.append(
+            ('restoreBlob',
+             (oid, serial, data, blobfilename, prev_txn, transaction)))
+        self.current.size += len(data or b'')
+
+    def write_raw(self, transaction, data, records, back_tids):
+        # Instead of tpc_vote, for raw transactions.
+        self.current.calls.append(
+            ('write_raw', (transaction, data, records, back_tids)))
+        self.current.size += len(data)
+
+    def tpc_vote(self, transaction):
+        self.current.calls.append(('tpc_vote', (transaction, )))
+
+    def tpc_finish(self, transaction, func=lambda tid: None):
+        current = self.current
+        self.current = None
+        current.calls.append(('tpc_finish', (transaction, func)))
+        current.received = time.monotonic()
+        with self.condition:
+            if self.failed or self.closed:
+                current.discard()
+                return
+            self.transactions.append(current)
+            self.received = current.tid
+            self.queued += current.size
+            pause = self.queued > self.max_queued and not self.paused
+            self.condition.notify()
+        if pause:
+            self.paused = True
+            self.pause()
+
+    def tpc_abort(self, transaction):
+        if self.current is not None:
+            self.current.discard()
+            self.current = None
+
+    def _resume(self):
+        # Called in the reactor thread when half of what was queued has
+        # been committed.
+        with self.condition:
+            room = self.queued <= self.max_queued // 2
+        if self.paused and room:
+            self.paused = False
+            self.resume()
+
+    def run(self):
+        transactions = self.transactions
+        while 1:
+            with self.condition:
+                while not (transactions or self.closed):
+                    self.condition.wait()
+                if self.closed:
+                    return
+                transaction = self.committing = transactions.popleft()
+
+            try:
+                transaction.apply(self.storage)
+            except Exception:
+                exc_info = sys.exc_info()
+                transaction.discard()
+                with self.condition:
+                    # The transactions queued after this one can't be
+                    # committed without it.
+                    self.failed = True
+                    for queued in transactions:
+                        queued.discard()
+                    transactions.clear()
+                    self.queued = 0
+                    self.received = None
+                    self.committing = None
+                self.reactor.callFromThread(self.fail, transaction.tid,
+                                            exc_info)
+                continue
+
+            latency = time.monotonic() - transaction.received
+            with self.condition:
+                if not self.closed:
+                    self.queued -= transaction.size
+                if not transactions:
+                    self.received = None
+                self.committing = None
+                self.applied += 1
+                self.latency = latency
+                self.total_latency += latency
+                room = self.queued <= self.max_queued // 2
+            if room and self.paused:
+                self.reactor.callFromThread(self._resume)
+
+    def close(self):
+        """Stop, discarding the transactions that aren't committed yet
+        """
+        with self.condition:
+            self.closed = True
+            for transaction in self.transactions:
+                transaction.discard()
+            self.transactions.clear()
+            self.queued = 0
+            self.received = None
+            self.condition.notify()
+        self.tpc_abort(None)
+        if self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def stats(self):
+        """Return the queue's size, and how long transactions wait in it
+        """
+        with self.condition:
+            return dict(
+                transactions=(len(self.transactions) +
+                              (self.committing is not None)),
+                size=self.queued,
+                received=self.received, applied=self.applied,
+                latency=self.latency,
+                mean_latency=(self.total_latency / self.applied
+                              if self.applied else 0.0))
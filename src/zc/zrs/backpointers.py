@@ -0,0 +1,108 @@
+##############################################################################
+#
+# Copyright (c) 2013 Zope Corporation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Cache of resolved backpointers
+
+Data records written by undo and by copying transactions have no data
+of their own, but point back to earlier records that do, which may be
+far back in the storage file.  Resolving a backpointer means reading
+the record it points to, and any records that one points to, to find
+the data.  Secondaries catching up on long runs of such records make
+the primary read all over the file.
+
+A primary can keep the results in a cache, shared by the iterators
+of all of its secondaries, keyed by backpointer.  For each, we keep
+the object id and transaction id of the record pointed to, and the
+position and size of the data it resolves to.  Unless they're large,
+we keep the data too.  The cache is bounded in bytes, and the least
+recently used entries are dropped to stay within the bound.
+
+Positions are only valid for the file they're in.  Entries are for
+the storage's current file.  When a pack replaces the file, the cache
+is cleared, and iterators that haven't reopened the file yet don't use
+the cache.
+"""
+
+import collections
+import threading
+
+# Bytes charged for an entry, besides its data.
+entry_overhead = 200
+
+class BackpointerCache:
+
+    def __init__(self, fs, max_size):
+        self.fs = fs
+        self.max_size = max_size
+        # Data larger than this aren't kept:
+        self.max_data_size = max_size // 8
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.file = None
+        self.hits = self.misses = self.resets = 0
+
+    def _current(self, file):
+        # Check whether a storage file is current, clearing the cache if
+        # the storage has a new one.
+        if file is not self.file:
+            if file is not self.fs._file:
+                return False
+            if self.file is not None:
+                self.resets += 1
+            self.file = file
+            self.entries.clear()
+            self.size = 0
+        return True
+
+    def get(self, file, back):
+        """Return the entry for a backpointer in a storage file
+
+        An entry is a tuple of the object id and transaction id of the
+        record pointed to, and the position, size and (if kept) data
+        of the data the backpointer resolves to.  None is returned if
+        there isn't an entry.
+        """
+        with self.lock:
+            if not self._current(file):
+                return None
+            entry = self.entries.get(back)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(back)
+            self.hits += 1
+            return entry
+
+    def set(self, file, back, oid, tid, data_pos, size, data):
+        """Remember what a backpointer in a storage file resolves to
+        """
+        if data is not None and len(data) > self.max_data_size:
+            data = None
+        entry_size = entry_overhead + (len(data) if data else 0)
+        with self.lock:
+            if not self._current(file) or back in self.entries:
+                return
+            self.entries[back] = oid, tid, data_pos, size, data
+            self.size += entry_size
+            while self.size > self.max_size:
+                _, (_, _, _, _, data) = self.entries.popitem(False)
+                self.size -= entry_overhead + (len(data) if data else 0)
+
+    def stats(self):
+        """Return the cache's size and its hit, miss and reset counts
+        """
+        with self.lock:
+            return dict(entries=len(self.entries), size=self.size,
+                        hits=self.hits, misses=self.misses,
+                        resets=self.resets)
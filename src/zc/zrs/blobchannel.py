@@ -0,0 +1,554 @@
+##############################################################################
+#
+# Copyright (c) 2013 Zope Corporation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Blob files fetched over separate connections
+
+Blob files can be large, and while one is sent, a secondary gets
+nothing else.  Secondaries can instead fetch blob files over separate
+connections, blob channels, in parallel with the replication stream.
+The primary then sends each blob record with a 'D' message, giving
+the size of the blob file, and the record data, and the secondary
+requests the file on the channel with the least data outstanding.
+
+Transactions are still committed in order.  The secondary queues the
+transactions it receives, and commits each once the blob files it
+needs have arrived.  The replication stream can so get ahead of blob
+transfer, by up to a limited amount of queued record data.
+
+A blob channel is opened like a replication connection, with the
+``zrs3.1`` protocol and a feature offer, including ``channel=blobs``,
+but no transaction id.  The secondary then sends requests, each an oid
+followed by a tid, and the primary answers them in order.
+"""
+
+import collections
+import logging
+import os
+import tempfile
+import threading
+import twisted.internet.interfaces
+import twisted.internet.protocol
+import zc.zrs.checksum
+import zc.zrs.features
+import zc.zrs.messages
+import zc.zrs.sizedmessage
+import ZODB.POSException
+import ZODB.TimeStamp
+import ZODB.utils
+import zope.interface
+from six.moves import cPickle
+
+logger = logging.getLogger(__name__)
+
+# Requests are an oid followed by a tid.
+request_size = 16
+
+@zope.interface.implementer(twisted.internet.interfaces.IPushProducer)
+class Sender:
+    """Send the blob files requested on a blob channel
+
+    A sender runs as a task in the primary's worker pool.
+    """
+
+    stopped = False
+    closed = False
+    task = None
+
+    # Blob data are handed to the reactor in batches of about this
+    # many bytes, and we stop reading blob files while more than
+    # max_unwritten bytes haven't been written.
+    batch_size = 1 << 20
+    max_unwritten = 1 << 22
+
+    def __init__(self, storage, transport, peer, start, features,
+                 block_size):
+        self.storage = storage
+        self.transport = transport
+        self.peer = peer
+        if features.get('headers') == 'binary':
+            self.encoder = zc.zrs.messages.BinaryEncoder()
+        else:
+            self.encoder = zc.zrs.messages.PickleEncoder()
+        self.checksum_algorithm = features.get('checksum', 'md5')
+        self.block_size = block_size
+        self.requests = collections.deque()
+        self.lock = threading.Lock()
+        self.unwritten = 0
+        self.consumer_event = threading.Event()
+        self.consumer_event.set()
+        self.callFromThread = transport.reactor.callFromThread
+        transport.registerProducer(self, True)
+        start(self.begin, 'BlobSender(%s)' % peer)
+
+    def begin(self, task):
+        self.task = task
+        return self.run()
+
+    def wake(self):
+        task = self.task
+        if task is not None:
+            task.wake()
+
+    def request(self, message):
+        if len(message) != request_size:
+            raise ValueError("Invalid blob request", message)
+        self.requests.append((message[:8], message[8:]))
+        self.wake()
+
+    def pauseProducing(self):
+        self.consumer_event.clear()
+
+    def resumeProducing(self):
+        self.consumer_event.set()
+        self.wake()
+
+    def stopProducing(self): # cfr
+        self.stopped = True
+        self.consumer_event.set() # unblock waits
+        self.wake()
+
+    def set_rate_limit(self, rate_limit):
+        pass # Rate limits apply to catching up, not to blob channels.
+
+    def read_ahead_stats(self):
+        return None # Blob files are read as they're requested.
+
+    def close(self):
+        # Send what's been asked for, then hang up.
+        self.closed = True
+        self.wake()
+
+    def _stop(self):
+        # for tests
+        self.requests.clear()
+        self.close()
+
+    def cfr_close(self):
+        if not self.stopped:
+            self.transport.unregisterProducer()
+            self.stopProducing()
+            self.transport.loseConnection()
+
+    def cfr_write(self, data, size):
+        with self.lock:
+            self.unwritten -= size
+        if not self.stopped:
+            self.transport.writeSequence(data)
+        self.wake()
+
+    def flush(self, batch):
+        size = sum(map(len, batch))
+        while not self.stopped and (
+            not self.consumer_event.is_set()
+            or self.unwritten >= self.max_unwritten):
+            yield
+        with self.lock:
+            self.unwritten += size
+        self.callFromThread(self.cfr_write, batch, size)
+
+    def send(self, oid, tid):
+        encoder = self.encoder
+        marshals = zc.zrs.sizedmessage.marshals
+        checksum = zc.zrs.checksum.new(self.checksum_algorithm)
+        try:
+            f = open(self.storage.loadBlob(oid, tid), 'rb')
+        except (IOError, ZODB.POSException.POSKeyError):
+            # The blob file has been packed away since the record was
+            # sent.
+            batch = list(marshals(encoder.blob_file(oid, tid, -1)))
+            batch.extend(marshals(encoder.commit(checksum.digest())))
+            yield from self.flush(batch)
+            return
+
+        with f:
+            blocks, r = divmod(os.fstat(f.fileno()).st_size,
+                               self.block_size)
+            if r:
+                blocks += 1
+            batch = list(marshals(encoder.blob_file(oid, tid, blocks)))
+            batched = 0
+            while blocks > 0:
+                data = f.read(self.block_size)
+                if not data:
+                    raise AssertionError("Too much blob data")
+                blocks -= 1
+                checksum.update(data)
+                batch.extend(marshals(data))
+                batched += len(data)
+                if batched >= self.batch_size:
+                    yield from self.flush(batch)
+                    if self.stopped:
+                        return
+                    batch = []
+                    batched = 0
+
+        batch.extend(marshals(encoder.commit(checksum.digest())))
+        yield from self.flush(batch)
+
+    def run(self):
+        try:
+            while not self.stopped:
+                if self.requests:
+                    oid, tid = self.requests.popleft()
+                    yield from self.send(oid, tid)
+                elif self.closed:
+                    break
+                else:
+                    yield # Wait for a request
+        except Exception:
+            logger.exception(self.peer)
+
+        self.callFromThread(self.cfr_close)
+
+
+class Blob:
+    """A blob file requested on a blob channel
+
+    The file name is None if the primary no longer had the file.
+    """
+
+    arrived = False
+    filename = None
+
+    def __init__(self, oid, tid, size):
+        self.oid = oid
+        self.tid = tid
+        self.size = size
+
+
+class Fetcher:
+    """Fetch blob files over a secondary's blob channels
+    """
+
+    closed = False
+
+    def __init__(self, factory, arrived, lost, failed):
+        # arrived is called with each blob that arrives, lost with the
+        # reason a channel was lost, and failed with a message to log
+        # when a channel gets bad data.
+        self.factory = factory
+        self.arrived = arrived
+        self.lost = lost
+        self.failed = failed
+        self.features = {'channel': 'blobs'}
+        for name in ('headers', 'checksum'):
+            if name in factory.features:
+                self.features[name] = factory.features[name]
+        self.blobs = self.blob_bytes = 0
+        self.channels = [ChannelFactory(self)
+                         for i in range(factory.blob_channels)]
+        for channel in self.channels:
+            factory.connect(channel)
+
+    def fetch(self, oid, tid, size):
+        blob = Blob(oid, tid, size)
+        min(self.channels, key=lambda channel: channel.outstanding
+            ).request(blob)
+        self.blobs += 1
+        self.blob_bytes += size
+        return blob
+
+    def received(self, blob, filename):
+        blob.filename = filename
+        blob.arrived = True
+        self.blobs -= 1
+        self.blob_bytes -= blob.size
+        if not self.closed:
+            self.arrived(blob)
+        elif filename is not None:
+            os.remove(filename)
+
+    def channel_lost(self, reason):
+        if not self.closed:
+            self.lost(reason)
+
+    def close(self):
+        self.closed = True
+        for channel in self.channels:
+            channel.close()
+
+
+class Channel(twisted.internet.protocol.Protocol):
+
+    __decode = staticmethod(cPickle.loads)
+    __checksum = None
+    __blocks = 0
+    __file_handle = None
+    __file_name = None
+
+    def connectionMade(self):
+        self.__stream = zc.zrs.sizedmessage.Stream(self.messageReceived)
+        self.__handler = self.featuresReceived
+        self.factory.instance = self
+        fetcher = self.factory.fetcher
+        self.transport.write(zc.zrs.sizedmessage.marshal(
+            zc.zrs.features.FEATURE_PROTOCOLS[1]))
+        self.transport.write(zc.zrs.sizedmessage.marshal(
+            zc.zrs.features.encode(fetcher.features)))
+        for blob in self.factory.requests:
+            self.request(blob)
+
+    def connectionLost(self, reason):
+        self.factory.instance = None
+        self.__discard()
+
+    def dataReceived(self, data):
+        try:
+            self.__stream(data)
+        except:
+            self.factory.fetcher.failed("Blob channel input data error",
+                                        exc_info=True)
+
+    def request(self, blob):
+        self.transport.write(zc.zrs.sizedmessage.marshal(blob.oid + blob.tid))
+
+    def messageReceived(self, message):
+        self.__handler(message)
+
+    def featuresReceived(self, message):
+        features = zc.zrs.features.decode(message)
+        if features.get('channel') != ['blobs']:
+            raise ValueError("Blob channel refused", features)
+        if features.get('headers') == ['binary']:
+            self.__decode = zc.zrs.messages.decode_binary
+        [self.__checksum_algorithm] = features.get('checksum', ['md5'])
+        self.__handler = self.blobReceived
+
+    def blobReceived(self, message):
+        if self.__blocks:
+            os.write(self.__file_handle, message)
+            self.__checksum.update(message)
+            self.__blocks -= 1
+            return
+
+        message_type, data = self.__decode(message)
+        requests = self.factory.requests
+        if message_type == 'G':
+            oid, tid, blocks = data
+            if not requests or (oid, tid) != (requests[0].oid,
+                                              requests[0].tid):
+                raise ValueError("Unexpected blob file",
+                                 ZODB.utils.oid_repr(oid),
+                                 ZODB.utils.tid_repr(tid))
+            self.__checksum = zc.zrs.checksum.new(self.__checksum_algorithm)
+            if blocks >= 0:
+                (self.__file_handle, self.__file_name
+                 ) = tempfile.mkstemp(
+                     'blob', 'secondary',
+                     self.factory.fetcher.factory.storage.temporaryDirectory()
+                     )
+                self.__blocks = blocks
+            else:
+                self.__file_name = None
+        elif message_type == 'C' and self.__checksum is not None:
+            checksum = self.__checksum
+            self.__checksum = None
+            if (self.factory.fetcher.factory.check_checksums
+                and data[0] != checksum.digest()):
+                raise AssertionError("Bad blob checksum", data[0],
+                                     checksum.digest())
+            filename = self.__file_name
+            if filename is not None:
+                os.close(self.__file_handle)
+                self.__file_handle = self.__file_name = None
+            blob = requests.popleft()
+            self.factory.outstanding -= blob.size
+            self.factory.fetcher.received(blob, filename)
+        else:
+            raise ValueError("Invalid message type, %r" % message_type)
+
+    def __discard(self):
+        # Discard a partly received blob file.
+        if self.__file_handle is not None:
+            os.close(self.__file_handle)
+            os.remove(self.__file_name)
+            self.__file_handle = self.__file_name = None
+
+
+class ChannelFactory(twisted.internet.protocol.ClientFactory):
+
+    protocol = Channel
+    connector = None
+    instance = None
+
+    def __init__(self, fetcher):
+        self.fetcher = fetcher
+        self.requests = collections.deque()
+        self.outstanding = 0
+
+    def request(self, blob):
+        self.requests.append(blob)
+        self.outstanding += blob.size
+        if self.instance is not None:
+            self.instance.request(blob)
+
+    def startedConnecting(self, connector):
+        if self.fetcher.closed:
+            connector.disconnect()
+        else:
+            self.connector = connector
+
+    def clientConnectionFailed(self, connector, reason):
+        self.connector = None
+        self.fetcher.channel_lost(reason)
+
+    def clientConnectionLost(self, connector, reason):
+        self.connector = None
+        self.fetcher.channel_lost(reason)
+
+    def close(self):
+        if self.connector is not None:
+            self.connector.disconnect()
+
+
+class Transaction:
+    """A transaction received from the replication stream
+
+    We record the storage calls made for it, to be made again once
+    its blob files have arrived.
+    """
+
+    def __init__(self, tid):
+        self.tid = tid
+        self.calls = []
+        self.blobs = []
+        self.size = 0
+
+    def ready(self):
+        for blob in self.blobs:
+            if not blob.arrived:
+                return False
+        return True
+
+    def apply(self, storage):
+        transaction = self.calls[0][1][0]
+        try:
+            for name, args in self.calls:
+                if name == 'restoreBlob':
+                    oid, serial, data, blob, prev_txn, _ = args
+                    if blob.filename is None:
+                        # The primary no longer had the blob file.
+                        storage.restore(oid, serial, data, '', prev_txn,
+                                        transaction)
+                        continue
+                    args = (oid, serial, data, blob.filename, prev_txn,
+                            transaction)
+                getattr(storage, name)(*args)
+        except:
+            storage.tpc_abort(transaction)
+            raise
+
+    def discard(self):
+        for blob in self.blobs:
+            if blob.filename is not None:
+                try:
+                    os.remove(blob.filename)
+                except OSError:
+                    pass # restored already
+
+
+class Queue:
+    """Transactions waiting for blob files
+
+    A queue stands in for a secondary's storage while transactions
+    are received, recording the calls made for each transaction.  The
+    calls are made on the storage, in order, once the blob files each
+    transaction needs have arrived.
+
+    When more than max_queued bytes of record data are queued, the
+    pause function is called to stop receiving, and when half of them
+    have been committed, resume is called.
+    """
+
+    max_queued = 1 << 24
+    paused = False
+    current = None
+    received = None
+
+    def __init__(self, storage, fetcher, pause, resume):
+        self.storage = storage
+        self.fetcher = fetcher
+        self.pause = pause
+        self.resume = resume
+        self.transactions = collections.deque()
+        self.queued = 0
+
+    def fetch(self, oid, tid, size):
+        blob = self.fetcher.fetch(oid, tid, size)
+        self.current.blobs.append(blob)
+        return blob
+
+    # Storage methods, for the transaction being received:
+
+    def tpc_begin(self, transaction, tid, status):
+        self.current = Transaction(tid)
+        self.current.calls.append(('tpc_begin', (transaction, tid, status)))
+
+    def restore(self, oid, serial, data, version, prev_txn, transaction):
+        self.current.calls.append(
+            ('restore', (oid, serial, data, version, prev_txn, transaction)))
+        self.current.size += len(data or b'')
+
+    def restoreBlob(self, oid, serial, data, blob, prev_txn, transaction):
+        self.current.calls.append(
+            ('restoreBlob', (oid, serial, data, blob, prev_txn, transaction)))
+        self.current.size += len(data or b'')
+
+    def tpc_vote(self, transaction):
+        self.current.calls.append(('tpc_vote', (transaction, )))
+
+    def tpc_finish(self, transaction, func=lambda tid: None):
+        current = self.current
+        self.current = None
+        current.calls.append(('tpc_finish', (transaction, func)))
+        self.transactions.append(current)
+        self.received = current.tid
+        self.queued += current.size
+        if self.queued > self.max_queued and not self.paused:
+            self.paused = True
+            self.pause()
+        self.apply()
+
+    def tpc_abort(self, transaction):
+        if self.current is not None:
+            self.current.discard()
+            self.current = None
+
+    def apply(self):
+        """Commit the transactions whose blob files have arrived
+        """
+        transactions = self.transactions
+        while transactions and transactions[0].ready():
+            transaction = transactions.popleft()
+            self.queued -= transaction.size
+            transaction.apply(self.storage)
+        if self.paused and self.queued <= self.max_queued // 2:
+            self.paused = False
+            self.resume()
+
+    def close(self):
+        for transaction in self.transactions:
+            transaction.discard()
+        self.transactions.clear()
+        self.tpc_abort(None)
+
+    def stats(self):
+        lag = 0.0
+        if self.transactions:
+            lag = (ZODB.TimeStamp.TimeStamp(self.received).timeTime() -
+                   ZODB.TimeStamp.TimeStamp(
+                       self.storage.lastTransaction()).timeTime())
+        return dict(
+            transactions=len(self.transactions), size=self.queued,
+            blobs=self.fetcher.blobs, blob_bytes=self.fetcher.blob_bytes,
+            received=self.received, lag=lag)
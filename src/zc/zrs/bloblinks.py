@@ -0,0 +1,79 @@
+##############################################################################
+#
+# Copyright (c) 2013 Zope Corporation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Blob files shared through hard links
+
+When a secondary's blob directory is on the same file system as the
+primary's, the primary can send the names of committed blob files
+rather than their data, and the secondary can hard link them into
+its blob directory.  Committed blob files are never changed, so they
+can be shared.
+
+A secondary offers to link blobs by sending the device and inode
+numbers and the (hex-encoded) name of its blob temporary directory::
+
+  link:DEVICE:INODE:NAME
+
+The primary accepts if it finds the same directory under that name,
+on the same device as its own blob directory.  Even so, links can
+fail, as when the primary's blob directory can't be read by the
+secondary, so secondaries fall back to being sent blob data.
+"""
+
+import binascii
+import errno
+import os
+import tempfile
+
+def offer(directory):
+    """Return an offer to link blobs into a directory
+    """
+    st = os.stat(directory)
+    return 'link:%x:%x:%s' % (
+        st.st_dev, st.st_ino,
+        binascii.hexlify(os.path.abspath(directory).encode('utf-8')
+                         ).decode('ascii'))
+
+def accept(spec, directory):
+    """Check whether blob files in a directory can be linked as offered
+    """
+    try:
+        kind, dev, ino, name = spec.split(':')
+        if kind != 'link':
+            return False
+        dev = int(dev, 16)
+        ino = int(ino, 16)
+        name = binascii.unhexlify(name).decode('utf-8')
+        st = os.stat(name)
+        return (st.st_dev == dev and st.st_ino == ino
+                and os.stat(directory).st_dev == dev)
+    except (ValueError, TypeError, binascii.Error, OSError):
+        return False
+
+def link(name, directory):
+    """Link a blob file into a directory, returning the new name
+    """
+    while 1:
+        # Like ZODB.utils.mktemp, we let mkstemp pick a name and
+        # remove the file it creates.  Someone may take the name
+        # before we link to it, in which case we try another.
+        fd, new_name = tempfile.mkstemp('.blob', 'secondary', directory)
+        os.close(fd)
+        os.remove(new_name)
+        try:
+            os.link(name, new_name)
+        except OSError as v:
+            if v.errno == errno.EEXIST:
+                continue
+            raise
+        return new_name
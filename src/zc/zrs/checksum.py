@@ -0,0 +1,67 @@
+##############################################################################
+#
+# Copyright (c) 2013 Zope Corporation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Replication-stream checksums
+
+Primaries send a checksum of the replication data with each
+transaction commit message, so secondaries can detect corrupted or
+mis-ordered data.  Traditionally, this is an md5 checksum of all of
+the messages sent since the connection started, seeded with the
+starting transaction id.  Secondaries using the zrs3 protocol can
+negotiate a cheaper algorithm, and can ask for checksums to cover only
+the messages for each transaction, so a failure identifies the
+transaction that was damaged.
+"""
+
+import hashlib
+import struct
+import zlib
+
+class CRC32:
+
+    def __init__(self, data=b''):
+        self.value = zlib.crc32(data)
+
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
+
+    def digest(self):
+        return struct.pack(">I", self.value)
+
+class NoChecksum:
+    """For trusted links.
+    """
+
+    def __init__(self, data=b''):
+        pass
+
+    def update(self, data):
+        pass
+
+    def digest(self):
+        return b''
+
+def blake2b(data=b''):
+    return hashlib.blake2b(data, digest_size=16)
+
+algorithms = {
+    'md5': hashlib.md5,
+    'blake2b': blake2b,
+    'crc32': CRC32,
+    'none': NoChecksum,
+    }
+
+def new(algorithm, data=b''):
+    """Return a new checksum object for the named algorithm
+    """
+    return algorithms[algorithm](data)
@@ -0,0 +1,82 @@
+##############################################################################
+#
+# Copyright (c) 2013 Zope Corporation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Compression of replication data
+
+Compression is specified with strings of the form ``name`` or
+``name:level``, where name is ``zlib`` or ``lzma``.
+
+With zlib, a single compression stream is used for a connection, and
+it is flushed after each batch of data, so later batches benefit from
+the history of earlier ones.  lzma can't flush without ending its
+stream, so each batch is compressed separately.
+"""
+
+import lzma
+import zlib
+
+codecs = {
+    # name: (default level, max level)
+    'zlib': (6, 9),
+    'lzma': (1, 9),
+    }
+
+def parse(spec):
+    """Parse a compression spec, returning a name and level
+    """
+    name, sep, level = spec.partition(':')
+    if name not in codecs:
+        raise ValueError("Unknown compression", spec)
+    default, max_level = codecs[name]
+    if sep:
+        try:
+            level = int(level)
+        except ValueError:
+            raise ValueError("Invalid compression level", spec)
+        if not 0 <= level <= max_level:
+            raise ValueError("Invalid compression level", spec)
+    else:
+        level = default
+    return name, level
+
+def parse_list(specs):
+    """Parse a whitespace-separated string or sequence of specs
+
+    The specs are returned in normalized form.
+    """
+    if isinstance(specs, str):
+        specs = specs.split()
+    return ['%s:%s' % parse(spec) for spec in specs]
+
+def compressor(spec):
+    """Return a function that compresses batches of data
+    """
+    name, level = parse(spec)
+    if name == 'zlib':
+        compressobj = zlib.compressobj(level)
+        def compress(data):
+            return (compressobj.compress(data) +
+                    compressobj.flush(zlib.Z_SYNC_FLUSH))
+    else:
+        def compress(data):
+            return lzma.compress(data, preset=level)
+    return compress
+
+def decompressor(spec):
+    """Return a function that decompresses compressed batches
+    """
+    name, level = parse(spec)
+    if name == 'zlib':
+        return zlib.decompressobj().decompress
+    else:
+        return lzma.decompress
@@ -0,0 +1,69 @@
+##############################################################################
+#
+# Copyright (c) 2013 Zope Corporation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Optional replication-protocol features
+
+Secondaries that don't need optional features open a connection by
+sending a protocol identifier, ``zrs2.0``, or ``zrs2.1`` if they
+support blobs, followed by the id of the last transaction they have.
+
+Secondaries that want optional features send ``zrs3.0`` or ``zrs3.1``
+instead, followed by a message offering features and then the
+transaction id.  Offers are space-separated items of the form
+``name=value,value...``, with values in order of preference, as in::
+
+  compress=zlib:6,lzma
+
+The primary replies with a message of the same form, giving the
+single value it chose for each feature it accepted, before sending any
+replication data.  Features that aren't mentioned in the reply are
+not used.
+"""
+
+PROTOCOLS = b'zrs2.0', b'zrs2.1'
+FEATURE_PROTOCOLS = b'zrs3.0', b'zrs3.1'
+
+# Offers are small.  This is the most we'll accept.
+limit = 1 << 12
+
+def feature_protocol(protocol):
+    """Return the feature-negotiating protocol for a basic protocol
+    """
+    return FEATURE_PROTOCOLS[PROTOCOLS.index(protocol)]
+
+def encode(features):
+    """Encode a mapping from feature names to values, or lists of values
+    """
+    items = []
+    for name, values in features.items():
+        if isinstance(values, str):
+            values = [values]
+        items.append('%s=%s' % (name, ','.join(values)))
+    return ' '.join(items).encode('ascii')
+
+def decode(message):
+    """Decode a feature message into a mapping from names to value lists
+    """
+    try:
+        text = message.decode('ascii')
+    except UnicodeDecodeError:
+        raise ValueError("Invalid features", message)
+
+    features = {}
+    for item in text.split():
+        name, sep, values = item.partition('=')
+        if not (name and sep and values):
+            raise ValueError("Invalid features", message)
+        features[name] = values.split(',')
+
+    return features
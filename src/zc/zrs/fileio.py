@@ -0,0 +1,209 @@
+##############################################################################
+#
+# Copyright (c) 2013 Zope Corporation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Storage-file reads for catching up
+
+Secondaries that are far behind read old parts of the primary's
+storage file, which, by default, pushes data the primary's clients
+need out of the page cache.  An I/O policy controls how catch-up
+reads are done:
+
+normal
+  Read as usual.
+
+sequential
+  Tell the kernel we're reading sequentially, and that we don't need
+  data we've read again.
+
+Either way, catch-up reads can be done in large blocks, with a
+read-ahead buffer, and at a lower I/O priority.  Once an iterator has
+caught up, its reads are normal.  Bytes read are counted for each
+policy.
+"""
+
+import ctypes
+import logging
+import os
+import platform
+import threading
+
+logger = logging.getLogger(__name__)
+
+policies = 'normal', 'sequential'
+
+fadvise = getattr(os, 'posix_fadvise', None)
+
+# Linux I/O priorities, set with the ioprio_set system call, which
+# Python doesn't provide.
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_SHIFT = 13
+priorities = dict(
+    normal=None,
+    low=(2 << IOPRIO_CLASS_SHIFT) | 7, # lowest best-effort priority
+    idle=3 << IOPRIO_CLASS_SHIFT,
+    )
+ioprio_syscalls = { # (get, set)
+    'x86_64': (252, 251),
+    'aarch64': (31, 30),
+    'i386': (290, 289),
+    'i686': (290, 289),
+    }
+
+try:
+    _syscall = ctypes.CDLL(None, use_errno=True).syscall
+except (OSError, AttributeError):
+    _syscall = None
+
+def get_io_priority():
+    """Return the current thread's I/O priority
+    """
+    return _syscall(ioprio_syscalls[platform.machine()][0],
+                    IOPRIO_WHO_PROCESS, 0)
+
+def set_io_priority(priority):
+    """Set the current thread's I/O priority
+    """
+    if _syscall(ioprio_syscalls[platform.machine()][1],
+                IOPRIO_WHO_PROCESS, 0, priority) < 0:
+        raise OSError(ctypes.get_errno(), "ioprio_set failed")
+
+def io_priorities_supported():
+    if _syscall is None or platform.machine() not in ioprio_syscalls:
+        return False
+    try:
+        return get_io_priority() >= 0
+    except Exception:
+        return False
+
+class IOPolicy:
+
+    def __init__(self, name='normal', read_ahead=0, priority='normal'):
+        if name not in policies:
+            raise ValueError("Invalid catch-up I/O policy", name)
+        if priority not in priorities:
+            raise ValueError("Invalid catch-up I/O priority", priority)
+        self.name = name
+        self.sequential = name == 'sequential' and fadvise is not None
+        self.read_ahead = read_ahead or 0
+        self.priority = priorities[priority]
+        if self.priority is not None and not io_priorities_supported():
+            logger.warning("I/O priorities aren't supported here")
+            self.priority = None
+        self.lock = threading.Lock()
+        self.counts = dict((name, 0) for name in policies)
+
+    def open(self, path):
+        return PolicyFile(open(path, 'rb', 0), self)
+
+    def count(self, name, size):
+        with self.lock:
+            self.counts[name] += size
+
+    def stats(self):
+        """Return the number of bytes read with each policy
+        """
+        with self.lock:
+            return dict(self.counts)
+
+class PolicyFile:
+    """A file opened for reading, following an I/O policy
+
+    It's read as an iterator catches up, until its caught_up method
+    is called.
+    """
+
+    catching_up = True
+
+    def __init__(self, file, policy):
+        self.file = file
+        self.name = file.name
+        self.fd = file.fileno()
+        self.policy = policy
+        self.pos = 0
+        self.buffer = b''
+        self.buffer_pos = 0
+        self.dropped = 0
+        if policy.sequential:
+            fadvise(self.fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+    def fileno(self):
+        return self.fd
+
+    def seek(self, pos, whence=0):
+        if whence == 1:
+            pos += self.pos
+        elif whence == 2:
+            pos += os.fstat(self.fd).st_size
+        self.pos = pos
+
+    def tell(self):
+        return self.pos
+
+    def read(self, size=-1):
+        pos = self.pos
+        if size < 0:
+            size = max(os.fstat(self.fd).st_size - pos, 0)
+
+        if not self.catching_up:
+            data = os.pread(self.fd, size, pos)
+            self.policy.count('normal', len(data))
+        elif self.policy.read_ahead:
+            start = pos - self.buffer_pos
+            if start < 0 or start + size > len(self.buffer):
+                self.buffer = self._read(max(size, self.policy.read_ahead))
+                self.buffer_pos = pos
+                start = 0
+            data = self.buffer[start:start+size]
+        else:
+            data = self._read(size)
+
+        self.pos = pos + len(data)
+        return data
+
+    def _read(self, size):
+        # Read catch-up data following our policy
+        policy = self.policy
+        pos = self.pos
+        if policy.priority is None:
+            data = os.pread(self.fd, size, pos)
+        else:
+            old = get_io_priority()
+            set_io_priority(policy.priority)
+            try:
+                data = os.pread(self.fd, size, pos)
+            finally:
+                set_io_priority(old)
+        policy.count(policy.name, len(data))
+
+        if policy.sequential and pos > self.dropped:
+            # We've sent what's before pos, and won't read it again.
+            fadvise(self.fd, self.dropped, pos - self.dropped,
+                    os.POSIX_FADV_DONTNEED)
+            self.dropped = pos
+        return data
+
+    def caught_up(self):
+        """Read normally from now on
+
+        The rest of the file was written recently and is likely to be
+        read by others.
+        """
+        if self.catching_up:
+            self.catching_up = False
+            self.buffer = b''
+            if self.policy.sequential:
+                fadvise(self.fd, 0, 0, os.POSIX_FADV_NORMAL)
+
+    def close(self):
+        self.buffer = b''
+        self.file.close()
@@ -0,0 +1,192 @@
+##############################################################################
+#
+# Copyright (c) 2013 Zope Corporation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Syncing secondaries' storage files for groups of transactions
+
+A file storage syncs its file as it commits each transaction, so a
+secondary catching up on many small transactions spends most of its
+time waiting for syncs.  A secondary can instead have its file synced
+for groups of transactions: transactions are committed without
+syncing, and a separate thread syncs the file at most interval seconds
+after the first transaction committed since the last sync, or as soon
+as max_transactions are waiting, if that's set.
+
+Until the file is synced, a transaction isn't durable.  The storage's
+lastTransaction method still returns it, so that replication picks up
+after it, but the secondary's lastTransaction method returns the last
+durable transaction, and databases using the secondary aren't told
+about transactions until they're durable.  After a system crash, the
+storage may lose transactions that weren't synced, and the secondary
+asks for them again.
+
+Only lastTransaction and invalidations are held back.  The storage's
+other methods, like load, loadBefore and history, which the secondary
+passes through, see transactions as soon as they're committed, so a
+ZEO server serving the secondary can give clients data from
+transactions after the last transaction it tells them about.
+
+The storage's own _finish_finish method commits transactions.  While
+it's called, the file storage module's fsync function skips syncing
+the storage's file in the calling thread.
+"""
+
+import importlib
+import os
+import threading
+import time
+
+# ZODB.FileStorage.FileStorage is the class, rather than the module.
+fs_module = importlib.import_module('ZODB.FileStorage.FileStorage')
+
+# The file descriptor whose syncs are skipped, in each thread:
+skipping = threading.local()
+
+install_lock = threading.Lock()
+original_fsync = None
+
+def fsync(fileno):
+    # Replaces the file storage module's fsync function.
+    if fileno != getattr(skipping, 'fileno', None):
+        original_fsync(fileno)
+
+def supported(fs):
+    """Return whether syncs can be grouped for a file storage
+    """
+    return (callable(getattr(fs, '_finish_finish', None)) and
+            getattr(fs_module, 'fsync', None) is not None)
+
+def install():
+    global original_fsync
+    with install_lock:
+        if fs_module.fsync is not fsync:
+            original_fsync = fs_module.fsync
+            fs_module.fsync = fsync
+
+class GroupSync:
+
+    # The first transaction committed since the last sync, if any:
+    first = None
+
+    def __init__(self, fs, interval, max_transactions=0):
+        if not supported(fs):
+            raise TypeError("Can't group syncs for", fs)
+        install()
+        self.fs = fs
+        self.finish_finish = fs._finish_finish
+        self.interval = interval
+        self.max_transactions = max_transactions
+        self.condition = threading.Condition()
+        self.durable = fs.lastTransaction()
+        self.waiting = 0
+        self.callbacks = []
+        self.syncs = self.synced = 0
+        self.closed = False
+        fs._finish_finish = self._finish_finish
+        self.thread = thread = threading.Thread(
+            target=self.run, name='GroupSync(%s)' % fs.getName())
+        thread.daemon = True
+        thread.start()
+
+    def lastTransaction(self):
+        with self.condition:
+            return self.durable
+
+    def _finish_finish(self, tid):
+        # Stands in for the file storage's _finish_finish, which is
+        # called with its lock held, to commit without syncing.
+        skipping.fileno = self.fs._file.fileno()
+        try:
+            self.finish_finish(tid)
+        finally:
+            skipping.fileno = None
+        with self.condition:
+            self.waiting += 1
+            if self.first is None:
+                self.first = time.monotonic()
+                self.condition.notify()
+            elif self.waiting == self.max_transactions:
+                self.condition.notify()
+
+    def after_sync(self, func):
+        """Return a function that calls func once a transaction is durable
+
+        It's passed to a storage's tpc_finish, to defer invalidations.
+        """
+        def call_after_sync(tid):
+            with self.condition:
+                if tid > self.durable:
+                    self.callbacks.append((func, tid))
+                    return
+            func(tid)
+        return call_after_sync
+
+    def run(self):
+        condition = self.condition
+        while 1:
+            with condition:
+                while 1:
+                    if self.first is None:
+                        if self.closed:
+                            return
+                        condition.wait()
+                        continue
+                    if self.closed or (
+                        self.max_transactions and
+                        self.waiting >= self.max_transactions):
+                        break
+                    delay = self.first + self.interval - time.monotonic()
+                    if delay <= 0:
+                        break
+                    condition.wait(delay)
+            self.sync()
+
+    def sync(self):
+        fs = self.fs
+        with fs._lock:
+            tid = fs._ltid
+            fs._file.flush()
+            # The storage may replace its file, when it's packed, while
+            # we sync.
+            fileno = os.dup(fs._file.fileno())
+            with self.condition:
+                waiting = self.waiting
+                self.waiting = 0
+                self.first = None
+
+        # Transactions may be committed while we sync.  They'll be
+        # durable after the next sync.
+        try:
+            os.fsync(fileno)
+        finally:
+            os.close(fileno)
+
+        with self.condition:
+            self.durable = tid
+            self.syncs += 1
+            self.synced += waiting
+            callbacks = [(func, ctid) for (func, ctid) in self.callbacks
+                         if ctid <= tid]
+            self.callbacks = [(func, ctid) for (func, ctid) in self.callbacks
+                              if ctid > tid]
+        for func, ctid in callbacks:
+            func(ctid)
+
+    def close(self):
+        """Sync any transactions committed since the last sync, and stop
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        if self.thread is not threading.current_thread():
+            self.thread.join()
+        self.fs.__dict__.pop('_finish_finish', None)
@@ -0,0 +1,276 @@
+##############################################################################
+#
+# Copyright (c) 2013 Zope Corporation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Replication control messages
+
+Each transaction is sent as a 'T' message with transaction meta data,
+followed by an 'S' (store) or 'B' (blob) message for each record, and
+a final 'C' (commit) message with a checksum.  Each 'S' or 'B' message
+is followed by a message with the record data, and each 'B' message is
+also followed by a number of blob-data messages.  Records with more
+data than the negotiated chunk size are sent with an 'L' (large)
+message instead of an 'S' message, followed by the data in as many
+messages as needed.
+
+When the secondary can link blob files from the primary's blob
+directory, blob records are sent with an 'H' (hard link) message
+instead of a 'B' message, followed by the record data and the name of
+the committed blob file, rather than by blob data.
+
+When the secondary fetches blob files over separate blob channels,
+blob records are sent with a 'D' (deferred blob) message giving the
+size of the blob file, followed by the record data only.  A blob
+channel is a connection on which the secondary sends requests, each
+an oid followed by a tid, with no control message.  The primary
+answers each request, in order, with a 'G' (get blob) message giving
+the number of blob-data messages that follow, or -1 if it no longer
+has the blob file, and a 'C' message with a checksum of the blob
+data.
+
+When both ends have file storages without blobs, transactions may be
+sent raw, as an 'R' message giving the transaction id, the size of its
+transaction record and the ids of the transactions its backpointers
+point into, followed by the transaction record, as found in the
+primary's storage file, in as many messages as needed, and a 'C'
+message.
+
+Empty secondaries may be sent a snapshot of the primary's storage
+before any transactions, as a sequence of 'F' (file block) messages,
+giving the kind of block, a key, a file position and a size.  Index,
+data and blob blocks are followed by that many bytes of file data, in
+as many messages as needed.  Each block ends with a 'C' message.
+
+Primaries that limit the number of secondaries catching up at once
+may send a 'Q' (queued) message, outside of any transaction, giving a
+waiting secondary its position in the queue and the number of seconds
+it has waited.  A position of 0 means the secondary has been admitted.
+
+Control messages are pickled (type, data) tuples, unless binary
+headers have been negotiated, in which case they are encoded with
+struct:
+
+T  tid, status, user length, description length, extension length,
+   followed by the user, description and (pickled) extension
+S  oid, tid, data_txn (z64 for None)
+B  oid, tid, data_txn (z64 for None), number of blob blocks
+L  oid, tid, data_txn (z64 for None), data size
+H  oid, tid, data_txn (z64 for None)
+D  oid, tid, data_txn (z64 for None), blob file size
+G  oid, tid, number of blob blocks (signed)
+R  tid, transaction record size, followed by backpointer transaction ids
+F  first letter of the block kind, position, size, followed by the key
+Q  queue position, seconds waited
+C  followed by the checksum
+
+Binary headers are cheaper to produce and parse, and spare
+secondaries from unpickling network input.
+"""
+
+from six import BytesIO
+from six.moves import cPickle
+import struct
+import ZODB.utils
+
+try:
+    long
+except NameError:
+    long = lambda n: n
+
+z64 = ZODB.utils.z64
+
+class PickleEncoder:
+
+    def __init__(self):
+        self._file = BytesIO()
+        self._pickler = cPickle.Pickler(self._file, 1)
+        self._pickler.fast = 1
+
+    def dump(self, data):
+        self._file.seek(0)
+        self._file.truncate()
+        self._pickler.dump(data)
+        return self._file.getvalue()
+
+    def transaction(self, trans):
+        return self.dump(('T', (trans.tid, trans.status, trans.user,
+                                trans.description, trans._extension)))
+
+    def store(self, record):
+        return self.dump(('S', (record.oid, record.tid, record.version,
+                                record.data_txn)))
+
+    def blob(self, record, blocks):
+        return self.dump(('B', (record.oid, record.tid, record.version,
+                                record.data_txn, long(blocks))))
+
+    def blob_link(self, record):
+        return self.dump(('H', (record.oid, record.tid, record.version,
+                                record.data_txn)))
+
+    def blob_fetch(self, record, size):
+        return self.dump(('D', (record.oid, record.tid, record.version,
+                                record.data_txn, long(size))))
+
+    def blob_file(self, oid, tid, blocks):
+        return self.dump(('G', (oid, tid, long(blocks))))
+
+    def large(self, record, size):
+        return self.dump(('L', (record.oid, record.tid, record.version,
+                                record.data_txn, long(size))))
+
+    def raw(self, tid, size, back_tids):
+        return self.dump(('R', (tid, long(size), list(back_tids))))
+
+    def file_block(self, kind, key, pos, size):
+        return self.dump(('F', (kind, key, long(pos), long(size))))
+
+    def queued(self, position, waited):
+        return self.dump(('Q', (position, float(waited))))
+
+    def commit(self, checksum):
+        return self.dump(('C', (checksum, )))
+
+T = struct.Struct(">c8scHHH")
+S = struct.Struct(">c8s8s8s")
+B = struct.Struct(">c8s8s8sQ")
+L = struct.Struct(">c8s8s8sQ")
+H = struct.Struct(">c8s8s8s")
+D = struct.Struct(">c8s8s8sQ")
+G = struct.Struct(">c8s8sq")
+R = struct.Struct(">c8sQ")
+Q = struct.Struct(">cId")
+F = struct.Struct(">ccQQ")
+
+# Kinds of snapshot file blocks
+file_block_kinds = 'start', 'index', 'data', 'blob', 'end'
+_file_block_kinds = dict((kind[:1].encode('ascii'), kind)
+                         for kind in file_block_kinds)
+
+class BinaryEncoder:
+
+    def transaction(self, trans):
+        user = trans.user
+        description = trans.description
+        extension = trans.extension_bytes
+        return b''.join((
+            T.pack(b'T', trans.tid, trans.status.encode('ascii'),
+                   len(user), len(description), len(extension)),
+            user, description, extension))
+
+    def store(self, record):
+        return S.pack(b'S', record.oid, record.tid, record.data_txn or z64)
+
+    def blob(self, record, blocks):
+        return B.pack(b'B', record.oid, record.tid, record.data_txn or z64,
+                      blocks)
+
+    def blob_link(self, record):
+        return H.pack(b'H', record.oid, record.tid, record.data_txn or z64)
+
+    def blob_fetch(self, record, size):
+        return D.pack(b'D', record.oid, record.tid, record.data_txn or z64,
+                      size)
+
+    def blob_file(self, oid, tid, blocks):
+        return G.pack(b'G', oid, tid, blocks)
+
+    def large(self, record, size):
+        return L.pack(b'L', record.oid, record.tid, record.data_txn or z64,
+                      size)
+
+    def raw(self, tid, size, back_tids):
+        return R.pack(b'R', tid, size) + b''.join(back_tids)
+
+    def file_block(self, kind, key, pos, size):
+        return F.pack(b'F', kind[:1].encode('ascii'), pos, size) + key
+
+    def queued(self, position, waited):
+        return Q.pack(b'Q', position, waited)
+
+    def commit(self, checksum):
+        return b'C' + checksum
+
+def decode_binary(message):
+    """Decode a binary control message into a (type, data) tuple
+
+    The tuple has the same form as the pickled tuples.
+    """
+    message_type = message[:1]
+    if message_type == b'S':
+        if len(message) != S.size:
+            raise ValueError("Invalid store message", message)
+        _, oid, tid, data_txn = S.unpack_from(message)
+        return 'S', (oid, tid, '', data_txn if data_txn != z64 else None)
+    elif message_type == b'T':
+        _, tid, status, ulen, dlen, elen = T.unpack_from(message)
+        pos = T.size
+        end = pos + ulen + dlen + elen
+        if len(message) != end:
+            raise ValueError("Invalid transaction message", message)
+        user = message[pos:pos+ulen]
+        pos += ulen
+        description = message[pos:pos+dlen]
+        pos += dlen
+        extension = message[pos:end]
+        return 'T', (tid, status.decode('ascii'), user, description,
+                     extension)
+    elif message_type == b'B':
+        if len(message) != B.size:
+            raise ValueError("Invalid blob message", message)
+        _, oid, tid, data_txn, blocks = B.unpack_from(message)
+        return 'B', (oid, tid, '', data_txn if data_txn != z64 else None,
+                     blocks)
+    elif message_type == b'H':
+        if len(message) != H.size:
+            raise ValueError("Invalid blob-link message", message)
+        _, oid, tid, data_txn = H.unpack_from(message)
+        return 'H', (oid, tid, '', data_txn if data_txn != z64 else None)
+    elif message_type == b'D':
+        if len(message) != D.size:
+            raise ValueError("Invalid blob-fetch message", message)
+        _, oid, tid, data_txn, size = D.unpack_from(message)
+        return 'D', (oid, tid, '', data_txn if data_txn != z64 else None,
+                     size)
+    elif message_type == b'G':
+        if len(message) != G.size:
+            raise ValueError("Invalid blob-file message", message)
+        _, oid, tid, blocks = G.unpack_from(message)
+        return 'G', (oid, tid, blocks)
+    elif message_type == b'L':
+        if len(message) != L.size:
+            raise ValueError("Invalid large-record message", message)
+        _, oid, tid, data_txn, size = L.unpack_from(message)
+        return 'L', (oid, tid, '', data_txn if data_txn != z64 else None,
+                     size)
+    elif message_type == b'R':
+        if len(message) < R.size or (len(message) - R.size) % 8:
+            raise ValueError("Invalid raw-transaction message", message)
+        _, tid, size = R.unpack_from(message)
+        return 'R', (tid, size, [message[pos:pos+8] for pos
+                                 in range(R.size, len(message), 8)])
+    elif message_type == b'F':
+        if len(message) < F.size:
+            raise ValueError("Invalid file-block message", message)
+        _, kind, pos, size = F.unpack_from(message)
+        if kind not in _file_block_kinds:
+            raise ValueError("Invalid file-block message", message)
+        return 'F', (_file_block_kinds[kind], message[F.size:], pos, size)
+    elif message_type == b'C':
+        return 'C', (message[1:], )
+    elif message_type == b'Q':
+        if len(message) != Q.size:
+            raise ValueError("Invalid queued message", message)
+        _, position, waited = Q.unpack_from(message)
+        return 'Q', (position, waited)
+    else:
+        raise ValueError("Invalid message type, %r" % message_type)
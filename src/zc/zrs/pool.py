@@ -0,0 +1,183 @@
+##############################################################################
+#
+# Copyright (c) 2013 Zope Corporation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""A bounded pool of threads running resumable tasks
+
+Tasks are generators.  A task runs until it has to wait for
+something, and then yields.  It's resumed after its wake method has
+been called, typically by whatever it was waiting for.  If wake is
+called while a task is running, the task is run again after it
+yields, so wake-ups aren't lost.  A task that has more to do, but
+wants to let other tasks run, calls wake before yielding.
+
+A task can also ask to be woken after a delay, using wake_after.
+
+Threads are started as tasks are added, up to the pool size, and
+exit when there are no tasks left.
+"""
+
+import collections
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+READY, RUNNING, WAITING, DONE = 'ready', 'running', 'waiting', 'done'
+
+class Task:
+
+    state = READY
+    woken = False
+
+    def __init__(self, pool, generator, name):
+        self.pool = pool
+        self.generator = generator
+        self.name = name
+
+    def __repr__(self):
+        return '<Task %s %s>' % (self.name, self.state)
+
+    def wake(self):
+        pool = self.pool
+        with pool.lock:
+            if self.state == WAITING:
+                pool._schedule(self)
+            elif self.state == RUNNING:
+                self.woken = True
+
+    def wake_after(self, delay):
+        """Wake the task after the given number of seconds
+        """
+        pool = self.pool
+        with pool.lock:
+            heapq.heappush(pool.timers, (time.monotonic() + delay,
+                                         next(pool.timer_sequence), self))
+            pool.work.notify()
+
+    def join(self, timeout=None):
+        pool = self.pool
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        with pool.lock:
+            while self.state != DONE:
+                if timeout is None:
+                    pool.done.wait()
+                else:
+                    w = deadline - time.monotonic()
+                    if w <= 0:
+                        break
+                    pool.done.wait(w)
+
+class WorkerPool:
+
+    def __init__(self, size, name='zrs'):
+        self.size = size
+        self.name = name
+        self.lock = threading.Lock()
+        self.work = threading.Condition(self.lock)
+        self.done = threading.Condition(self.lock)
+        self.ready = collections.deque()
+        self.timers = []
+        self.timer_sequence = itertools.count()
+        self.tasks = set()
+        self.threads = 0
+        self.busy = 0
+
+    def start(self, func, name=''):
+        """Start running a task
+
+        The function is called with the new task, before the task is
+        scheduled, and returns the generator to run.
+        """
+        task = Task(self, None, name)
+        task.generator = func(task)
+        with self.lock:
+            self.tasks.add(task)
+            self._schedule(task)
+            if self.threads < self.size:
+                self.threads += 1
+                thread = threading.Thread(
+                    target=self._work, name='%s worker' % self.name)
+                thread.daemon = True
+                thread.start()
+        return task
+
+    def stats(self):
+        with self.lock:
+            return dict(size=self.size, threads=self.threads,
+                        busy=self.busy, ready=len(self.ready),
+                        tasks=len(self.tasks))
+
+    def _schedule(self, task):
+        # Called with the lock held
+        task.state = READY
+        self.ready.append(task)
+        self.work.notify()
+
+    def _wake_due(self):
+        # Called with the lock held.  Wake tasks whose timers have
+        # expired and return the time until the next timer expires.
+        timers = self.timers
+        now = time.monotonic()
+        while timers:
+            deadline, _, task = timers[0]
+            if deadline > now:
+                return deadline - now
+            heapq.heappop(timers)
+            if task.state == WAITING:
+                self._schedule(task)
+            elif task.state != DONE:
+                task.woken = True
+
+    def _work(self):
+        lock = self.lock
+        while 1:
+            with lock:
+                while 1:
+                    timeout = self._wake_due()
+                    if self.ready:
+                        break
+                    if not self.tasks:
+                        self.threads -= 1
+                        return
+                    self.work.wait(timeout)
+                task = self.ready.popleft()
+                task.state = RUNNING
+                task.woken = False
+                self.busy += 1
+
+            try:
+                next(task.generator)
+            except StopIteration:
+                done = True
+            except Exception:
+                logger.exception("%s: %r failed", self.name, task)
+                done = True
+            else:
+                done = False
+
+            with lock:
+                self.busy -= 1
+                if done:
+                    task.state = DONE
+                    self.tasks.discard(task)
+                    self.done.notify_all()
+                    if not self.tasks:
+                        self.work.notify_all() # Let idle threads exit.
+                elif task.woken:
+                    self._schedule(task)
+                else:
+                    task.state = WAITING
@@ -12,18 +12,34 @@
 #
 ##############################################################################
 
-from hashlib import md5
-from six import BytesIO
 from six.moves import cPickle
+import collections
 import logging
+import mmap
 import os
+import struct
 import sys
 import threading
 import time
 import twisted.internet.interfaces
 import twisted.internet.protocol
+import zc.zrs.admission
+import zc.zrs.backpointers
+import zc.zrs.blobchannel
+import zc.zrs.bloblinks
+import zc.zrs.checksum
+import zc.zrs.compression
+import zc.zrs.features
+import zc.zrs.fileio
+import zc.zrs.messages
+import zc.zrs.pool
+import zc.zrs.ratelimit
+import zc.zrs.rawtxn
+import zc.zrs.readahead
 import zc.zrs.reactor
 import zc.zrs.sizedmessage
+import zc.zrs.snapshot
+import zc.zrs.tidindex
 import ZODB.BaseStorage
 import ZODB.blob
 import ZODB.FileStorage
@@ -33,11 +49,6 @@ import ZODB.TimeStamp
 import ZODB.utils
 import zope.interface
 
-try:
-    long
-except NameError:
-    long = lambda n: n
-
 if not hasattr(ZODB.blob.BlobStorage, 'restoreBlob'):
     import zc.zrs.restoreblob
 
@@ -75,7 +86,15 @@ class Base(object):
 
 class Primary(Base):
 
-    def __init__(self, storage, addr, reactor=None):
+    def __init__(self, storage, addr, reactor=None,
+                 transaction_buffer_size=0, worker_pool_size=8,
+                 high_watermark=None, low_watermark=None,
+                 max_in_flight=None, rate_limit=None, total_rate_limit=None,
+                 max_catch_ups=None, catch_up_lag=60,
+                 tid_index_interval=1 << 20, memory_map=False,
+                 catch_up_io='normal', catch_up_read_ahead=0,
+                 catch_up_io_priority='normal', blob_block_size=1 << 16,
+                 backpointer_cache_size=0, read_ahead_queue_size=0):
         Base.__init__(self, storage, addr, reactor)
         storage = self._storage
 
@@ -90,7 +109,23 @@ class Primary(Base):
                           ):
             raise ValueError("Invalid storage", storage)
 
-        self._changed = threading.Condition()
+        self._changed = Changes()
+
+        fs = zc.zrs.snapshot.file_storage(storage)
+        if fs is not None:
+            zc.zrs.snapshot.remove_stale_indexes(fs)
+
+        if tid_index_interval:
+            self._tid_index = zc.zrs.tidindex.TidIndex(
+                storage, tid_index_interval)
+        else:
+            self._tid_index = None
+
+        if backpointer_cache_size:
+            self._back_cache = zc.zrs.backpointers.BackpointerCache(
+                storage, backpointer_cache_size)
+        else:
+            self._back_cache = None
 
         # required methods
         for name in (
@@ -115,7 +150,17 @@ class Primary(Base):
             if hasattr(storage, name):
                 setattr(self, name, getattr(storage, name))
 
-        self._factory = PrimaryFactory(storage, self._changed)
+        self._factory = PrimaryFactory(
+            storage, self._changed, transaction_buffer_size,
+            worker_pool_size, dict(high_watermark=high_watermark,
+                                   low_watermark=low_watermark,
+                                   max_in_flight=max_in_flight),
+            rate_limit, total_rate_limit,
+            zc.zrs.admission.AdmissionScheduler(max_catch_ups, catch_up_lag),
+            self._tid_index, memory_map,
+            zc.zrs.fileio.IOPolicy(catch_up_io, catch_up_read_ahead,
+                                   catch_up_io_priority),
+            blob_block_size, self._back_cache, read_ahead_queue_size)
         logger.info("Opening %s %s", self.getName(), addr)
         self._reactor.callFromThread(self.cfr_listen)
 
@@ -138,12 +183,71 @@ class Primary(Base):
             self._listener.stopListening()
 
     def tpc_finish(self, *args):
+        # The transaction is written at _pos until it's finished.
+        pos = self._storage._pos
         tid = self._storage.tpc_finish(*args)
-        self._changed.acquire()
-        self._changed.notifyAll()
-        self._changed.release()
+        if self._tid_index is not None:
+            self._tid_index.add(tid, pos)
+        self._changed.committed()
+        # Our caller may be holding a commit lock, so we let the
+        # reactor wake those waiting for the commit.
+        self._reactor.callFromThread(self._changed.notify_waiters)
         return tid
 
+    def getTransactionBufferStats(self):
+        """Return statistics for the buffer of recent transactions
+        """
+        return self._factory.tail.stats()
+
+    def getWorkerPoolStats(self):
+        """Return statistics for the pool of threads sending data
+        """
+        return self._factory.pool.stats()
+
+    def setRateLimits(self, rate_limit, total_rate_limit):
+        """Limit the rates, in bytes per second, of catch-up data
+
+        The first limit applies to each secondary and the second to
+        all secondaries together.  Pass None for no limit.
+        """
+        self._factory.set_rate_limits(rate_limit, total_rate_limit)
+
+    def setMaxCatchUps(self, max_catch_ups):
+        """Set the number of secondaries that may catch up at once
+
+        Pass None for no limit.
+        """
+        self._factory.admission.set_limit(max_catch_ups)
+
+    def getCatchUpStats(self):
+        """Return the numbers of secondaries catching up and waiting to
+        """
+        return self._factory.admission.stats()
+
+    def getTidIndexStats(self):
+        """Return statistics for the index of transaction positions
+        """
+        if self._tid_index is not None:
+            return self._tid_index.stats()
+
+    def getIOStats(self):
+        """Return the numbers of bytes read with each I/O policy
+        """
+        return self._factory.io_policy.stats()
+
+    def getBackpointerCacheStats(self):
+        """Return statistics for the cache of resolved backpointers
+        """
+        if self._back_cache is not None:
+            return self._back_cache.stats()
+
+    def getReadAheadStats(self):
+        """Return read-ahead statistics for secondaries catching up
+
+        A dictionary is returned, keyed by secondary address.
+        """
+        return self._factory.read_ahead_stats()
+
     def close(self):
         logger.info('Closing %s %s', self.getName(), self._addr)
         self._reactor.callFromThread(self.cfr_stop_listening)
@@ -152,23 +256,69 @@ class Primary(Base):
         # give the secondaries more time to catch up.
         self._storage.close()
         self._factory.close()
+        if self._tid_index is not None:
+            self._tid_index.close()
 
 class PrimaryFactory(twisted.internet.protocol.Factory):
 
-    def __init__(self, storage, changed):
+    def __init__(self, storage, changed, transaction_buffer_size=0,
+                 worker_pool_size=8, flow_control=None, rate_limit=None,
+                 total_rate_limit=None, admission=None, tid_index=None,
+                 memory_map=False, io_policy=None, blob_block_size=None,
+                 back_cache=None, read_ahead_size=0):
         self.storage = storage
         self.changed = changed
+        self.flow_control = flow_control or {}
+        self.rate_limit = rate_limit
+        self.total_bucket = zc.zrs.ratelimit.TokenBucket(total_rate_limit)
+        if admission is None:
+            admission = zc.zrs.admission.AdmissionScheduler()
+        self.admission = admission
+        self.tid_index = tid_index
+        self.memory_map = memory_map
+        if io_policy is None:
+            io_policy = zc.zrs.fileio.IOPolicy()
+        self.io_policy = io_policy
+        self.blob_block_size = blob_block_size
+        self.back_cache = back_cache
+        self.read_ahead_size = read_ahead_size
         self.instances = []
         self.threads = ThreadCounter()
+        self.pool = zc.zrs.pool.WorkerPool(
+            worker_pool_size, 'Primary(%s)' % storage.getName())
+        self.tail = SharedTail(storage, changed, self.threads.run,
+                               transaction_buffer_size, memory_map,
+                               io_policy, blob_block_size, back_cache)
+
+    def start(self, func, name=''):
+        return self.pool.start(
+            lambda task: self.threads.task(func(task)), name)
+
+    def set_rate_limits(self, rate_limit, total_rate_limit):
+        self.rate_limit = rate_limit
+        self.total_bucket.set_rate(total_rate_limit)
+        for instance in list(self.instances):
+            instance.set_rate_limit(rate_limit)
+
+    def read_ahead_stats(self):
+        result = {}
+        for instance in list(self.instances):
+            stats = instance.read_ahead_stats()
+            if stats is not None:
+                result[str(instance.transport.getPeer())] = stats
+        return result
 
     def close(self):
         for instance in list(self.instances):
             instance.close()
+        self.tail.close()
         self.threads.wait(60)
 
 class PrimaryProtocol(twisted.internet.protocol.Protocol):
 
     __protocol = None
+    __features = None
+    __bootstrap = None
     __start = None
     __producer = None
 
@@ -192,6 +342,14 @@ class PrimaryProtocol(twisted.internet.protocol.Protocol):
                 self.transport.loseConnection)
         self.info('Closed')
 
+    def set_rate_limit(self, rate_limit):
+        if self.__producer is not None:
+            self.__producer.set_rate_limit(rate_limit)
+
+    def read_ahead_stats(self):
+        if self.__producer is not None:
+            return self.__producer.read_ahead_stats()
+
     def _stop(self):
         # for tests
         if self.__producer is not None:
@@ -216,14 +374,43 @@ class PrimaryProtocol(twisted.internet.protocol.Protocol):
 
     def messageReceived(self, data):    # cfr
         if self.__protocol is None:
-            if data == b'zrs2.0':
+            if data in (b'zrs2.0', b'zrs3.0'):
                 if ZODB.interfaces.IBlobStorage.providedBy(
                     self.factory.storage):
                     return self.error("Invalid protocol %r. Require >= 2.1",
                                       data)
-            elif data != b'zrs2.1':
+            elif data not in (b'zrs2.1', b'zrs3.1'):
                 return self.error("Invalid protocol %r", data)
             self.__protocol = data
+            if data in zc.zrs.features.FEATURE_PROTOCOLS:
+                # Feature offers come next.
+                self.__stream.limit = zc.zrs.features.limit
+        elif (self.__features is None and
+              self.__protocol in zc.zrs.features.FEATURE_PROTOCOLS):
+            self.__stream.limit = 8
+            try:
+                offers = zc.zrs.features.decode(data)
+            except ValueError:
+                return self.error("Invalid features %r", data)
+            self.__features = self.negotiate(offers)
+            self.info("features %r", self.__features)
+            self.transport.write(zc.zrs.sizedmessage.marshal(
+                zc.zrs.features.encode(self.__features)))
+            if self.__features.get('channel') == 'blobs':
+                # A blob channel. Blob requests come next.
+                self.__stream.limit = zc.zrs.blobchannel.request_size
+                self.__producer = zc.zrs.blobchannel.Sender(
+                    self.factory.storage, self.transport, self.__peer,
+                    self.factory.start, self.__features,
+                    self.factory.blob_block_size or blob_block_size)
+        elif self.__features and self.__features.get('channel') == 'blobs':
+            if not data:
+                logger.debug(self.__peer + "keep-alive")
+                return # ignore empty messages
+            try:
+                self.__producer.request(data)
+            except ValueError:
+                return self.error("Invalid blob request, %r", data)
         else:
             if self.__start is not None:
                 if not data:
@@ -238,13 +425,96 @@ class PrimaryProtocol(twisted.internet.protocol.Protocol):
             self.__producer = PrimaryProducer(
                 (self.factory.storage, self.factory.changed, self.__start),
                 self.transport, self.__peer,
-                self.factory.threads.run)
+                self.factory.start, self.__features, self.factory.tail,
+                rate_limit=self.factory.rate_limit,
+                total_bucket=self.factory.total_bucket,
+                admission=self.factory.admission,
+                tid_index=self.factory.tid_index,
+                memory_map=self.factory.memory_map,
+                io_policy=self.factory.io_policy,
+                bootstrap=self.__bootstrap,
+                blob_block_size=self.factory.blob_block_size,
+                back_cache=self.factory.back_cache,
+                read_ahead_size=self.factory.read_ahead_size,
+                **self.factory.flow_control)
+
+    def negotiate(self, offers):
+        """Choose among the features offered by a secondary
+        """
+        features = {}
+        for spec in offers.get('compress', ()):
+            try:
+                zc.zrs.compression.parse(spec)
+            except ValueError:
+                continue
+            features['compress'] = spec
+            break
+
+        if 'binary' in offers.get('headers', ()):
+            features['headers'] = 'binary'
+
+        for algorithm in offers.get('checksum', ()):
+            if algorithm in zc.zrs.checksum.algorithms:
+                features['checksum'] = algorithm
+                break
+
+        if 'transaction' in offers.get('checksum-scope', ()):
+            features['checksum-scope'] = 'transaction'
+
+        for size in offers.get('chunk-size', ()):
+            if size.isdigit() and int(size) > 0:
+                features['chunk-size'] = size
+                break
+
+        if 'queue' in offers.get('notices', ()):
+            features['notices'] = 'queue'
+
+        if ('raw' in offers.get('transfer', ()) and
+            'chunk-size' not in features and
+            not ZODB.interfaces.IBlobStorage.providedBy(self.factory.storage)):
+            # Blob records need blob data, so only transactions of
+            # storages without blobs can be sent raw.  Secondaries
+            # hold raw transactions in memory until they're
+            # committed, so they aren't sent raw to secondaries that
+            # asked for bounded chunks.
+            features['transfer'] = 'raw'
+
+        if ZODB.interfaces.IBlobStorage.providedBy(self.factory.storage):
+            for spec in offers.get('blobs', ()):
+                if spec == 'fetch':
+                    features['blobs'] = 'fetch'
+                    break
+                if zc.zrs.bloblinks.accept(
+                    spec, self.factory.storage.temporaryDirectory()):
+                    features['blobs'] = 'link'
+                    break
+
+            if 'blobs' in offers.get('channel', ()):
+                features['channel'] = 'blobs'
+
+        for spec in offers.get('bootstrap', ()):
+            if (spec.split(':')[0] == 'snapshot' and
+                zc.zrs.snapshot.file_storage(self.factory.storage)
+                is not None):
+                # Remember what was asked for.  We decide whether we
+                # can resume a snapshot when we start sending it.
+                features['bootstrap'] = 'snapshot'
+                self.__bootstrap = spec
+                break
+
+        return features
 
 PrimaryFactory.protocol = PrimaryProtocol
 
 
 @zope.interface.implementer(twisted.internet.interfaces.IPushProducer)
 class PrimaryProducer:
+    """Send replication data to a secondary
+
+    A producer runs as a task in a worker pool.  Rather than blocking,
+    it yields when its consumer is paused or it has nothing to send,
+    and is woken when that changes.
+    """
 
     # stopped indicates that we should stop sending output to a client
     stopped = False
@@ -254,24 +524,126 @@ class PrimaryProducer:
     # sending data to the client as long as data are available.
     closed = False
 
-    def __init__(self, iterator_args, transport, peer,
-                 run=lambda f, *args: f(*args)):
+    compress = None
+    binary_headers = False
+    checksum_algorithm = 'md5'
+    per_transaction_checksums = False
+
+    # Send transaction records as they are in the storage file.
+    raw = False
+
+    # Send the names of blob files, rather than their data, to
+    # secondaries that can link them ('link'), or send neither, to
+    # secondaries that fetch blob files over blob channels ('fetch').
+    blobs = None
+    blob_block_size = None
+
+    # Records with more data than this are sent in chunks of this size.
+    chunk_size = None
+
+    # An empty secondary may ask for a snapshot of the storage.
+    bootstrap = None
+
+    # A producer whose transactions are checksummed individually can
+    # follow a shared tail once it has caught up.
+    tail = None
+    joined = False
+
+    task = None
+
+    # While catching up with read-ahead, the queue of messages read
+    # ahead.
+    read_ahead = None
+
+    # Producers that are far behind may have to wait to be admitted
+    # before catching up, holding a ticket while they do.
+    admission = None
+    ticket = None
+    queue_notices = False
+
+    # We count the bytes we've handed to the reactor that haven't been
+    # written yet, and those written while the transport was paused,
+    # and so are buffered in the transport.  When the total reaches
+    # the high watermark, we stop sending until it falls to the low
+    # watermark.  If it exceeds max_in_flight, the secondary isn't
+    # keeping up and we disconnect it.
+    high_watermark = 1 << 22
+    low_watermark = 1 << 20
+    max_in_flight = 1 << 28
+    throttled = False
+
+    def __init__(self, iterator_args, transport, peer, start=None,
+                 features=None, tail=None, high_watermark=None,
+                 low_watermark=None, max_in_flight=None, rate_limit=None,
+                 total_bucket=None, admission=None, tid_index=None,
+                 memory_map=False, io_policy=None, bootstrap=None,
+                 blob_block_size=None, back_cache=None, read_ahead_size=0):
+        if features:
+            if 'compress' in features:
+                self.compress = zc.zrs.compression.compressor(
+                    features['compress'])
+            self.binary_headers = features.get('headers') == 'binary'
+            self.checksum_algorithm = features.get('checksum', 'md5')
+            self.per_transaction_checksums = (
+                features.get('checksum-scope') == 'transaction')
+            if 'chunk-size' in features:
+                self.chunk_size = int(features['chunk-size'])
+                self.batch_size = min(self.batch_size, self.chunk_size)
+            if self.per_transaction_checksums:
+                self.tail = tail
+            self.queue_notices = features.get('notices') == 'queue'
+            self.raw = features.get('transfer') == 'raw'
+            self.blobs = features.get('blobs')
+        self.encoding = (self.binary_headers, self.checksum_algorithm,
+                         self.chunk_size, self.blobs, self.raw)
+        self.blob_block_size = blob_block_size
+        self.followed = []
+        self.follow_lock = threading.Lock()
+        self.queued = 0
         self.iterator_scan_control = ScanControl()
         self.storage = iterator_args[0]
         self.iterator = None
         self.iterator_args = iterator_args + (self.iterator_scan_control,)
-        self.start_tid = iterator_args[2]
+        self.start_tid = self.last_tid = iterator_args[2]
+        if self.start_tid == ZODB.utils.z64:
+            self.bootstrap = bootstrap
         self.transport = transport
         self.peer = peer
         transport.registerProducer(self, True)
         self.callFromThread = transport.reactor.callFromThread
         self.consumer_event = threading.Event()
         self.consumer_event.set()
-        thread = threading.Thread(target=run, args=(self.run, ),
-                                  name='Producer(%s)' % peer)
-        thread.setDaemon(True)
-        thread.start()
-        self.thread = thread
+        if high_watermark is not None:
+            self.high_watermark = high_watermark
+        if low_watermark is not None:
+            self.low_watermark = low_watermark
+        if max_in_flight is not None:
+            self.max_in_flight = max_in_flight
+        self.flow_lock = threading.Lock()
+        self.unwritten = self.buffered = 0
+        self.bucket = zc.zrs.ratelimit.TokenBucket(rate_limit)
+        self.buckets = [self.bucket]
+        if total_bucket is not None:
+            self.buckets.append(total_bucket)
+        self.admission = admission
+        self.tid_index = tid_index
+        self.memory_map = memory_map
+        self.io_policy = io_policy
+        self.back_cache = back_cache
+        self.read_ahead_size = read_ahead_size
+        if start is None:
+            start = zc.zrs.pool.WorkerPool(1, peer).start
+        self.start = start
+        start(self.begin, 'Producer(%s)' % peer)
+
+    def begin(self, task):
+        self.task = task
+        return self.run()
+
+    def wake(self):
+        task = self.task
+        if task is not None:
+            task.wake()
 
     def pauseProducing(self):
         logger.debug(self.peer+" pausing")
@@ -279,8 +651,26 @@ class PrimaryProducer:
 
     def resumeProducing(self):
         logger.debug(self.peer+" resuming")
+        with self.flow_lock:
+            # Twisted resumes us when the transport's buffer is empty.
+            self.buffered = 0
+            self.check_watermark()
         self.consumer_event.set()
+        self.wake()
+
+    def set_rate_limit(self, rate_limit):
+        self.bucket.set_rate(rate_limit)
+        self.wake()
+
+    @property
+    def in_flight(self):
+        return self.unwritten + self.buffered
 
+    def check_watermark(self):
+        # Called with the flow lock held
+        if self.throttled and self.in_flight <= self.low_watermark:
+            self.throttled = False
+            self.wake()
 
     def close(self):
         # We use the closed flag to handle a race condition in
@@ -293,12 +683,15 @@ class PrimaryProducer:
         iterator = self.iterator
         if iterator is not None:
             iterator.catch_up_then_stop()
+        self.wake()
 
     def _stop(self):
         # for tests
         iterator = self.iterator
         if iterator is not None:
             iterator.stop()
+        self.unfollow()
+        self.wake()
 
     def cfr_close(self):
         if not self.stopped:
@@ -315,105 +708,820 @@ class PrimaryProducer:
         else:
             self.iterator_scan_control.not_stopped = False
 
-        self.consumer_event.set() # unblock wait calls
+        self.unfollow()
+        self.consumer_event.set() # unblock waits
+        self.wake()
 
-    def cfr_write(self, data):
-        if not self.stopped:
-            self.transport.writeSequence(data)
+    def cfr_write(self, data, size):
+        with self.flow_lock:
+            self.unwritten -= size
+        if self.stopped:
+            return
 
-    def write(self, data):
-        data = zc.zrs.sizedmessage.marshals(data)
-        self.md5.update(data[1])
-        self.consumer_event.wait()
-        self.callFromThread(self.cfr_write, data)
+        self.transport.writeSequence(data)
 
+        with self.flow_lock:
+            if self.consumer_event.is_set():
+                # The transport didn't pause us, so its buffer is
+                # small.
+                self.buffered = 0
+            else:
+                self.buffered += size
+            in_flight = self.in_flight
+            self.check_watermark()
+
+        if (self.max_in_flight and in_flight > self.max_in_flight
+            and in_flight > size):
+            logger.error(
+                "%s too much data in flight (%s bytes). Disconnecting.",
+                self.peer, in_flight)
+            self.transport.unregisterProducer()
+            self.stopProducing()
+            getattr(self.transport, 'abortConnection',
+                    self.transport.loseConnection)()
 
-    def run(self):
-        try:
-            self.iterator = FileStorageIterator(*self.iterator_args)
-        except:
-            logger.exception(self.peer)
-            self.iterator = None
-            self.callFromThread(self.cfr_close)
-            return
+    # Messages are collected into a batch that is handed to the
+    # reactor in a single writeSequence call when it reaches this
+    # many bytes, or when we run out of transactions to send.
+    batch_size = 1 << 20
 
+    def write(self, data):
+        self.checksum.update(data)
+        self.batch.extend(zc.zrs.sizedmessage.marshals(data))
+        self.batched += len(data) + 4
+
+    def flush(self, catching_up=False):
+        # Hand our batch to the reactor, once the consumer will take
+        # it. Then let other tasks have a turn.  Catch-up data are
+        # subject to rate limits, unless we're closing.
+        if self.batch:
+            batch = self.batch
+            self.batch = []
+            self.batched = 0
+            if self.compress is not None:
+                batch = zc.zrs.sizedmessage.marshals(
+                    self.compress(b''.join(batch)))
+            elif self.memory_map:
+                # Data read from mapped files are memoryviews, but
+                # transports only take bytes.
+                batch = [b''.join(batch)]
+            size = sum(map(len, batch))
+            if catching_up:
+                while not (self.stopped or self.closed):
+                    delay = max(bucket.delay() for bucket in self.buckets)
+                    if not delay:
+                        break
+                    self.task.wake_after(delay)
+                    yield
+                for bucket in self.buckets:
+                    bucket.take(size)
+            while not self.consumer_event.is_set() or (
+                self.throttled and not self.stopped):
+                yield
+            with self.flow_lock:
+                self.unwritten += size
+                if self.in_flight >= self.high_watermark:
+                    self.throttled = True
+            self.callFromThread(self.cfr_write, batch, size)
+            self.wake()
+            yield
+
+    def new_iterator(self, start):
+        if self.memory_map:
+            iterator_class = MappedFileStorageIterator
+        else:
+            iterator_class = FileStorageIterator
+        return iterator_class(
+            *self.iterator_args[:2] + (start, ) + self.iterator_args[3:],
+            chunk_size=self.chunk_size, index=self.tid_index,
+            io_policy=self.io_policy, back_cache=self.back_cache)
+
+    def watch(self, iterator):
+        # Arrange to be woken when the iterator has news.
+        self.iterator = iterator
+        iterator.listen(self.wake)
         if self.closed:
-            self.callFromThread(self.cfr_close)
+            iterator.catch_up_then_stop()
+        if self.stopped:
+            iterator.stop()
+
+    def catch_up(self, encoder):
+        # Send transactions from our iterator until it's exhausted,
+        # or until we've caught up and have joined the shared tail.
+        # Until we first run out of transactions, we're catching up,
+        # and are subject to rate limits.
+        if self.read_ahead_size:
+            yield from self.catch_up_read_ahead(encoder)
             return
 
-        if self.stopped:
-            # make sure our iterator gets stopped, as stopProducing might
-            # have been called while we were creating the iterator.
-            self.iterator.stop()
+        iterator = self.iterator
+        catching_up = True
+        while 1:
+            try:
+                trans = iterator.poll(self.wake)
+            except StopIteration:
+                return
 
-        picklerf = BytesIO()
-        pickler = cPickle.Pickler(picklerf, 1)
-        pickler.fast = 1
-        def dump(data):
-            picklerf.seek(0)
-            picklerf.truncate()
-            pickler.dump(data)
-            return picklerf.getvalue()
+            if trans is None:
+                catching_up = False
+                self.release()
+                if self.batch:
+                    # Flushing yields, so we may miss a wake-up while
+                    # doing so.  Poll again before waiting.
+                    yield from self.flush()
+                    continue
+                if (self.tail is not None
+                    and not (self.stopped or self.closed)
+                    and self.tail.join(self)):
+                    logger.debug(self.peer+" following shared tail")
+                    self.joined = True
+                    return
+                yield # Wait for more
+                continue
 
-        self.md5 = md5(self.start_tid)
+            if self.per_transaction_checksums:
+                self.checksum = zc.zrs.checksum.new(self.checksum_algorithm)
+            for message in transaction_messages(
+                self.storage, trans, trans, encoder, self.chunk_size,
+                self.raw, self.blobs, self.blob_block_size):
+                self.write(message)
+                if self.batched >= self.batch_size:
+                    yield from self.flush(catching_up)
+            self.write(encoder.commit(self.checksum.digest()))
+            if self.batched >= self.batch_size:
+                yield from self.flush(catching_up)
+            self.last_tid = trans.tid
+
+    def catch_up_read_ahead(self, encoder):
+        # Like catch_up, but sending messages read and encoded by a
+        # reader task.
+        queue = self.read_ahead = zc.zrs.readahead.ReadAheadQueue(
+            self.read_ahead_size, self.wake)
+        iterator = self.iterator
+        # Encoders aren't thread safe, so the reader has its own.
+        reader_encoder = new_encoder(self.binary_headers)
+        self.start(
+            lambda task: self.reader(task, iterator, queue, reader_encoder),
+            'Reader(%s)' % self.peer)
+        catching_up = True
+        caught_up = False
+        try:
+            while 1:
+                queue.enter('sender', 'busy')
+                items = queue.take()
+                for item in items:
+                    if not isinstance(item, tuple):
+                        self.write(item)
+                        if self.batched >= self.batch_size:
+                            queue.enter('sender', 'sending')
+                            yield from self.flush(catching_up)
+                            queue.enter('sender', 'busy')
+                        continue
+
+                    kind, value = item
+                    if kind == zc.zrs.readahead.BEGIN:
+                        caught_up = False
+                        if self.per_transaction_checksums:
+                            self.checksum = zc.zrs.checksum.new(
+                                self.checksum_algorithm)
+                    elif kind == zc.zrs.readahead.COMMIT:
+                        self.write(encoder.commit(self.checksum.digest()))
+                        if self.batched >= self.batch_size:
+                            queue.enter('sender', 'sending')
+                            yield from self.flush(catching_up)
+                            queue.enter('sender', 'busy')
+                        self.last_tid = value
+                    elif kind == zc.zrs.readahead.CAUGHT_UP:
+                        caught_up = True
+                        catching_up = False
+                        self.release()
+                    elif kind == zc.zrs.readahead.ENDED:
+                        return
+                    else:
+                        raise value
+
+                if items:
+                    continue # There may be more.
+
+                if caught_up:
+                    if self.batch:
+                        queue.enter('sender', 'sending')
+                        yield from self.flush()
+                        continue
+                    if (self.tail is not None
+                        and not (self.stopped or self.closed)
+                        and self.tail.join(self)):
+                        # Anything the reader read since is sent by
+                        # the tail.
+                        logger.debug(self.peer+" following shared tail")
+                        self.joined = True
+                        return
+
+                queue.enter('sender', 'starved')
+                yield # Wait for more
+        finally:
+            queue.stop()
+            queue.enter('sender', None)
+            self.read_ahead = None
+
+    def reader(self, task, iterator, queue, encoder):
+        # The reader task for catch_up_read_ahead.
+        queue.reader = task
+        iterator.listen(task.wake)
+        queue.enter('reader', 'reading')
+        try:
+            while not queue.stopped:
+                try:
+                    trans = iterator.poll(task.wake)
+                except StopIteration:
+                    queue.put((zc.zrs.readahead.ENDED, None))
+                    return
+
+                if trans is None:
+                    queue.put((zc.zrs.readahead.CAUGHT_UP, None))
+                    queue.enter('reader', 'idle')
+                    yield # Wait for a commit
+                    queue.enter('reader', 'reading')
+                    continue
+
+                queue.put((zc.zrs.readahead.BEGIN, trans.tid))
+                messages = transaction_messages(
+                    self.storage, trans, trans, encoder, self.chunk_size,
+                    self.raw, self.blobs, self.blob_block_size)
+                try:
+                    for message in messages:
+                        if not queue.put(message, len(message)):
+                            queue.enter('reader', 'blocked')
+                            while queue.full():
+                                yield # Wait for room
+                            if queue.stopped:
+                                return
+                            queue.enter('reader', 'reading')
+                finally:
+                    messages.close()
+                queue.put((zc.zrs.readahead.COMMIT, trans.tid))
+        except Exception as exc:
+            queue.put((zc.zrs.readahead.ERROR, exc))
+        finally:
+            iterator.unlisten(task.wake)
+            queue.enter('reader', None)
+
+    def read_ahead_stats(self):
+        queue = self.read_ahead
+        if queue is not None:
+            return queue.stats()
+
+    def deliver(self, item, size=0):
+        # Called by the shared tail to queue an encoded transaction,
+        # or a marker.  Returns False if too much is queued already.
+        with self.follow_lock:
+            if size and self.queued + size > self.tail.max_queued:
+                return False
+            self.followed.append(item)
+            self.queued += size
+        self.wake()
+        return True
+
+    def unfollow(self):
+        if self.tail is not None:
+            self.tail.leave(self)
+            self.deliver(ENDED)
+
+    def follow(self):
+        """Send encoded transactions from the shared tail.
+
+        Return True if we were detached and have to catch up on our own.
+        """
+        while 1:
+            with self.follow_lock:
+                items = self.followed
+                self.followed = []
+                self.queued = 0
+            if not items:
+                if self.batch:
+                    yield from self.flush()
+                else:
+                    yield # Wait for more
+                continue
 
-        blob_block_size = 1 << 16
+            for item in items:
+                if item is DETACHED:
+                    logger.debug(self.peer+" detached from shared tail")
+                    return True
+                if item is ENDED:
+                    return False
+                tid, frames, size = item
+                if tid <= self.last_tid:
+                    continue # We sent this one before joining.
+                self.batch.extend(frames)
+                self.batched += size
+                if self.batched >= self.batch_size:
+                    yield from self.flush()
+                self.last_tid = tid
+
+    def admit(self, encoder):
+        # Wait until we're admitted to catch up, if we're far behind
+        # and too many others are catching up.
+        if self.admission is None:
+            return
+        last = self.storage.lastTransaction()
+        lag = (ZODB.TimeStamp.TimeStamp(last).timeTime() -
+               ZODB.TimeStamp.TimeStamp(self.start_tid).timeTime())
+        ticket = self.admission.request(lag, self.wake)
+        if ticket is None:
+            return
+        self.ticket = ticket
 
+        reported = None
+        while 1:
+            if self.stopped or self.closed:
+                return
+            position = self.admission.position(ticket)
+            if position == 0 and reported is None:
+                return # We were admitted right away.
+            if position != reported:
+                reported = position
+                waited = ticket.waited()
+                if position:
+                    logger.info("%s waiting to catch up, at position %s,"
+                                " after %.0f seconds",
+                                self.peer, position, waited)
+                else:
+                    logger.info("%s catching up after waiting %.0f seconds",
+                                self.peer, waited)
+                if self.queue_notices:
+                    self.write(encoder.queued(position, waited))
+                    yield from self.flush()
+                    continue # We may have moved while flushing.
+            if not position:
+                return
+            yield # Wait for our position to change
+
+    def send_snapshot(self, encoder):
+        # Send a snapshot of the storage, after which we send
+        # transactions as usual.  Snapshots are catch-up data.
+        snapshot = zc.zrs.snapshot.Snapshot(
+            zc.zrs.snapshot.file_storage(self.storage), self.bootstrap,
+            self.io_policy)
+        blocks = snapshot.blocks(encoder, self.chunk_size or raw_block_size)
         try:
-            for trans in self.iterator:
-                self.write(
-                    dump(('T', (trans.tid, trans.status, trans.user,
-                                        trans.description, trans._extension))))
-                for record in trans:
-                    if record.data and is_blob_record(record.data):
-                        try:
-                            fname = self.storage.loadBlob(
-                                record.oid, record.tid)
-                            f = open(fname, 'rb')
-                        except (IOError, ZODB.POSException.POSKeyError):
-                            pass
-                        else:
-                            f.seek(0, 2)
-                            blob_size = f.tell()
-                            blocks, r = divmod(blob_size, blob_block_size)
-                            if r:
-                                blocks += 1
-
-                            self.write(
-                                dump(('B',
-                                      (record.oid, record.tid, record.version,
-                                       record.data_txn, long(blocks)))))
-                            self.write(record.data or '')
-                            f.seek(0)
-                            while blocks > 0:
-                                data = f.read(blob_block_size)
-                                if not data:
-                                    raise AssertionError("Too much blob data")
-                                blocks -= 1
-                                self.write(data)
-
-                            f.close()
-                            continue
-
-                    self.write(
-                        dump(('S', (record.oid, record.tid, record.version,
-                                    record.data_txn)))
-                        )
-                    self.write(record.data or b'')
-
-                self.write(dump(('C', (self.md5.digest(), ))))
+            if snapshot.tid is None:
+                return # The storage is empty.
+            logger.info("%s sending snapshot at %s from %s",
+                        self.peer, ZODB.utils.tid_repr(snapshot.tid),
+                        snapshot.pos)
+            for header, chunks in blocks:
+                if self.per_transaction_checksums:
+                    self.checksum = zc.zrs.checksum.new(
+                        self.checksum_algorithm)
+                self.write(header)
+                for data in chunks:
+                    self.write(data)
+                    if self.batched >= self.batch_size:
+                        yield from self.flush(True)
+                self.write(encoder.commit(self.checksum.digest()))
+                if self.batched >= self.batch_size:
+                    yield from self.flush(True)
+                if self.stopped or self.closed:
+                    return
+            yield from self.flush(True)
+            self.start_tid = self.last_tid = snapshot.tid
+        finally:
+            blocks.close()
+            snapshot.close()
+
+    def release(self):
+        # Let someone else catch up.
+        ticket = self.ticket
+        if ticket is not None:
+            self.ticket = None
+            self.admission.release(ticket)
 
+    def run(self):
+        encoder = new_encoder(self.binary_headers)
+
+        self.checksum = zc.zrs.checksum.new(
+            self.checksum_algorithm, self.start_tid)
+        self.batch = []
+        self.batched = 0
+
+        if (self.bootstrap is None
+            and self.tail is not None and self.tail.join(self)):
+            # The secondary is up to date, or recent transactions are
+            # buffered, so we needn't read the file.
+            self.joined = True
+        else:
+            try:
+                yield from self.admit(encoder)
+                if self.bootstrap is not None and not (
+                    self.stopped or self.closed):
+                    yield from self.send_snapshot(encoder)
+                if self.stopped or self.closed:
+                    self.release()
+                    self.callFromThread(self.cfr_close)
+                    return
+                iterator = self.new_iterator(self.start_tid)
+            except:
+                logger.exception(self.peer)
+                self.release()
+                self.iterator = None
+                self.callFromThread(self.cfr_close)
+                return
+
+        if self.closed:
+            if self.joined:
+                self.tail.leave(self)
+            self.release()
+            self.callFromThread(self.cfr_close)
+            return
+
+        if not self.joined:
+            # stopProducing might have been called while we were
+            # creating the iterator.
+            self.watch(iterator)
+
+        try:
+            while 1:
+                if not self.joined:
+                    yield from self.catch_up(encoder)
+                    self.iterator.unlisten(self.wake)
+                    if not self.joined:
+                        break
+                self.joined = False
+                detached = yield from self.follow()
+                self.tail.leave(self)
+                if not detached:
+                    break
+
+                # We were detached from the shared tail.  Catch up on
+                # our own.
+                self.watch(self.new_iterator(self.last_tid))
+
+            yield from self.flush()
         except Exception as exc:
             logger.exception(self.peer)
 
+        self.release()
         self.iterator = None
         self.callFromThread(self.cfr_close)
 
 
+blob_block_size = 1 << 16
+
+# Raw transactions are sent in blocks of at most this size, unless a
+# chunk size was negotiated.
+raw_block_size = 1 << 20
+
+def new_encoder(binary_headers):
+    if binary_headers:
+        return zc.zrs.messages.BinaryEncoder()
+    else:
+        return zc.zrs.messages.PickleEncoder()
+
+def transaction_messages(storage, trans, records, encoder, chunk_size,
+                         raw=False, blobs=None, block_size=None):
+    """Generate the messages for a transaction, except the commit message
+    """
+    if block_size is None:
+        block_size = blob_block_size
+    if raw:
+        yield encoder.raw(trans.tid, trans.raw_size(),
+                          trans.backpointer_tids())
+        for data in trans.raw_chunks(chunk_size or raw_block_size):
+            yield data
+        return
+
+    yield encoder.transaction(trans)
+    for record in records:
+        if isinstance(record, LargeRecord):
+            yield encoder.large(record, record.size)
+            for data in record.chunks(chunk_size):
+                yield data
+            continue
+
+        data = record.data
+        if chunk_size is not None and data and len(data) > chunk_size:
+            # Read by an iterator with a larger chunk size.
+            yield encoder.large(record, len(data))
+            for pos in range(0, len(data), chunk_size):
+                yield data[pos:pos+chunk_size]
+            continue
+
+        if record.data and is_blob_record(record.data):
+            if blobs == 'link':
+                try:
+                    fname = storage.loadBlob(record.oid, record.tid)
+                except ZODB.POSException.POSKeyError:
+                    pass
+                else:
+                    yield encoder.blob_link(record)
+                    yield record.data
+                    yield fname.encode('utf-8')
+                    continue
+
+            if blobs == 'fetch':
+                try:
+                    blob_size = os.path.getsize(
+                        storage.loadBlob(record.oid, record.tid))
+                except (OSError, ZODB.POSException.POSKeyError):
+                    pass
+                else:
+                    yield encoder.blob_fetch(record, blob_size)
+                    yield record.data
+                    continue
+
+            try:
+                fname = storage.loadBlob(record.oid, record.tid)
+                f = open(fname, 'rb')
+            except (IOError, ZODB.POSException.POSKeyError):
+                pass
+            else:
+                f.seek(0, 2)
+                blob_size = f.tell()
+                blocks, r = divmod(blob_size, block_size)
+                if r:
+                    blocks += 1
+
+                yield encoder.blob(record, blocks)
+                yield record.data or b''
+                f.seek(0)
+                while blocks > 0:
+                    data = f.read(block_size)
+                    if not data:
+                        raise AssertionError("Too much blob data")
+                    blocks -= 1
+                    yield data
+
+                f.close()
+                continue
+
+        yield encoder.store(record)
+        yield record.data or b''
+
+# Markers delivered to producers following a shared tail:
+DETACHED = 'detached'
+ENDED = 'ended'
+
+class SharedTail:
+    """Read newly committed transactions once for many secondaries
+
+    Producers that have caught up join the tail, which reads each new
+    transaction, encodes it once for each encoding its followers use
+    and hands the encoded messages to the followers to send.  This
+    requires per-transaction checksums, as stream checksums depend on
+    where each connection started.
+
+    A follower that falls too far behind is detached.  It catches up
+    on its own and then joins again.
+
+    The most recent transactions can be kept, encoded, in a buffer of
+    up to buffer_size bytes.  Producers whose secondaries are missing
+    only buffered transactions join right away and are sent the
+    transactions they're missing from the buffer.
+    """
+
+    # The most bytes of encoded transactions a follower may have
+    # waiting to be sent.
+    max_queued = 1 << 24
+
+    def __init__(self, storage, changed, run, buffer_size=0,
+                 memory_map=False, io_policy=None, blob_block_size=None,
+                 back_cache=None):
+        self.storage = storage
+        self.blob_block_size = blob_block_size
+        self.memory_map = memory_map
+        self.io_policy = io_policy
+        self.back_cache = back_cache
+        self.changed = changed
+        self.run_thread = run
+        self.buffer_size = buffer_size
+        self.lock = threading.Lock()
+        self.followers = []
+        self.encodings = set()
+        self.iterator = None
+        self.last_tid = None
+        self.closed = False
+
+        # Recent transactions, as (tid, {encoding: (frames, size)}, size).
+        # We have all of the transactions after buffer_start.
+        self.buffer = collections.deque()
+        self.buffered = 0
+        self.buffer_start = None
+        self.hits = self.misses = 0
+
+    def join(self, producer):
+        with self.lock:
+            if self.closed:
+                return False
+            if self.iterator is None:
+                self.last_tid = self.buffer_start = (
+                    self.storage.lastTransaction())
+                # Records too large to queue aren't read.
+                if self.memory_map:
+                    iterator_class = MappedFileStorageIterator
+                else:
+                    iterator_class = FileStorageIterator
+                self.iterator = iterator_class(
+                    self.storage, self.changed, self.last_tid,
+                    chunk_size=self.max_queued, io_policy=self.io_policy,
+                    back_cache=self.back_cache)
+                thread = threading.Thread(
+                    target=self.run_thread, args=(self.run, ),
+                    name='SharedTail(%s)' % self.storage.getName())
+                thread.daemon = True
+                thread.start()
+            encoding = producer.encoding
+            self.encodings.add(encoding)
+            last_tid = producer.last_tid
+            if last_tid > self.storage.lastTransaction():
+                # The secondary is ahead of us. Let an iterator complain.
+                return False
+            if last_tid < self.buffer_start:
+                self.misses += 1
+                return False # There's more for it to catch up on.
+
+            backlog = [(tid, encoded.get(encoding))
+                       for tid, encoded, size in self.buffer
+                       if tid > last_tid]
+            if backlog:
+                if (None in [item for tid, item in backlog] or
+                    sum(item[1] for tid, item in backlog) > self.max_queued
+                    ):
+                    self.misses += 1
+                    return False
+                for tid, (frames, size) in backlog:
+                    producer.deliver((tid, frames, size), size)
+                self.hits += 1
+
+            self.followers.append(producer)
+            return True
+
+    def stats(self):
+        with self.lock:
+            return dict(size=self.buffered, transactions=len(self.buffer),
+                        hits=self.hits, misses=self.misses)
+
+    def leave(self, producer):
+        with self.lock:
+            if producer in self.followers:
+                self.followers.remove(producer)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            iterator = self.iterator
+        if iterator is not None:
+            iterator.catch_up_then_stop()
+
+    def run(self):
+        ended = ENDED
+        try:
+            for trans in self.iterator:
+                # Don't bother reading records if nobody needs them.
+                records = (list(trans)
+                           if records_needed(self.encodings_needed())
+                           else None)
+                with self.lock:
+                    encodings = self.encodings_needed()
+                    if records is None and records_needed(encodings):
+                        records = list(trans)
+                    encoded = dict(
+                        (encoding, self.encode(encoding, trans, records))
+                        for encoding in encodings)
+                    self.save(trans.tid, encoded)
+                    for producer in list(self.followers):
+                        item = encoded[producer.encoding]
+                        if item is None or not producer.deliver(
+                            (trans.tid, ) + item, item[1]):
+                            self.followers.remove(producer)
+                            producer.deliver(DETACHED)
+                    self.last_tid = trans.tid
+        except Exception:
+            logger.exception("Shared tail for %s", self.storage.getName())
+            ended = DETACHED
+
+        with self.lock:
+            self.closed = True
+            followers = self.followers
+            self.followers = []
+        for producer in followers:
+            producer.deliver(ended)
+
+    def encodings_needed(self):
+        if self.buffer_size:
+            return self.encodings
+        return set(producer.encoding for producer in self.followers)
+
+    def save(self, tid, encoded):
+        # Save an encoded transaction in the buffer, discarding old
+        # ones to make room.
+        buffer = self.buffer
+        size = 0
+        for item in encoded.values():
+            if item is None:
+                size = self.buffer_size + 1 # Too big to buffer.
+                break
+            size += item[1]
+        if not encoded or size > self.buffer_size:
+            buffer.clear()
+            self.buffered = 0
+            self.buffer_start = tid
+            return
+
+        buffer.append((tid, encoded, size))
+        self.buffered += size
+        while self.buffered > self.buffer_size:
+            tid, _, size = buffer.popleft()
+            self.buffered -= size
+            self.buffer_start = tid
+
+    def encode(self, encoding, trans, records):
+        # Return encoded messages and their size, or None if they
+        # take more space than a follower may have queued.
+        (binary_headers, checksum_algorithm, chunk_size, blobs, raw
+         ) = encoding
+        if raw:
+            if trans.raw_size() > self.max_queued:
+                return None
+        else:
+            for record in records:
+                if isinstance(record, LargeRecord):
+                    return None
+        encoder = new_encoder(binary_headers)
+        checksum = zc.zrs.checksum.new(checksum_algorithm)
+        frames = []
+        size = 0
+        for message in transaction_messages(
+            self.storage, trans, records, encoder, chunk_size, raw,
+            blobs, self.blob_block_size):
+            if type(message) is memoryview:
+                # Don't keep mapped files around in the buffer.
+                message = message.tobytes()
+            checksum.update(message)
+            frames.extend(zc.zrs.sizedmessage.marshals(message))
+            size += len(message) + 4
+            if size > self.max_queued:
+                return None
+        message = encoder.commit(checksum.digest())
+        frames.extend(zc.zrs.sizedmessage.marshals(message))
+        return frames, size + len(message) + 4
+
+def records_needed(encodings):
+    # Records are read for encodings that don't send raw transactions.
+    for encoding in encodings:
+        if not encoding[-1]:
+            return True
+    return False
+
 class TidTooHigh(Exception):
     """The last tid for an iterator is higher than any tids in a file.
     """
 
+class Changes(threading.Condition):
+    """A condition notified when transactions are committed
+
+    The sequence is incremented for each commit, by the committing
+    thread, and can be checked without locking.  Tasks, and threads
+    blocked reading iterators, register callbacks with wait_for, which
+    are called once, after the next commit, so only those that have
+    run out of transactions are woken.
+    """
+
+    sequence = 0
+
+    def __init__(self):
+        threading.Condition.__init__(self)
+        self.waiting_lock = threading.Lock()
+        self.waiting = set()
+
+    def committed(self):
+        self.sequence += 1
+
+    def wait_for(self, sequence, callback):
+        """Call the callback after the commit following sequence
+
+        False is returned, and the callback isn't registered, if
+        there's been a commit since.
+        """
+        with self.waiting_lock:
+            if self.sequence != sequence:
+                return False
+            self.waiting.add(callback)
+            return True
+
+    def cancel(self, callback):
+        with self.waiting_lock:
+            self.waiting.discard(callback)
+
+    def notify_waiters(self):
+        with self.waiting_lock:
+            waiting = self.waiting
+            self.waiting = set()
+        for callback in waiting:
+            callback()
+        with self:
+            self.notify_all()
+
 class ScanControl:
 
     not_stopped = True
@@ -423,8 +1531,13 @@ class FileStorageIterator(ZODB.FileStorage.format.FileStorageFormatter):
     _file_size = 1 << 64 # To make base class check happy.
 
     def __init__(self, fs, condition=None, start=ZODB.utils.z64,
-                 scan_control=None):
+                 scan_control=None, chunk_size=None, index=None,
+                 io_policy=None, back_cache=None):
         self._ltid = start
+        self._chunk_size = chunk_size
+        self._index = index
+        self._io_policy = io_policy
+        self._back_cache = back_cache
         self._fs = fs
         self._stop = False
         if scan_control is None:
@@ -432,14 +1545,20 @@ class FileStorageIterator(ZODB.FileStorage.format.FileStorageFormatter):
         self._scan_control = scan_control
         self._open()
         if condition is None:
-            condition = threading.Condition()
+            condition = Changes()
         self._condition = condition
+        self._listeners = set()
         self._catch_up_then_stop = False
+        # Set to wake a thread blocked reading us.
+        self._woken = threading.Event()
 
     def _open(self):
         self._old_file = self._fs._file
         try:
-            file = open(self._fs._file_name, 'rb', 0)
+            if self._io_policy is not None:
+                file = self._io_policy.open(self._fs._file_name)
+            else:
+                file = open(self._fs._file_name, 'rb', 0)
         except IOError as v:
             if os.path.exists(self._fs._file_name):
                 raise
@@ -458,8 +1577,12 @@ class FileStorageIterator(ZODB.FileStorage.format.FileStorageFormatter):
         ltid = self._ltid
         if ltid > ZODB.utils.z64:
             # We aren't starting at the beginning.  We need to find the
-            # first transaction after _ltid. We can either search from the
-            # beginning, or from the end.
+            # first transaction after _ltid. If we have an index, we
+            # start from the nearest indexed transaction. Otherwise,
+            # we can either search from the beginning, or from the end.
+            if self._index is not None and self._scan_from_index(ltid):
+                return
+
             file.seek(4)
             tid = file.read(8)
             if len(tid) < 8:
@@ -494,6 +1617,25 @@ class FileStorageIterator(ZODB.FileStorage.format.FileStorageFormatter):
                 else:
                     self._scan_backward(pos, ltid)
 
+    def _scan_from_index(self, ltid):
+        found = self._index.find(ltid)
+        if found is None:
+            return False
+
+        tid, pos = found
+        try:
+            h = self._read_txn_header(pos)
+        except ZODB.FileStorage.format.CorruptedDataError:
+            h = None
+        if h is None or h.tid != tid:
+            logger.warning("%s transaction index is wrong at %s",
+                           self._file.name, pos)
+            self._index.invalidate()
+            return False
+
+        self._scan_forward(pos, ltid)
+        return True
+
     def _scan_forward(self, pos, ltid):
         file = self._file
         while self._scan_control.not_stopped:
@@ -540,34 +1682,106 @@ class FileStorageIterator(ZODB.FileStorage.format.FileStorageFormatter):
         return self
 
     def stop(self):
-        self._condition.acquire()
         self._stop = True
-        self._condition.notifyAll()
-        self._condition.release()
+        self._wake()
 
     def catch_up_then_stop(self):
-        self._condition.acquire()
         self._catch_up_then_stop = True
-        self._condition.notifyAll()
-        self._condition.release()
+        self._wake()
+
+    def _wake(self):
+        # Wake whoever's reading us, but nobody else.
+        for callback in list(self._listeners):
+            callback()
+        if isinstance(self._condition, Changes):
+            self._woken.set()
+        else:
+            # Readers of other conditions can only be woken together.
+            self._condition.acquire()
+            self._condition.notifyAll()
+            self._condition.release()
 
     def __next__(self):
-        self._condition.acquire()
-        try:
-            while 1:
-                if self._stop:
-                    raise StopIteration
-                r = self._next()
-                if r is not None:
-                    return r
-                if self._catch_up_then_stop:
-                    raise StopIteration
-                self._condition.wait()
-        finally:
-            self._condition.release()
+        condition = self._condition
+        if not isinstance(condition, Changes):
+            # We can't tell if there were commits while we were
+            # reading, so we hold the condition while reading.
+            condition.acquire()
+            try:
+                while 1:
+                    if self._stop:
+                        raise StopIteration
+                    r = self._next()
+                    if r is not None:
+                        return r
+                    self._caught_up()
+                    if self._catch_up_then_stop:
+                        raise StopIteration
+                    condition.wait()
+            finally:
+                condition.release()
+
+        # Like pollers, we register to be woken after the next commit,
+        # so that we're woken by commits and by being stopped, and
+        # other readers aren't woken when we're stopped.
+        woken = self._woken
+        while 1:
+            if self._stop:
+                raise StopIteration
+            sequence = condition.sequence
+            r = self._next()
+            if r is not None:
+                return r
+            self._caught_up()
+            if self._catch_up_then_stop:
+                raise StopIteration
+            woken.clear()
+            if condition.wait_for(sequence, woken.set):
+                if not (self._stop or self._catch_up_then_stop):
+                    woken.wait()
+                condition.cancel(woken.set)
 
     next = __next__
 
+    def poll(self, wait=None):
+        """Return the next transaction, or None if none is available now
+
+        If a callback is passed as wait and None is returned, the
+        callback is called after the next commit.
+
+        StopIteration is raised if we've been stopped, or if we've
+        caught up after catch_up_then_stop was called.
+        """
+        while 1:
+            if self._stop:
+                raise StopIteration
+            sequence = getattr(self._condition, 'sequence', None)
+            r = self._next()
+            if r is not None:
+                return r
+            self._caught_up()
+            if self._catch_up_then_stop:
+                raise StopIteration
+            if (wait is None or sequence is None
+                or self._condition.wait_for(sequence, wait)):
+                return None
+            # There was a commit while we were reading. Try again.
+
+    def _caught_up(self):
+        # Reads from now on are of recent data.
+        if self._io_policy is not None:
+            self._file.caught_up()
+
+    def listen(self, callback):
+        """Call the callback when we're stopped
+        """
+        self._listeners.add(callback)
+
+    def unlisten(self, callback):
+        self._listeners.discard(callback)
+        if isinstance(self._condition, Changes):
+            self._condition.cancel(callback)
+
     def _next(self):
 
         if self._old_file is not self._fs._file:
@@ -633,35 +1847,166 @@ class FileStorageIterator(ZODB.FileStorage.format.FileStorageFormatter):
                 continue
 
             pos += h.headerlen()
-            if h.elen:
-                e = cPickle.loads(h.ext)
-            else:
-                e = {}
 
             result = RecordIterator(
                 h.tid, h.status, h.user, h.descr,
-                e, pos, tend, self._file, tpos)
+                h.ext, pos, tend, self._file, tpos, self._chunk_size,
+                self._back_cache, self._old_file)
 
             return result
 
     def notify(self):
-        self._condition.acquire()
-        self._condition.notifyAll()
-        self._condition.release()
+        """Note that a transaction was committed
+        """
+        if isinstance(self._condition, Changes):
+            self._condition.committed()
+            self._condition.notify_waiters()
+        else:
+            self._condition.acquire()
+            self._condition.notifyAll()
+            self._condition.release()
+
+TRANS_HDR = struct.Struct(ZODB.FileStorage.format.TRANS_HDR)
+TRANS_HDR_LEN = ZODB.FileStorage.format.TRANS_HDR_LEN
+DATA_HDR = struct.Struct(ZODB.FileStorage.format.DATA_HDR)
+DATA_HDR_LEN = ZODB.FileStorage.format.DATA_HDR_LEN
+U64 = struct.Struct(">Q")
+
+class MappedFileStorageIterator(FileStorageIterator):
+    """Iterate over the transactions in a memory-mapped FileStorage file
+
+    Headers are decoded in place, and record data are memoryviews of
+    the mapping, so reading doesn't require system calls.
+
+    Only committed data, before the storage's current position, are
+    mapped.  The transaction being committed may be aborted and the
+    file truncated, and touching a mapping beyond the end of a file is
+    fatal.  As more transactions are committed, the file is remapped.
+    """
+
+    def _open(self):
+        self._map = self._view = None
+        FileStorageIterator._open(self)
+
+    def _mapping(self, end):
+        # Return the mapping, if committed data extend to end
+        m = self._map
+        if m is None or len(m) < end:
+            fileno = self._file.fileno()
+            # If the storage was just packed, its position is for the
+            # new file, but we'll reopen before reading that.
+            size = min(self._fs._pos, os.fstat(fileno).st_size)
+            if size < end:
+                return None
+            self._map = m = mmap.mmap(fileno, size, access=mmap.ACCESS_READ)
+            self._view = memoryview(m)
+        return m
+
+    def _read_txn_header(self, pos, tid=None):
+        m = self._mapping(pos + TRANS_HDR_LEN)
+        if m is None:
+            # Treat the end of committed data as the end of the file.
+            raise ZODB.FileStorage.format.CorruptedDataError(tid, b'', pos)
+        h = ZODB.FileStorage.format.TxnHeader(*TRANS_HDR.unpack_from(m, pos))
+        h.status = h.status.decode('ascii')
+        if tid is not None and tid != h.tid:
+            raise ZODB.FileStorage.format.CorruptedDataError(tid, b'', pos)
+        pos += TRANS_HDR_LEN
+        h.user = m[pos:pos+h.ulen]
+        pos += h.ulen
+        h.descr = m[pos:pos+h.dlen]
+        pos += h.dlen
+        h.ext = m[pos:pos+h.elen]
+        return h
+
+    def _next(self):
+
+        if self._old_file is not self._fs._file:
+            # Our file-storage must have been packed.  We need to
+            # reopen the file:
+            self._open()
+
+        pos = self._pos
+
+        while 1:
+            m = self._mapping(pos + TRANS_HDR_LEN)
+            if m is None:
+                return None
+
+            tid, tlen, status, ulen, dlen, elen = TRANS_HDR.unpack_from(m, pos)
+
+            if tid <= self._ltid:
+                logger.warning("%s time-stamp reduction at %s",
+                               self._file.name, pos)
+
+            if status == b'c':
+                return None
+
+            tend = pos + tlen
+            m = self._mapping(tend + 8)
+            if m is None:
+                logger.critical("%s truncated, possibly due to"
+                                " damaged records at %s", self._file.name, pos)
+                raise ZODB.FileStorage.format.CorruptedDataError(None, '', pos)
+
+            if status not in b" up":
+                logger.warning('%s has invalid status,'
+                               ' %s, at %s', self._file.name, status, pos)
+
+            headerlen = TRANS_HDR_LEN + ulen + dlen + elen
+            if tlen < headerlen:
+                logger.critical("%s has invalid transaction header at %s",
+                                self._file.name, pos)
+                raise ZODB.FileStorage.format.CorruptedDataError(None, '', pos)
+
+            # Check the (intentionally redundant) transaction length
+            if U64.unpack_from(m, tend)[0] != tlen:
+                logger.warning("%s redundant transaction length check"
+                               " failed at %s", self._file.name, tend)
+                break
+
+            tpos = pos
+            pos = self._pos = tend + 8
+            self._ltid = tid
+
+            if status == b'u':
+                # Undone trans.  It's unlikely to see these anymore
+                continue
+
+            upos = tpos + TRANS_HDR_LEN
+            dpos = upos + ulen
+            epos = dpos + dlen
+            return MappedRecordIterator(
+                tid, status.decode('ascii'), m[upos:dpos], m[dpos:epos],
+                m[epos:epos+elen], tpos + headerlen, tend, self._view, tpos,
+                self._chunk_size)
 
 class RecordIterator(ZODB.FileStorage.format.FileStorageFormatter):
     """Iterate over the transactions in a FileStorage file."""
 
-    def __init__(self, tid, status, user, desc, ext, pos, tend, file, tpos):
+    def __init__(self, tid, status, user, desc, ext, pos, tend, file, tpos,
+                 chunk_size=None, back_cache=None, storage_file=None):
         self.tid = tid
         self.status = status
         self.user = user
         self.description = desc
-        self._extension = ext
+        self.extension_bytes = ext
         self._pos = pos
         self._tend = tend
         self._file = file
         self._tpos = tpos
+        self._data_pos = pos
+        self._chunk_size = chunk_size
+        self._back_cache = back_cache
+        self._storage_file = storage_file
+
+    @property
+    def _extension(self):
+        # Only unpickled when someone needs it, which isn't the case
+        # when we send binary headers.
+        if self.extension_bytes:
+            return cPickle.loads(self.extension_bytes)
+        return {}
 
     def __iter__(self):
         return self
@@ -682,6 +2027,9 @@ class RecordIterator(ZODB.FileStorage.format.FileStorageFormatter):
             self._pos = pos + dlen
             prev_txn = None
             if h.plen:
+                if self._large(h.plen):
+                    return LargeRecord(h.oid, h.tid, '', prev_txn, pos,
+                                       self._file, self._file.tell(), h.plen)
                 data = self._file.read(h.plen)
             else:
                 if h.back == 0:
@@ -692,10 +2040,13 @@ class RecordIterator(ZODB.FileStorage.format.FileStorageFormatter):
                     # instead of a pickle to indicate this.
                     data = None
                 else:
-                    data, tid = self._loadBackTxn(h.oid, h.back, False)
                     # Caution:  :ooks like this only goes one link back.
                     # Should it go to the original data like BDBFullStorage?
-                    prev_txn = self.getTxnFromData(h.oid, h.back)
+                    prev_txn, data_pos, size, data = self._back(
+                        h.oid, h.back)
+                    if self._large(size):
+                        return LargeRecord(h.oid, h.tid, '', prev_txn, pos,
+                                           self._file, data_pos, size)
 
             return Record(h.oid, h.tid, '', data, prev_txn, pos)
 
@@ -703,8 +2054,137 @@ class RecordIterator(ZODB.FileStorage.format.FileStorageFormatter):
 
     next = __next__
 
+    def _large(self, size):
+        return self._chunk_size is not None and size > self._chunk_size
+
+    def raw_size(self):
+        """Return the size of the transaction record, including lengths
+        """
+        return self._tend + 8 - self._tpos
+
+    def raw_chunks(self, chunk_size):
+        """Read the transaction record in chunks
+        """
+        pos = self._tpos
+        end = self._tend + 8
+        while pos < end:
+            data = self._read(pos, min(chunk_size, end - pos))
+            if not data:
+                raise ZODB.FileStorage.format.CorruptedDataError(
+                    self.tid, '', pos)
+            pos += len(data)
+            yield data
+
+    def backpointer_tids(self):
+        """Return the ids of the transactions backpointers point into
+        """
+        return zc.zrs.rawtxn.backpointer_tids(
+            self._data_pos, self._tend, self._read)
+
+    def _read(self, pos, size):
+        self._file.seek(pos)
+        return self._file.read(size)
+
+    def _resolve_back(self, back):
+        # Follow a chain of backpointers to the record with the data,
+        # leaving the file positioned at the data, without reading it.
+        while 1:
+            h = self._read_data_header(back)
+            if h.plen or not h.back:
+                return h
+            back = h.back
+
+    def _back(self, oid, back):
+        # Return the id of the transaction a backpointer points into,
+        # and the position, size and data of the data it resolves to.
+        # Large data aren't read.
+        cache = self._back_cache
+        if cache is not None:
+            entry = cache.get(self._storage_file, back)
+            if entry is not None:
+                back_oid, tid, data_pos, size, data = entry
+                if back_oid != oid:
+                    raise ZODB.FileStorage.format.CorruptedDataError(
+                        oid, '', back)
+                if data is None and size and not self._large(size):
+                    data = self._read(data_pos, size)
+                return tid, data_pos, size, data
+
+        tid = self.getTxnFromData(oid, back)
+        size = self._resolve_back(back).plen
+        data_pos = self._file.tell()
+        data = None
+        if size and not self._large(size):
+            data = self._file.read(size)
+        if cache is not None:
+            cache.set(self._storage_file, back, oid, tid, data_pos, size, data)
+        return tid, data_pos, size, data
+
+class MappedRecordIterator(RecordIterator):
+    """Iterate over the records of a transaction in a mapped file
+
+    The file is given as a memoryview of the mapping.
+    """
+
+    def __next__(self):
+        pos = self._pos
+        if pos >= self._tend:
+            raise StopIteration
+
+        view = self._file
+        oid, tid, _, tloc, vlen, plen = DATA_HDR.unpack_from(view, pos)
+        dlen = DATA_HDR_LEN + (plen or 8)
+        if pos + dlen > self._tend or tloc != self._tpos or vlen:
+            logger.critical("Data record exceeds transaction"
+                            " record at %s", pos)
+            raise ZODB.FileStorage.format.CorruptedDataError(oid, '', pos)
+
+        self._pos = pos + dlen
+        prev_txn = None
+        if plen:
+            data_pos = pos + DATA_HDR_LEN
+        else:
+            back = U64.unpack_from(view, pos + DATA_HDR_LEN)[0]
+            if back == 0:
+                # The transaction undid the object's creation.
+                return Record(oid, tid, '', None, None, pos)
+            if view[back:back+8] != oid:
+                raise ZODB.FileStorage.format.CorruptedDataError(
+                    oid, '', back)
+            prev_txn = view[back+8:back+16].tobytes()
+            data_pos, plen = self._resolve_back(back)
+            if not plen:
+                return Record(oid, tid, '', None, prev_txn, pos)
+
+        if self._large(plen):
+            return LargeRecord(oid, tid, '', prev_txn, pos,
+                               view, data_pos, plen)
+        return Record(oid, tid, '', view[data_pos:data_pos+plen],
+                      prev_txn, pos)
+
+    next = __next__
+
+    def _read(self, pos, size):
+        return self._file[pos:pos+size]
+
+    def _resolve_back(self, back):
+        # Follow a chain of backpointers to the record with the data,
+        # returning its position and size.
+        view = self._file
+        while 1:
+            plen = DATA_HDR.unpack_from(view, back)[5]
+            if plen:
+                return back + DATA_HDR_LEN, plen
+            back_ = U64.unpack_from(view, back + DATA_HDR_LEN)[0]
+            if not back_:
+                return back + DATA_HDR_LEN, 0
+            back = back_
+
 class Record:
     """An abstract database record."""
+
+    __slots__ = ('oid', 'tid', 'version', 'data', 'data_txn', 'pos')
+
     def __init__(self, oid, tid, version, data, prev, pos):
         self.oid = oid
         self.tid = tid
@@ -713,11 +2193,42 @@ class Record:
         self.data_txn = prev
         self.pos = pos
 
+class LargeRecord(Record):
+    """A record with too much data to read all at once.
+
+    The data are read from the file in chunks when they're sent.  The
+    file may be a memoryview of a mapped file.
+    """
+
+    __slots__ = ('_file', '_data_pos', 'size')
+
+    def __init__(self, oid, tid, version, prev, pos, file, data_pos, size):
+        Record.__init__(self, oid, tid, version, None, prev, pos)
+        self._file = file
+        self._data_pos = data_pos
+        self.size = size
+
+    def chunks(self, chunk_size):
+        pos = self._data_pos
+        end = pos + self.size
+        if isinstance(self._file, memoryview):
+            for pos in range(pos, end, chunk_size):
+                yield self._file[pos:min(pos+chunk_size, end)]
+            return
+        while pos < end:
+            self._file.seek(pos)
+            data = self._file.read(min(chunk_size, end - pos))
+            if not data:
+                raise ZODB.FileStorage.format.CorruptedDataError(
+                    self.oid, '', pos)
+            pos += len(data)
+            yield data
+
 class ThreadCounter:
-    """Keep track of running threads
+    """Keep track of running threads and tasks
 
-    We use the run method to run the threads and the wait method to
-    wait until they're all done:
+    We use the run method to run the threads, the task method to wrap
+    tasks, and the wait method to wait until they're all done:
     """
 
     def __init__(self):
@@ -736,6 +2247,23 @@ class ThreadCounter:
             self.condition.notifyAll()
             self.condition.release()
 
+    def task(self, generator):
+        """Count a task, given as a generator, until it's done
+        """
+        self.condition.acquire()
+        self.count += 1
+        self.condition.release()
+        return self._task(generator)
+
+    def _task(self, generator):
+        try:
+            yield from generator
+        finally:
+            self.condition.acquire()
+            self.count -= 1
+            self.condition.notifyAll()
+            self.condition.release()
+
     def wait(self, timeout):
         deadline = time.time()+timeout
         self.condition.acquire()
@@ -746,10 +2274,100 @@ class ThreadCounter:
             self.condition.wait(w)
         self.condition.release()
 
+# Blob records start with a class pickle that's just a reference to
+# ZODB.blob.Blob, which fits in this many bytes in any protocol:
+blob_record_head = 64
+
+# The class pickles written by the pickler for each protocol:
+blob_class_pickles = tuple(cPickle.dumps(ZODB.blob.Blob, protocol)
+                           for protocol in range(cPickle.HIGHEST_PROTOCOL + 1))
+
 def is_blob_record(record):
+    """Check whether a data record is a blob record
+
+    The record's class pickle must be nothing but a reference to
+    ZODB.blob.Blob.  Only its opcodes are examined, so no modules
+    are imported and nothing is unpickled.
+
+    Records transformed by an XformStorage start with ".", a STOP
+    opcode, followed by the transform's prefix character, and so
+    aren't blob records.
+    """
     try:
-        return cPickle.loads(record) is ZODB.blob.Blob
-    except (MemoryError, KeyboardInterrupt, SystemExit):
-        raise
-    except Exception:
+        head = bytes(record[:blob_record_head])
+    except TypeError:
         return False
+
+    if head.startswith(blob_class_pickles):
+        return True
+    if b'ZODB.blob' not in head:
+        return False
+
+    try:
+        pos = 0
+        if head[0] == 0x80: # PROTO
+            if head[1] > cPickle.HIGHEST_PROTOCOL:
+                return False
+            pos = 2
+        if head[pos] == 0x95: # FRAME
+            size = struct.unpack("<Q", head[pos + 1:pos + 9])[0]
+            pos += 9
+            if size > len(record) - pos:
+                return False
+
+        op = head[pos]
+        if op == 0x63: # GLOBAL
+            end = head.index(b'\n', pos + 1)
+            module = head[pos + 1:end]
+            pos = head.index(b'\n', end + 1)
+            name = head[end + 1:pos]
+            pos += 1
+        else:
+            module, pos = _pickled_string(head, pos)
+            pos = _skip_memo(head, pos)
+            name, pos = _pickled_string(head, pos)
+            pos = _skip_memo(head, pos)
+            if head[pos] != 0x93: # STACK_GLOBAL
+                return False
+            pos += 1
+
+        pos = _skip_memo(head, pos)
+        return (head[pos] == 0x2e # STOP
+                and module == b'ZODB.blob' and name == b'Blob')
+    except (IndexError, ValueError, struct.error):
+        return False
+
+def _pickled_string(head, pos):
+    op = head[pos]
+    if op == 0x8c: # SHORT_BINUNICODE
+        start = pos + 2
+        size = head[pos + 1]
+    elif op == 0x58: # BINUNICODE
+        start = pos + 5
+        size = struct.unpack("<I", head[pos + 1:start])[0]
+    elif op == 0x8d: # BINUNICODE8
+        start = pos + 9
+        size = struct.unpack("<Q", head[pos + 1:start])[0]
+    else:
+        raise ValueError(op)
+    end = start + size
+    if end > len(head):
+        raise ValueError(size)
+    return head[start:end], end
+
+def _skip_memo(head, pos):
+    while True:
+        op = head[pos]
+        if op == 0x94: # MEMOIZE
+            pos += 1
+        elif op == 0x71: # BINPUT
+            pos += 2
+        elif op == 0x72: # LONG_BINPUT
+            pos += 5
+        elif op == 0x70: # PUT
+            end = head.index(b'\n', pos + 1)
+            if int(head[pos + 1:end]) < 0:
+                raise ValueError("negative PUT argument")
+            pos = end + 1
+        else:
+            return pos
@@ -0,0 +1,68 @@
+##############################################################################
+#
+# Copyright (c) 2013 Zope Corporation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Token-bucket rate limits
+
+A bucket fills at its rate, in bytes per second, holding at most a
+second's worth.  Senders take what they send from the bucket, which
+may leave it in debt, and wait until it's no longer in debt before
+sending more, so data larger than the bucket can still be sent.  A
+rate of None or 0 means there's no limit.
+"""
+
+import threading
+import time
+
+class TokenBucket:
+
+    def __init__(self, rate=None):
+        self.lock = threading.Lock()
+        self.rate = rate or None
+        self.tokens = self.rate or 0
+        self.updated = time.monotonic()
+
+    def _fill(self):
+        # Called with the lock held
+        now = time.monotonic()
+        if self.rate:
+            self.tokens = min(
+                self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def set_rate(self, rate):
+        with self.lock:
+            self._fill()
+            self.rate = rate or None
+            if self.rate:
+                self.tokens = min(self.tokens, self.rate)
+            else:
+                self.tokens = 0
+
+    def delay(self):
+        """Return the number of seconds to wait before sending
+        """
+        with self.lock:
+            if not self.rate:
+                return 0
+            self._fill()
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+    def take(self, size):
+        """Record that size bytes were sent
+        """
+        with self.lock:
+            if self.rate:
+                self._fill()
+                self.tokens -= size
@@ -0,0 +1,205 @@
+##############################################################################
+#
+# Copyright (c) 2013 Zope Corporation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Raw transaction records
+
+When both ends of a connection are file storages without blobs, a
+primary can send transactions as the bytes of their transaction
+records, as found in its storage file, rather than record by record.
+The secondary checks the record and appends it to its own file, after
+fixing the file positions in it:
+
+- each data record's transaction position, which is where the
+  transaction is written,
+
+- each data record's previous-record position, which is the position
+  of the object's current record in the secondary's index, and
+
+- backpointers, to records written by earlier transactions.  The
+  primary sends the ids of the transactions backpointers point into,
+  and we find the records in those transactions.
+
+The storage's index is then updated for all of the transaction's
+objects at once.
+"""
+
+import struct
+import ZODB.FileStorage
+import ZODB.FileStorage.format
+import ZODB.interfaces
+import ZODB.POSException
+import ZODB.utils
+import zc.zrs.primary
+
+TRANS_HDR = struct.Struct(ZODB.FileStorage.format.TRANS_HDR)
+TRANS_HDR_LEN = ZODB.FileStorage.format.TRANS_HDR_LEN
+DATA_HDR = struct.Struct(ZODB.FileStorage.format.DATA_HDR)
+DATA_HDR_LEN = ZODB.FileStorage.format.DATA_HDR_LEN
+U64 = struct.Struct(">Q")
+
+# Offsets in a data record of the previous-record and transaction
+# positions, which are written together.
+POSITIONS_OFFSET = 16
+POSITIONS = struct.Struct(">QQ")
+
+# Offset of the status in a transaction record
+STATUS_OFFSET = 16
+
+class UnresolvedBackpointer(Exception):
+    """A backpointer's record isn't in the secondary's file
+
+    This can happen if the secondary was packed separately from the
+    primary.  Such transactions have to be sent record by record.
+    """
+
+def file_storage(storage):
+    """Return the file storage raw transactions can be written to
+
+    None is returned if transactions for the storage can't be written
+    raw.  A primary wrapping a file storage is itself replaced.
+    """
+    if isinstance(storage, zc.zrs.primary.Primary):
+        storage = storage._storage
+    if (isinstance(storage, ZODB.FileStorage.FileStorage)
+        and not ZODB.interfaces.IBlobStorage.providedBy(storage)
+        and not storage.isReadOnly()
+        ):
+        return storage
+    return None
+
+def backpointer_tids(pos, end, read):
+    """Return the ids of the transactions backpointers point into
+
+    The data records of a transaction, from pos to end, are read with
+    the read function, which reads a number of bytes at a position.
+    """
+    tids = []
+    while pos < end:
+        oid, tid, prev, tloc, vlen, plen = DATA_HDR.unpack(
+            read(pos, DATA_HDR_LEN))
+        if plen:
+            pos += DATA_HDR_LEN + plen
+            continue
+        back = U64.unpack(read(pos + DATA_HDR_LEN, 8))[0]
+        if back:
+            tids.append(bytes(read(back + 8, 8)))
+        pos += DATA_HDR_LEN + 8
+    return tids
+
+def parse(data, tid, back_tids):
+    """Check a raw transaction record
+
+    The transaction status, user, description and extension are
+    returned, along with the oids and positions, relative to the
+    start of the record, of its data records.  ValueError is raised
+    if the record is malformed.
+    """
+    size = len(data)
+    if size < TRANS_HDR_LEN + 8:
+        raise ValueError("Raw transaction too short", size)
+    tid_, tlen, status, ulen, dlen, elen = TRANS_HDR.unpack_from(data)
+    if tid_ != tid:
+        raise ValueError("Raw transaction id mismatch", tid_, tid)
+    if tlen + 8 != size or U64.unpack_from(data, tlen)[0] != tlen:
+        raise ValueError("Invalid raw transaction length", tlen, size)
+    if status not in b' p':
+        raise ValueError("Invalid raw transaction status", status)
+
+    pos = TRANS_HDR_LEN + ulen + dlen + elen
+    if pos > tlen:
+        raise ValueError("Invalid raw transaction header", tlen)
+    user = bytes(data[TRANS_HDR_LEN:TRANS_HDR_LEN+ulen])
+    description = bytes(data[TRANS_HDR_LEN+ulen:TRANS_HDR_LEN+ulen+dlen])
+    extension = bytes(data[pos-elen:pos])
+
+    records = []
+    tloc = None
+    backs = 0
+    while pos < tlen:
+        if pos + DATA_HDR_LEN > tlen:
+            raise ValueError("Invalid raw data record", pos)
+        oid, rtid, prev, rtloc, vlen, plen = DATA_HDR.unpack_from(data, pos)
+        if tloc is None:
+            tloc = rtloc
+        if rtid != tid or rtloc != tloc or vlen:
+            raise ValueError("Invalid raw data record", pos)
+        end = pos + DATA_HDR_LEN + (plen or 8)
+        if end > tlen:
+            raise ValueError("Raw data record exceeds transaction", pos)
+        if not plen and U64.unpack_from(data, pos + DATA_HDR_LEN)[0]:
+            backs += 1
+        records.append((oid, pos))
+        pos = end
+
+    if backs != len(back_tids):
+        raise ValueError("Wrong number of backpointer transactions",
+                         backs, len(back_tids))
+
+    return status.decode('ascii'), user, description, extension, records
+
+def write(fs, transaction, data, records, back_tids):
+    """Write a parsed raw transaction record to a file storage
+
+    The storage must have begun the transaction, which will be
+    committed by calling tpc_finish.  tpc_vote isn't called, as it
+    would write the transaction again.  The data are modified in
+    place.
+    """
+    backs = iter(back_tids)
+    with fs._lock:
+        if transaction is not fs._transaction:
+            raise ZODB.POSException.StorageTransactionError(
+                "write called with wrong transaction")
+        tpos = fs._pos
+        index_get = fs._index.get
+        tindex = fs._tindex
+        for oid, pos in records:
+            POSITIONS.pack_into(data, pos + POSITIONS_OFFSET,
+                                index_get(oid, 0), tpos)
+            if DATA_HDR.unpack_from(data, pos)[5] == 0:
+                back_pos = pos + DATA_HDR_LEN
+                if U64.unpack_from(data, back_pos)[0]:
+                    U64.pack_into(data, back_pos,
+                                  _find_back(fs, oid, next(backs)))
+            tindex[oid] = tpos + pos
+            if oid > fs._oid:
+                fs.set_max_oid(oid)
+
+        # Like tpc_vote, write the record marked as being committed.
+        # tpc_finish writes the real status.
+        data[STATUS_OFFSET:STATUS_OFFSET+1] = b'c'
+        fs._file.seek(tpos)
+        try:
+            fs._file.write(data)
+            fs._file.flush()
+        except:
+            fs._file.truncate(tpos)
+            fs._files.flush()
+            raise
+        fs._nextpos = tpos + len(data)
+
+def _find_back(fs, oid, tid):
+    # Return the position of the oid's record in the transaction with
+    # the given id.  Called with the storage lock held.  Rather than
+    # search the file for the transaction, we follow the oid's records
+    # back from its current one, which is usually close.
+    pos = fs._index.get(oid, 0)
+    while pos:
+        dh = fs._read_data_header(pos, oid)
+        if dh.tid == tid:
+            return pos
+        if dh.tid < tid:
+            break
+        pos = dh.prev
+    raise UnresolvedBackpointer(ZODB.utils.oid_repr(oid),
+                                ZODB.utils.tid_repr(tid))
@@ -0,0 +1,140 @@
+##############################################################################
+#
+# Copyright (c) 2013 Zope Corporation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Read ahead of sending, for secondaries catching up
+
+A producer catching up on its own reads a transaction, encodes it,
+and sends it, and then reads the next.  While its secondary's
+connection can't take more data, nothing is read, and while it reads,
+nothing is sent.
+
+With read-ahead, reading is done by a separate task, a reader, that
+reads and encodes transactions, including the data of their blob
+files, and puts their messages in a queue.  The producer takes
+messages from the queue and sends them.  When the queue holds max_size
+bytes, the reader waits until the producer has taken them.
+
+Besides messages, the queue holds markers for the beginnings and ends
+of transactions, for when the reader has caught up, for when the
+reader's iterator was stopped, and for errors.
+
+The time each stage spends in each of its states is recorded, to see
+which stage limits the other.
+"""
+
+import collections
+import threading
+import time
+
+# Markers:
+BEGIN = 'begin'         # (BEGIN, tid)
+COMMIT = 'commit'       # (COMMIT, tid)
+CAUGHT_UP = 'caught up' # (CAUGHT_UP, None)
+ENDED = 'ended'         # (ENDED, None)
+ERROR = 'error'         # (ERROR, exception)
+
+# Stages and their states:
+states = dict(
+    reader=('reading', # reading and encoding transactions
+            'blocked', # waiting for room in the queue
+            'idle',    # caught up, waiting for commits
+            ),
+    sender=('busy',    # taking messages from the queue
+            'sending', # handing data to the connection, or waiting to
+            'starved', # waiting for messages
+            ),
+    )
+
+class ReadAheadQueue:
+
+    reader = None
+
+    def __init__(self, max_size, wake):
+        self.max_size = max_size
+        self.wake = wake
+        self.lock = threading.Lock()
+        self.items = collections.deque()
+        self.queued = 0
+        self.blocked = self.stopped = False
+        self.started = time.monotonic()
+        self.times = dict(
+            (stage, dict((state, 0.0) for state in stage_states))
+            for (stage, stage_states) in states.items())
+        self.states = {}
+
+    def put(self, item, size=0):
+        """Add a message, or a marker, to the queue
+
+        Return False if the reader should wait until there's room.
+        """
+        with self.lock:
+            was_empty = not self.items
+            self.items.append((item, size))
+            self.queued += size
+            full = self.blocked = self.queued >= self.max_size
+        if was_empty:
+            self.wake()
+        return not full
+
+    def full(self):
+        with self.lock:
+            return self.blocked and not self.stopped
+
+    def take(self):
+        """Take everything in the queue
+        """
+        with self.lock:
+            items = self.items
+            self.items = collections.deque()
+            self.queued = 0
+            blocked = self.blocked
+            self.blocked = False
+        if blocked and self.reader is not None:
+            self.reader.wake()
+        return [item for (item, size) in items]
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+            self.items.clear()
+            self.queued = 0
+        if self.reader is not None:
+            self.reader.wake()
+
+    def enter(self, stage, state):
+        """Note that a stage has entered a state, or stopped, if None
+        """
+        now = time.monotonic()
+        with self.lock:
+            old = self.states.pop(stage, None)
+            if old is not None:
+                old_state, since = old
+                self.times[stage][old_state] += now - since
+            if state is not None:
+                self.states[stage] = state, now
+
+    def stats(self):
+        """Return the queue size and the shares of time in stage states
+        """
+        now = time.monotonic()
+        with self.lock:
+            elapsed = (now - self.started) or 1
+            result = dict(queued=self.queued, items=len(self.items))
+            for stage, stage_times in self.times.items():
+                stage_times = stage_times.copy()
+                if stage in self.states:
+                    state, since = self.states[stage]
+                    stage_times[state] += now - since
+                result[stage] = dict(
+                    (state, t / elapsed) for (state, t) in stage_times.items())
+            return result
@@ -14,17 +14,27 @@
 
 from six.moves import cPickle
 import logging
-from hashlib import md5
 import os
 import tempfile
 import threading
 import twisted.internet.protocol
+import zc.zrs.applier
+import zc.zrs.blobchannel
+import zc.zrs.bloblinks
+import zc.zrs.checksum
+import zc.zrs.compression
+import zc.zrs.features
+import zc.zrs.groupsync
+import zc.zrs.messages
 import zc.zrs.primary
+import zc.zrs.rawtxn
 import zc.zrs.reactor
 import zc.zrs.sizedmessage
+import zc.zrs.snapshot
 import ZODB.blob
 import ZODB.interfaces
 import ZODB.POSException
+import ZODB.utils
 import zope.interface
 from ZODB.Connection import TransactionMetaData
 
@@ -39,14 +49,47 @@ class SecondaryProtocol(twisted.internet.protocol.Protocol):
 
     logger = logger
 
+    __frame_handler = None
+    __decode = staticmethod(cPickle.loads)
+    __tid = ZODB.utils.z64
+
     def connectionMade(self):
-        self.__stream = zc.zrs.sizedmessage.Stream(self.messageReceived)
+        self.__stream = zc.zrs.sizedmessage.Stream(self.frameReceived)
         self.__peer = str(self.transport.getPeer()) + ': '
+        self.__storage = self.factory.storage
+        applier = self.factory.applier
+        if applier is not None:
+            applier.connected()
+            self.__storage = applier
         self.factory.instance = self
-        self.transport.write(zc.zrs.sizedmessage.marshal(
-            self.factory.zrs_proto))
-        tid = self.factory.storage.lastTransaction()
-        self._replication_stream_md5 = md5(tid)
+        features = self.factory.features
+        staging = self.factory.snapshot
+        if features is not None and staging is not None:
+            # What we ask for depends on how much of a snapshot we have.
+            features = dict(features)
+            offer = staging.offer()
+            if offer:
+                features['bootstrap'] = offer
+            else:
+                features.pop('bootstrap', None)
+        if features:
+            self.transport.write(zc.zrs.sizedmessage.marshal(
+                zc.zrs.features.feature_protocol(self.factory.zrs_proto)))
+            self.transport.write(zc.zrs.sizedmessage.marshal(
+                zc.zrs.features.encode(features)))
+            self.__frame_handler = self.featuresReceived
+        else:
+            self.transport.write(zc.zrs.sizedmessage.marshal(
+                self.factory.zrs_proto))
+            self.__frame_handler = self.messageReceived
+        if applier is not None:
+            # Transactions we've received may not be committed yet.
+            tid = applier.last_received()
+        else:
+            tid = self.factory.storage.lastTransaction()
+        self.__start = tid
+        self._replication_stream_checksum = zc.zrs.checksum.new('md5', tid)
+        self.__per_transaction_checksums = False
         self.transport.write(zc.zrs.sizedmessage.marshal(tid))
         self.info("Connected")
         if self.factory.keep_alive_delay > 0:
@@ -58,9 +101,25 @@ class SecondaryProtocol(twisted.internet.protocol.Protocol):
             self.keep_alive_delayed_call.cancel()
 
         self.factory.instance = None
+        if self.__frame_handler == self.featuresReceived:
+            # The primary hung up on our offer.  It's probably too old
+            # to negotiate features, so don't ask next time.
+            self.logger.warning(
+                self.__peer + "Primary didn't accept features. "
+                "Falling back to %s", self.factory.zrs_proto)
+            self.factory.features = None
         if self._zrs_transaction is not None:
-            self.factory.storage.tpc_abort(self._zrs_transaction)
+            self.__storage.tpc_abort(self._zrs_transaction)
             self._zrs_transaction = None
+        if self.__queue is not None:
+            self.__queue.close()
+            self.__fetcher.close()
+            self.__queue = self.__fetcher = None
+        if self.factory.applier is not None:
+            self.factory.applier.disconnected()
+        if self.__file_block:
+            self.factory.snapshot.abort()
+            self.__file_block = False
         self.info("Disconnected %r", reason)
 
     def error(self, message, *args, **kw):
@@ -70,6 +129,29 @@ class SecondaryProtocol(twisted.internet.protocol.Protocol):
     def info(self, message, *args):
         self.logger.info(self.__peer + message, *args)
 
+    def blob_channel_stats(self):
+        if self.__queue is not None:
+            return self.__queue.stats()
+
+    __paused = 0
+    def pauseReceiving(self):
+        # Receiving is paused while blob files are awaited, or while
+        # transactions wait to be committed, until neither is the case.
+        self.__paused += 1
+        if self.__paused == 1:
+            getattr(self.transport, 'pauseProducing', lambda: None)()
+
+    def resumeReceiving(self):
+        self.__paused -= 1
+        if self.__paused == 0:
+            getattr(self.transport, 'resumeProducing', lambda: None)()
+
+    def apply_failed(self, tid, exc_info):
+        if isinstance(exc_info[1], zc.zrs.rawtxn.UnresolvedBackpointer):
+            self.__unresolved_backpointer(tid)
+        self.error("Couldn't commit %s", ZODB.utils.tid_repr(tid),
+                   exc_info=exc_info)
+
     def keep_alive(self):
         if self.keep_alive_delayed_call is not None:
             self.transport.write(b"\0\0\0\0")
@@ -85,10 +167,60 @@ class SecondaryProtocol(twisted.internet.protocol.Protocol):
             self.error("Input data error", exc_info=True)
 
 
+    def frameReceived(self, frame):
+        self.__frame_handler(frame)
+
+    def featuresReceived(self, message):
+        features = zc.zrs.features.decode(message)
+        self.info("features %r", features)
+        if features.get('headers') == ['binary']:
+            self.__decode = zc.zrs.messages.decode_binary
+        [self.__checksum_algorithm] = features.get('checksum', ['md5'])
+        self._replication_stream_checksum = zc.zrs.checksum.new(
+            self.__checksum_algorithm, self.__start)
+        self.__per_transaction_checksums = (
+            features.get('checksum-scope') == ['transaction'])
+        if 'compress' in features:
+            [spec] = features['compress']
+            decompress = zc.zrs.compression.decompressor(spec)
+            stream = zc.zrs.sizedmessage.Stream(self.messageReceived)
+            self.__frame_handler = lambda frame: stream(decompress(frame))
+        else:
+            self.__frame_handler = self.messageReceived
+        if features.get('blobs') == ['fetch']:
+            # Transactions are queued until their blob files arrive
+            # on blob channels.
+            self.__fetcher = zc.zrs.blobchannel.Fetcher(
+                self.factory, self.__blob_arrived, self.__blob_channel_lost,
+                self.error)
+            self.__queue = zc.zrs.blobchannel.Queue(
+                self.__storage, self.__fetcher,
+                self.pauseReceiving, self.resumeReceiving)
+            self.__storage = self.__queue
+
+    __fetcher = None
+    __queue = None
+    def __blob_arrived(self, blob):
+        try:
+            self.__queue.apply()
+        except:
+            self.error("Input data error", exc_info=True)
+
+    def __blob_channel_lost(self, reason):
+        # Start over, with new channels.
+        self.info("Blob channel lost %r", reason)
+        self.factory.connector.disconnect()
+
+    __blob_fetch = None
     __blob_file_blocks = None
     __blob_file_handle = None
     __blob_file_name = None
+    __blob_link = False
     __blob_record = None
+    __file_block = False
+    __large_record = None
+    __raw_transaction = None
+    __raw_record = None
     __record = None
     def messageReceived(self, message):
         if self.__record:
@@ -96,13 +228,19 @@ class SecondaryProtocol(twisted.internet.protocol.Protocol):
             oid, serial, version, data_txn = self.__record
             self.__record = None
             data = message or None
-            key = serial, version
-            oids = self.__inval.get(key)
-            if oids is None:
-                oids = self.__inval[key] = {}
-            oids[oid] = 1
+            self.__invalidated(oid, serial, version)
 
-            if self.__blob_file_blocks:
+            if self.__blob_link:
+                # The blob file name comes next.
+                self.__blob_record = oid, serial, data, version, data_txn
+            elif self.__blob_fetch is not None:
+                # The blob file comes on a blob channel.
+                blob = self.__queue.fetch(oid, serial, self.__blob_fetch)
+                self.__blob_fetch = None
+                self.__storage.restoreBlob(
+                    oid, serial, data, blob, data_txn,
+                    self._zrs_transaction)
+            elif self.__blob_file_blocks:
                 # We have to collect blob data
                 self.__blob_record = oid, serial, data, version, data_txn
 
@@ -111,10 +249,18 @@ class SecondaryProtocol(twisted.internet.protocol.Protocol):
                                       self.factory.storage.temporaryDirectory()
                                       )
             else:
-                self.factory.storage.restore(
+                self.__storage.restore(
                     oid, serial, data, version, data_txn,
                     self._zrs_transaction)
 
+        elif self.__blob_record and self.__blob_link:
+            self.__blob_link = False
+            oid, serial, data, version, data_txn = self.__blob_record
+            self.__blob_record = None
+            self.__storage.restoreBlob(
+                oid, serial, data, self.__link_blob(message), data_txn,
+                self._zrs_transaction)
+
         elif self.__blob_record:
             os.write(self.__blob_file_handle, message)
             self.__blob_file_blocks -= 1
@@ -123,13 +269,57 @@ class SecondaryProtocol(twisted.internet.protocol.Protocol):
                 os.close(self.__blob_file_handle)
                 oid, serial, data, version, data_txn = self.__blob_record
                 self.__blob_record = None
-                self.factory.storage.restoreBlob(
+                self.__storage.restoreBlob(
                     oid, serial, data, self.__blob_file_name, data_txn,
                     self._zrs_transaction)
 
+        elif self.__large_record:
+            # Collect large-record data into a buffer allocated up
+            # front, so the only copy we hold is the one we restore.
+            data = self.__large_data
+            pos = self.__large_data_pos
+            end = pos + len(message)
+            if end > len(data):
+                raise ValueError("Too much record data")
+            data[pos:end] = message
+            self.__large_data_pos = end
+            if end == len(data):
+                oid, serial, version, data_txn = self.__large_record
+                self.__large_record = self.__large_data = None
+                self.__storage.restore(
+                    oid, serial, data, version, data_txn,
+                    self._zrs_transaction)
+
+        elif self.__raw_transaction:
+            # Collect a raw transaction record.  It's written when
+            # we get the commit message.
+            data = self.__raw_data
+            pos = self.__raw_data_pos
+            end = pos + len(message)
+            if end > len(data):
+                raise ValueError("Too much transaction data")
+            data[pos:end] = message
+            self.__raw_data_pos = end
+            if end == len(data):
+                tid, back_tids = self.__raw_transaction
+                self.__raw_transaction = self.__raw_data = None
+                (status, user, description, extension, records
+                 ) = zc.zrs.rawtxn.parse(data, tid, back_tids)
+                for oid, _ in records:
+                    self.__invalidated(oid, tid, '')
+                transaction = TransactionMetaData(user=user,
+                                                  description=description,
+                                                  extension=extension)
+                self.__storage.tpc_begin(transaction, tid, status)
+                self._zrs_transaction = transaction
+                self.__raw_record = data, records, back_tids
+
+        elif self.__file_block and self.factory.snapshot.collecting:
+            self.factory.snapshot.write(message)
+
         else:
             # Ordinary message
-            message_type, data = cPickle.loads(message)
+            message_type, data = self.__decode(message)
             if message_type == 'T':
                 assert self._zrs_transaction is None
                 assert self.__record is None
@@ -137,40 +327,153 @@ class SecondaryProtocol(twisted.internet.protocol.Protocol):
                 transaction = TransactionMetaData(user=user,
                                                   description=description,
                                                   extension=extension)
+                if self.__per_transaction_checksums:
+                    self._replication_stream_checksum = zc.zrs.checksum.new(
+                        self.__checksum_algorithm)
+                self.__tid = tid
                 self.__inval = {}
-                self.factory.storage.tpc_begin(transaction, tid, status)
+                self.__storage.tpc_begin(transaction, tid, status)
                 self._zrs_transaction = transaction
             elif message_type == 'S':
                 self.__record = data
             elif message_type == 'B':
                 self.__record = data[:-1]
                 self.__blob_file_blocks = data[-1]
+            elif message_type == 'H':
+                self.__record = data
+                self.__blob_link = True
+            elif message_type == 'D':
+                if self.__queue is None:
+                    raise ValueError("Unexpected blob-fetch message")
+                self.__record = data[:-1]
+                self.__blob_fetch = data[-1]
+            elif message_type == 'L':
+                oid, serial, version, data_txn, size = data
+                self.__invalidated(oid, serial, version)
+                self.__large_record = oid, serial, version, data_txn
+                self.__large_data = bytearray(size)
+                self.__large_data_pos = 0
+            elif message_type == 'R':
+                assert self._zrs_transaction is None
+                tid, size, back_tids = data
+                if self.__per_transaction_checksums:
+                    self._replication_stream_checksum = zc.zrs.checksum.new(
+                        self.__checksum_algorithm)
+                self.__tid = tid
+                self.__inval = {}
+                self.__raw_transaction = tid, back_tids
+                self.__raw_data = bytearray(size)
+                self.__raw_data_pos = 0
+            elif message_type == 'F':
+                assert self._zrs_transaction is None
+                if self.factory.snapshot is None:
+                    raise ValueError("Unexpected snapshot data")
+                kind, key, pos, size = data
+                if self.__per_transaction_checksums:
+                    self._replication_stream_checksum = zc.zrs.checksum.new(
+                        self.__checksum_algorithm)
+                self.factory.snapshot.begin(kind, key, pos, size)
+                self.__file_block = True
+                if kind == 'start':
+                    self.info("Receiving snapshot at %s from %s",
+                              ZODB.utils.tid_repr(key), pos)
+            elif message_type == 'Q':
+                position, waited = data
+                if position:
+                    self.info("Waiting to catch up, at position %s,"
+                              " after %.0f seconds", position, waited)
+                else:
+                    self.info("Catching up after waiting %.0f seconds",
+                              waited)
+            elif message_type == 'C' and self.__file_block:
+                self._check_replication_stream_checksum(data)
+                self.__file_block = False
+                self.factory.snapshot.commit(self.factory.db)
             elif message_type == 'C':
                 self._check_replication_stream_checksum(data)
                 assert self._zrs_transaction is not None
                 assert self.__record is None
-                self.factory.storage.tpc_vote(self._zrs_transaction)
-
+                assert self.__large_record is None
+                assert self.__raw_transaction is None
+                if self.__raw_record is not None:
+                    self.__write_raw_record()
+                else:
+                    self.__storage.tpc_vote(self._zrs_transaction)
+
+                inval = self.__inval
                 def invalidate(tid):
                     if self.factory.db is not None:
-                        for (tid, version), oids in self.__inval.items():
+                        for (tid, version), oids in inval.items():
                             self.factory.db.invalidate(tid, oids)
+                if self.factory.group_sync is not None:
+                    # Databases only see durable transactions.
+                    invalidate = self.factory.group_sync.after_sync(
+                        invalidate)
 
-                self.factory.storage.tpc_finish(
+                self.__storage.tpc_finish(
                     self._zrs_transaction, invalidate)
                 self._zrs_transaction = None
             else:
                 raise ValueError("Invalid message type, %r" % message_type)
 
-        self._replication_stream_md5.update(message)
+        self._replication_stream_checksum.update(message)
+
+    def __invalidated(self, oid, serial, version):
+        key = serial, version
+        oids = self.__inval.get(key)
+        if oids is None:
+            oids = self.__inval[key] = {}
+        oids[oid] = 1
+
+    def __link_blob(self, name):
+        try:
+            return zc.zrs.bloblinks.link(
+                name.decode('utf-8'),
+                self.factory.storage.temporaryDirectory())
+        except OSError:
+            # We'll have to get blob data.
+            self.logger.warning(
+                self.__peer + "Can't link blob files from the primary. "
+                "Falling back to sending blob data.")
+            blobs = [spec for spec in self.factory.features['blobs']
+                     if not spec.startswith('link:')]
+            if blobs:
+                self.factory.features['blobs'] = blobs
+            else:
+                del self.factory.features['blobs']
+            raise
+
+    def __write_raw_record(self):
+        data, records, back_tids = self.__raw_record
+        self.__raw_record = None
+        if self.__storage is self.factory.applier:
+            self.__storage.write_raw(
+                self._zrs_transaction, data, records, back_tids)
+            return
+        try:
+            zc.zrs.rawtxn.write(
+                zc.zrs.rawtxn.file_storage(self.factory.storage),
+                self._zrs_transaction, data, records, back_tids)
+        except zc.zrs.rawtxn.UnresolvedBackpointer:
+            self.__unresolved_backpointer(self.__tid)
+            raise
+
+    def __unresolved_backpointer(self, tid):
+        # We'll have to get this transaction record by record.
+        self.logger.warning(
+            self.__peer + "Can't resolve backpointers in %s. "
+            "Falling back to sending records.",
+            ZODB.utils.tid_repr(tid))
+        self.factory.features.pop('transfer', None)
 
     def _check_replication_stream_checksum(self, data):
         if self.factory.check_checksums:
             checksum = data[0]
-            if checksum != self._replication_stream_md5.digest():
+            expected = self._replication_stream_checksum.digest()
+            if checksum != expected:
                 raise AssertionError(
-                    "Bad checksum", checksum,
-                    self._replication_stream_md5.digest())
+                    "Bad checksum", checksum, expected,
+                    ZODB.utils.tid_repr(self.__tid))
 
 class SecondaryFactory(twisted.internet.protocol.ClientFactory):
 
@@ -179,13 +482,25 @@ class SecondaryFactory(twisted.internet.protocol.ClientFactory):
     closed = False
     protocol = SecondaryProtocol
 
+    # Staging for a snapshot, if we bootstrap from snapshots
+    snapshot = None
+
+    # The number of blob channels to fetch blob files over
+    blob_channels = 0
+
+    # Commits received transactions in a separate thread, if set
+    applier = None
+
+    # Syncs the storage file for groups of transactions, if set
+    group_sync = None
+
     # We'll keep track of the connected instance, if any mainly
     # for the convenience of some tests that want to force disconnects to
     # stress the secondaries.
     instance = None
 
     def __init__(self, reactor, storage, reconnect_delay, check_checksums,
-                 zrs_proto, keep_alive_delay, secondary):
+                 zrs_proto, keep_alive_delay, secondary, features=None):
         self.reactor = reactor
         self.storage = storage
         self.reconnect_delay = reconnect_delay
@@ -193,6 +508,7 @@ class SecondaryFactory(twisted.internet.protocol.ClientFactory):
         self.zrs_proto = zrs_proto
         self.keep_alive_delay = keep_alive_delay
         self.secondary = secondary
+        self.features = features
 
     def close(self, callback):
         self.closed = True
@@ -200,6 +516,23 @@ class SecondaryFactory(twisted.internet.protocol.ClientFactory):
             self.connector.disconnect()
         callback()
 
+    # Called by our applier:
+
+    def pause_receiving(self):
+        if self.instance is not None:
+            self.instance.pauseReceiving()
+
+    def resume_receiving(self):
+        if self.instance is not None:
+            self.instance.resumeReceiving()
+
+    def apply_failed(self, tid, exc_info):
+        if self.instance is not None:
+            self.instance.apply_failed(tid, exc_info)
+        else:
+            logger.critical("Couldn't commit %s", ZODB.utils.tid_repr(tid),
+                            exc_info=exc_info)
+
     def startedConnecting(self, connector):
         if self.closed:
             connector.disconnect()
@@ -216,14 +549,18 @@ class SecondaryFactory(twisted.internet.protocol.ClientFactory):
         if not self.closed:
             self.reactor.callLater(self.reconnect_delay, self.connect)
 
-    def connect(self):
+    def connect(self, factory=None):
+        # Connect to the primary, for replication, or with another
+        # factory, for a blob channel.
+        if factory is None:
+            factory = self
         addr = self.secondary._addr
         reactor = self.reactor
         if isinstance(addr, str):
-            reactor.callFromThread(reactor.connectUNIX, addr, self)
+            reactor.callFromThread(reactor.connectUNIX, addr, factory)
         else:
             host, port = addr
-            reactor.callFromThread(reactor.connectTCP, host, port, self)
+            reactor.callFromThread(reactor.connectTCP, host, port, factory)
 
 
 class Secondary(zc.zrs.primary.Base):
@@ -232,7 +569,13 @@ class Secondary(zc.zrs.primary.Base):
     logger = logger
 
     def __init__(self, storage, addr, reactor=None, reconnect_delay=60,
-                 check_checksums=True, keep_alive_delay=0):
+                 check_checksums=True, keep_alive_delay=0, compression=None,
+                 binary_headers=False, checksum_algorithm='md5',
+                 per_transaction_checksums=False, chunk_size=None,
+                 queue_notices=False, raw_transactions=False,
+                 snapshot_bootstrap=False, link_blobs=False,
+                 blob_channels=0, apply_queue_size=0,
+                 group_sync_interval=0, group_sync_transactions=0):
         zc.zrs.primary.Base.__init__(self, storage, addr, reactor)
         storage = self._storage
 
@@ -240,9 +583,86 @@ class Secondary(zc.zrs.primary.Base):
 
         zrs_proto = self.copyMethods(storage)
 
+        features = {}
+        if compression:
+            features['compress'] = zc.zrs.compression.parse_list(compression)
+        if binary_headers:
+            features['headers'] = 'binary'
+        if checksum_algorithm != 'md5':
+            if checksum_algorithm not in zc.zrs.checksum.algorithms:
+                raise ValueError("Unknown checksum algorithm",
+                                 checksum_algorithm)
+            features['checksum'] = checksum_algorithm
+        if per_transaction_checksums:
+            features['checksum-scope'] = 'transaction'
+        if chunk_size:
+            features['chunk-size'] = str(chunk_size)
+        if queue_notices:
+            features['notices'] = 'queue'
+        if raw_transactions:
+            if chunk_size:
+                # Raw transactions are held in memory until they're
+                # committed, whatever their size.
+                self.logger.warning(
+                    "Can't receive raw transactions in chunks for %s",
+                    storage.getName())
+            elif zc.zrs.rawtxn.file_storage(storage) is not None:
+                features['transfer'] = 'raw'
+            else:
+                self.logger.warning(
+                    "Can't write raw transactions to %s", storage.getName())
+
+        blobs = []
+        if link_blobs:
+            if ZODB.interfaces.IBlobStorage.providedBy(self):
+                blobs.append(zc.zrs.bloblinks.offer(
+                    storage.temporaryDirectory()))
+            else:
+                self.logger.warning(
+                    "Can't link blob files into %s", storage.getName())
+        if blob_channels:
+            if ZODB.interfaces.IBlobStorage.providedBy(self):
+                blobs.append('fetch')
+            else:
+                self.logger.warning(
+                    "Can't fetch blob files for %s", storage.getName())
+        if blobs:
+            # Linking is preferred, if we can.
+            features['blobs'] = blobs
+
+        staging = None
+        if snapshot_bootstrap:
+            fs = zc.zrs.snapshot.file_storage(storage)
+            if fs is not None and not fs.isReadOnly():
+                staging = zc.zrs.snapshot.Staging(storage)
+                # The offer is made when we connect.
+                features['bootstrap'] = 'snapshot'
+            else:
+                self.logger.warning(
+                    "Can't install snapshots in %s", storage.getName())
+
         self._factory = self.factoryClass(
             reactor, storage, reconnect_delay,
-            check_checksums, zrs_proto, keep_alive_delay, self)
+            check_checksums, zrs_proto, keep_alive_delay, self, features)
+        self._factory.snapshot = staging
+        self._factory.blob_channels = blob_channels
+        if group_sync_interval:
+            fs = zc.zrs.snapshot.file_storage(storage)
+            if (fs is not None and not fs.isReadOnly() and
+                zc.zrs.groupsync.supported(fs)):
+                group_sync = self._factory.group_sync = (
+                    zc.zrs.groupsync.GroupSync(
+                        fs, group_sync_interval, group_sync_transactions))
+                self.lastTransaction = group_sync.lastTransaction
+            else:
+                self.logger.warning(
+                    "Can't group syncs for %s", storage.getName())
+        if apply_queue_size:
+            factory = self._factory
+            factory.applier = zc.zrs.applier.Applier(
+                storage, reactor, apply_queue_size,
+                factory.pause_receiving, factory.resume_receiving,
+                factory.apply_failed)
         self.logger.info("Opening %s %s", self.getName(), addr)
 
         if addr:
@@ -296,6 +716,34 @@ class Secondary(zc.zrs.primary.Base):
         raise ZODB.POSException.ReadOnlyError()
     new_oid = tpc_begin = undo = write_method
 
+    def getBlobChannelStats(self):
+        """Return statistics about transactions waiting for blob files
+
+        None is returned unless blob files are being fetched over blob
+        channels.  Otherwise, the number and size of the transactions
+        received but waiting for blob files, the number and size of
+        the blob files requested but not yet received, the id of the
+        last transaction received, and the number of seconds by which
+        the last transaction committed lags behind it, are returned.
+        """
+        instance = self._factory.instance
+        if instance is not None:
+            return instance.blob_channel_stats()
+
+    def getApplyStats(self):
+        """Return statistics about transactions waiting to be committed
+
+        None is returned unless received transactions are committed in
+        a separate thread.  Otherwise, the number and size of the
+        transactions waiting, the id of the last transaction received,
+        if it isn't committed yet, the number of transactions committed,
+        and the seconds the last of these, and all of them on average,
+        waited to be committed, are returned.
+        """
+        applier = self._factory.applier
+        if applier is not None:
+            return applier.stats()
+
     def registerDB(self, db, limit=None):
         self._factory.db = db
 
@@ -304,4 +752,8 @@ class Secondary(zc.zrs.primary.Base):
         event = threading.Event()
         self._reactor.callFromThread(self._factory.close, event.set)
         event.wait()
+        if self._factory.applier is not None:
+            self._factory.applier.close()
+        if self._factory.group_sync is not None:
+            self._factory.group_sync.close()
         self._storage.close()
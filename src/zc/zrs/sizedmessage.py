@@ -29,41 +29,66 @@ class LimitExceeded(Exception):
     """
 
 class Stream:
+    """Split a byte stream into sized messages
+
+    Input is parsed in place through memoryviews.  A message that lies
+    entirely within one chunk of input is copied out of it once (or
+    not at all, if it is the whole chunk).  A message split across
+    chunks is collected as a list of views and joined once, when it's
+    complete, so nothing is re-joined or re-sliced while we wait for
+    the rest of it.
+    """
 
     def __init__(self, callback, limit = 1 << 32):
         self._callback = callback
         self.limit = limit
-        self.data = []
-        self.size = 0
-        self.length = 0
+        self.data = []   # views of a partial header or message
+        self.size = 0    # number of bytes in data
+        self.length = 0  # length of the message being collected, if any
 
     def __call__(self, data):
-        self.data.append(data)
-        self.size += len(data)
-        while 1:
+        view = memoryview(data)
+        pos = 0
+        end = len(view)
+        while pos < end:
             if self.length:
-                if self.size < self.length:
+                need = self.length - self.size
+                if end - pos < need:
+                    self.data.append(view[pos:])
+                    self.size += end - pos
                     return
 
-                data = b''.join(self.data)
-                result = data[:self.length]
-                data = data[self.length:]
-                self.data = [data]
-                self.size = len(data)
+                if self.data:
+                    self.data.append(view[pos:pos+need])
+                    result = b''.join(self.data)
+                    self.data = []
+                    self.size = 0
+                elif pos == 0 and need == end and isinstance(data, bytes):
+                    result = data
+                else:
+                    result = view[pos:pos+need].tobytes()
+                pos += need
                 self.length = 0
                 self._callback(result)
+                continue
 
-            if self.size < 4:
+            need = 4 - self.size
+            if end - pos < need:
+                self.data.append(view[pos:])
+                self.size += end - pos
                 return
 
-            if len(self.data[0]) < 4:
-                self.data = [b''.join(self.data)]
+            if self.data:
+                self.data.append(view[pos:pos+need])
+                header = b''.join(self.data)
+                self.data = []
+                self.size = 0
+            else:
+                header = view[pos:pos+4]
+            pos += need
 
-            self.length, = struct.unpack(">I", self.data[0][:4])
-            self.data[0] = self.data[0][4:]
-            self.size -= 4
+            self.length, = struct.unpack_from(">I", header)
             if self.length == 0:
                 self._callback(b'')
             elif self.length > self.limit:
                 raise LimitExceeded(self.limit, long(self.length))
-
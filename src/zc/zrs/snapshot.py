@@ -0,0 +1,466 @@
+##############################################################################
+#
+# Copyright (c) 2013 Zope Corporation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Snapshot bootstrap
+
+An empty secondary can ask to be sent a snapshot of the primary's
+file storage, rather than every transaction since the beginning of
+time.  A snapshot is the prefix of the primary's storage file up to
+its last transaction when the snapshot was taken, the storage's
+index as of that transaction, and, if the primary has blobs, the
+blob files written up to then.  The secondary installs the
+snapshot, as a pack would, and then replicates transactions after
+it as usual.
+
+A snapshot is sent as a sequence of file blocks, each committed
+separately.  The secondary stages what it's received next to its
+storage file, and remembers how far it got, so that, if it's
+disconnected, it can ask for the rest of the snapshot.  The primary
+resumes a snapshot if the file prefix hasn't changed, as it does
+when the primary is packed, and starts a new one otherwise.
+
+Snapshots are offered and resumed with bootstrap specifications.
+``snapshot`` asks for a new snapshot, and::
+
+  snapshot:TID:SIZE:POS[:BLOB]
+
+asks for the rest of the snapshot of the SIZE-byte file prefix
+ending with transaction TID, starting at file position POS and, if
+given, after the blob with the hex key BLOB, which is its oid
+followed by its transaction id.
+"""
+
+import binascii
+import BTrees.OOBTree
+import logging
+import os
+import tempfile
+import ZODB.blob
+import ZODB.FileStorage
+import ZODB.fsIndex
+import ZODB.TimeStamp
+import ZODB.utils
+import zc.zrs.primary
+
+logger = logging.getLogger(__name__)
+
+# File data are committed in blocks of at most this size.
+block_size = 1 << 24
+
+z64 = ZODB.utils.z64
+
+def file_storage(storage):
+    """Return the file storage for a storage, or None
+
+    A primary wrapping a file storage is itself replaced.
+    """
+    if isinstance(storage, zc.zrs.primary.Primary):
+        storage = storage._storage
+    if isinstance(storage, ZODB.FileStorage.FileStorage):
+        return storage
+    return None
+
+def format_spec(tid, size, pos, blob_key=None):
+    spec = 'snapshot:%s:%d:%d' % (
+        binascii.hexlify(tid).decode('ascii'), size, pos)
+    if blob_key:
+        spec += ':' + binascii.hexlify(blob_key).decode('ascii')
+    return spec
+
+def parse_spec(spec):
+    """Parse a bootstrap specification
+
+    None is returned for a new snapshot, and (tid, size, pos, blob_key)
+    for the rest of one.  ValueError is raised if the specification
+    is invalid.
+    """
+    parts = spec.split(':')
+    if parts[0] != 'snapshot' or len(parts) not in (1, 4, 5):
+        raise ValueError("Invalid bootstrap specification", spec)
+    if len(parts) == 1:
+        return None
+    try:
+        tid = binascii.unhexlify(parts[1])
+        size = int(parts[2])
+        pos = int(parts[3])
+        blob_key = binascii.unhexlify(parts[4]) if len(parts) > 4 else None
+    except (TypeError, ValueError, binascii.Error):
+        raise ValueError("Invalid bootstrap specification", spec)
+    if (len(tid) != 8 or not 0 <= pos <= size
+        or (blob_key is not None and (len(blob_key) != 16 or pos < size))):
+        raise ValueError("Invalid bootstrap specification", spec)
+    return tid, size, pos, blob_key
+
+def copy_index(index):
+    """Return a copy of a file-storage index
+
+    The buckets are copied through their string forms, which is done
+    in C, and is much quicker than saving the index.
+    """
+    result = ZODB.fsIndex.fsIndex()
+    result._data = BTrees.OOBTree.OOBTree([
+        (prefix, ZODB.fsIndex.fsBucket().fromString(bucket.toString()))
+        for (prefix, bucket) in index._data.items()
+        ])
+    return result
+
+def index_prefix(fs):
+    # The prefix of the names of the indexes of snapshots being sent,
+    # which are saved next to the storage file.
+    return '.%s.snapshot' % os.path.basename(fs._file_name)
+
+def remove_stale_indexes(fs):
+    """Remove snapshot indexes left behind by a process that crashed
+    """
+    dirname = os.path.dirname(os.path.abspath(fs._file_name))
+    prefix = index_prefix(fs)
+    for name in os.listdir(dirname):
+        if name.startswith(prefix) and name.endswith('.index'):
+            path = os.path.join(dirname, name)
+            logger.info("Removing stale snapshot index %s", path)
+            try:
+                os.remove(path)
+            except OSError:
+                pass # Someone else got to it
+
+def blob_files(fshelper, tid):
+    """Return the keys and paths of the blob files written up to tid
+
+    Keys are blob oids followed by blob tids, and are sorted.
+    """
+    files = []
+    for oid, path in fshelper.listOIDs():
+        for name in os.listdir(path):
+            if not name.endswith(ZODB.blob.BLOB_SUFFIX):
+                continue
+            blob_path = os.path.join(path, name)
+            blob_oid, blob_tid = fshelper.splitBlobFilename(blob_path)
+            if blob_tid is not None and blob_tid <= tid:
+                files.append((blob_oid + blob_tid, blob_path))
+    files.sort()
+    return files
+
+def _chunks(file, pos, size, chunk_size):
+    # Read size bytes from pos in chunks.
+    end = pos + size
+    while pos < end:
+        file.seek(pos)
+        data = file.read(min(chunk_size, end - pos))
+        if not data:
+            raise ValueError("Snapshot file ended early", file.name, pos)
+        pos += len(data)
+        yield data
+
+class Snapshot:
+    """A snapshot being sent by a primary
+
+    A new snapshot is taken, unless the spec asks for the rest of a
+    snapshot that's still valid.  The tid is None if the storage is
+    empty, in which case there's nothing to send.
+    """
+
+    tid = None
+    file = index_path = None
+
+    def __init__(self, fs, spec, io_policy=None):
+        self.fs = fs
+        try:
+            resume = parse_spec(spec)
+        except ValueError:
+            logger.warning("Ignoring invalid bootstrap specification %r",
+                           spec)
+            resume = None
+
+        index = None
+        with fs._lock:
+            if resume is not None and self._valid(*resume):
+                self.tid, self.size, self.pos, self.blob_key = resume
+            elif fs._ltid != z64:
+                self.tid = fs._ltid
+                self.size = fs._pos
+                self.pos = 0
+                self.blob_key = None
+                # The index has to match the file prefix, so we copy
+                # it while we hold the lock, and save the copy after.
+                index = copy_index(fs._index)
+            else:
+                return
+
+            # Open the file while we hold the lock, so we get the
+            # file we checked, even if a pack replaces it.
+            if io_policy is not None:
+                self.file = io_policy.open(fs._file_name)
+            else:
+                self.file = open(fs._file_name, 'rb', 0)
+
+        self.blobs = bool(getattr(fs, 'blob_dir', None))
+
+        if index is not None:
+            fd, self.index_path = tempfile.mkstemp(
+                '.index', index_prefix(fs),
+                os.path.dirname(os.path.abspath(fs._file_name)))
+            os.close(fd)
+            index.save(self.size, self.index_path)
+
+    def _valid(self, tid, size, pos, blob_key):
+        # Check whether the storage file still ends a transaction with
+        # the given id at size.  Called with the storage lock held.
+        file = self.fs._file
+        if size > self.fs._pos or size < 12:
+            return False
+        file.seek(size - 8)
+        tlen = ZODB.utils.u64(file.read(8))
+        if tlen + 8 > size - 4:
+            return False
+        file.seek(size - 8 - tlen)
+        return file.read(8) == tid
+
+    def blocks(self, encoder, chunk_size):
+        """Generate the snapshot's file blocks
+
+        Each block is a header message and an iterable of data
+        messages.
+        """
+        yield encoder.file_block('start', self.tid, self.pos, self.size), ()
+
+        if self.index_path is not None:
+            size = os.path.getsize(self.index_path)
+            with open(self.index_path, 'rb') as f:
+                yield (encoder.file_block('index', b'', 0, size),
+                       _chunks(f, 0, size, chunk_size))
+
+        pos = self.pos
+        while pos < self.size:
+            size = min(block_size, self.size - pos)
+            yield (encoder.file_block('data', b'', pos, size),
+                   _chunks(self.file, pos, size, chunk_size))
+            pos += size
+
+        if self.blobs:
+            for key, path in blob_files(self.fs.fshelper, self.tid):
+                if self.blob_key is not None and key <= self.blob_key:
+                    continue
+                try:
+                    f = open(path, 'rb')
+                except (IOError, OSError):
+                    # Removed by a pack
+                    logger.warning("Skipping missing blob file %s", path)
+                    continue
+                with f:
+                    size = os.fstat(f.fileno()).st_size
+                    yield (encoder.file_block('blob', key, 0, size),
+                           _chunks(f, 0, size, chunk_size))
+
+        yield encoder.file_block('end', self.tid, 0, self.size), ()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.index_path is not None:
+            os.remove(self.index_path)
+            self.index_path = None
+
+class Staging:
+    """A snapshot being received by a secondary
+
+    Data are staged in files next to the storage file, with the
+    progress made so far, as a bootstrap specification, in a state
+    file.
+    """
+
+    state = None
+    kind = None
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.fs = fs = file_storage(storage)
+        self.path = fs._file_name + '.snapshot'
+        self.index_path = self.path + '.index'
+        self.state_path = self.path + '.state'
+        try:
+            with open(self.state_path) as f:
+                self.state = parse_spec(f.read().strip())
+        except (IOError, OSError):
+            pass
+        except ValueError:
+            logger.warning("Ignoring invalid %s", self.state_path)
+
+    def offer(self):
+        """Return the bootstrap specification to offer, if any
+        """
+        if self.fs.lastTransaction() != z64:
+            return None
+        if self.state is None:
+            return 'snapshot'
+        return format_spec(*self.state)
+
+    def _save_state(self):
+        tmp = self.state_path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(format_spec(*self.state))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.state_path)
+
+    def begin(self, kind, key, pos, size):
+        """Begin receiving a file block
+        """
+        if self.kind is not None:
+            raise ValueError("Unfinished snapshot block", self.kind)
+        if kind == 'start':
+            if pos == 0:
+                # A new snapshot.  The state is saved once we have
+                # its index.
+                self._remove(self.state_path, self.index_path, self.path)
+                self.state = key, size, 0, None
+            elif self.state is None or self.state[:3] != (key, size, pos):
+                raise ValueError("Unexpected snapshot", key, size, pos)
+        elif self.state is None:
+            raise ValueError("Snapshot block before start", kind)
+        elif kind == 'index':
+            self.file = open(self.index_path + '.tmp', 'wb')
+        elif kind == 'data':
+            if pos != self.state[2] or pos + size > self.state[1]:
+                raise ValueError("Unexpected snapshot data", pos, size)
+            if os.path.exists(self.path):
+                self.file = open(self.path, 'r+b')
+            else:
+                self.file = open(self.path, 'w+b')
+            # Drop anything written after what was committed.
+            self.file.truncate(pos)
+            self.file.seek(pos)
+        elif kind == 'blob':
+            if not getattr(self.fs, 'blob_dir', None):
+                raise ValueError("Can't store snapshot blobs")
+            fshelper = self.fs.fshelper
+            oid, tid = key[:8], key[8:]
+            fshelper.createPathForOID(oid)
+            self.blob_path = fshelper.getBlobFilename(oid, tid)
+            self.file = open(self.blob_path + '.tmp', 'wb')
+        elif kind == 'end':
+            if key != self.state[0] or self.state[2] != self.state[1]:
+                raise ValueError("Incomplete snapshot")
+        else:
+            raise ValueError("Invalid snapshot block", kind)
+        self.kind = kind
+        self.key = key
+        self.remaining = size if kind in ('index', 'data', 'blob') else 0
+
+    def write(self, data):
+        """Write data for the current block
+        """
+        if len(data) > self.remaining:
+            raise ValueError("Too much snapshot data")
+        self.remaining -= len(data)
+        self.file.write(data)
+
+    @property
+    def collecting(self):
+        return self.kind is not None and self.remaining > 0
+
+    def commit(self, db=None):
+        """Commit the current block, once its checksum has been checked
+        """
+        kind = self.kind
+        if kind is None or self.remaining:
+            raise ValueError("Incomplete snapshot block", kind)
+        self.kind = None
+        tid, size, pos, blob_key = self.state
+        if kind == 'index':
+            self._close_file()
+            os.rename(self.index_path + '.tmp', self.index_path)
+            self._save_state()
+        elif kind == 'data':
+            pos = self.file.tell()
+            self._close_file()
+            self.state = tid, size, pos, None
+            self._save_state()
+        elif kind == 'blob':
+            self._close_file()
+            os.rename(self.blob_path + '.tmp', self.blob_path)
+            self.state = tid, size, pos, self.key
+            self._save_state()
+        elif kind == 'end':
+            self.install(db)
+
+    def abort(self):
+        """Discard the current block
+        """
+        if self.kind is not None:
+            kind = self.kind
+            self.kind = None
+            if self.file is not None:
+                name = self.file.name
+                self.file.close()
+                self.file = None
+                if kind in ('index', 'blob'):
+                    self._remove(name)
+
+    file = None
+    def _close_file(self):
+        file = self.file
+        self.file = None
+        file.flush()
+        os.fsync(file.fileno())
+        file.close()
+
+    def _remove(self, *paths):
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def install(self, db=None):
+        """Replace the storage's file and index with the snapshot's
+        """
+        tid, size = self.state[:2]
+        fs = self.fs
+        info = ZODB.fsIndex.fsIndex.load(self.index_path)
+        if info['pos'] != size:
+            raise ValueError("Snapshot index doesn't match its data")
+        index = info['index']
+        with open(self.path, 'rb') as f:
+            f.seek(size - 8)
+            f.seek(size - 8 - ZODB.utils.u64(f.read(8)))
+            if f.read(8) != tid:
+                raise ValueError("Snapshot data don't end with", tid)
+
+        with fs._files.write_lock():
+            with fs._lock:
+                if fs._ltid != z64:
+                    raise ValueError("Can't install a snapshot in a"
+                                     " non-empty storage")
+                fs._files.empty()
+                fs._file.close()
+                os.rename(self.path, fs._file_name)
+                fs._file = open(fs._file_name, 'r+b')
+                fs._initIndex(index, {})
+                fs._pos = size
+                fs._oid = index.maxKey() if len(index) else z64
+                fs._ltid = tid
+                fs._ts = ZODB.TimeStamp.TimeStamp(tid)
+                fs._save_index()
+
+        self._remove(self.index_path, self.state_path)
+        self.state = None
+        logger.info("Installed snapshot of %s at %s",
+                    fs.getName(), ZODB.utils.tid_repr(tid))
+
+        if db is not None:
+            db.invalidateCache()
+        if isinstance(self.storage, zc.zrs.primary.Primary):
+            # Let our own secondaries know.  Their iterators reopen
+            # the file.
+            changed = self.storage._changed
+            changed.committed()
+            self.storage._reactor.callFromThread(changed.notify_waiters)
@@ -51,10 +51,13 @@ import twisted.internet.error
 import twisted.python.failure
 import unittest
 import warnings
+import zc.zrs.fileio
+import zc.zrs.messages
 import zc.zrs.primary
 import zc.zrs.reactor
 import zc.zrs.secondary
 import zc.zrs.sizedmessage
+import zc.zrs.tidindex
 
 
 warnings.simplefilter('ignore', ResourceWarning)
@@ -146,13 +149,13 @@ Now, we'll create a special transport that will output data when it is called:
     >>> class Transport:
     ...     def __init__(self):
     ...         self.reactor = Reactor()
-    ...     def writeSequence(self, message):
-    ...         message = message[1] # cheat. :)
-    ...         if message:
-    ...             message = cPickle.loads(message)
-    ...             if type(message) is tuple:
-    ...                 message = message[0]
-    ...         print(message)
+    ...     def writeSequence(self, data):
+    ...         for message in data[1::2]: # cheat. :)
+    ...             if message:
+    ...                 message = cPickle.loads(message)
+    ...                 if type(message) is tuple:
+    ...                     message = message[0]
+    ...             print(message)
     ...     def registerProducer(self, producer, streaming):
     ...         print('registered producer')
     ...     def unregisterProducer(self):
@@ -235,7 +238,7 @@ and resume:
     <class 'persistent.mapping.PersistentMapping'>
     C
 
-    >>> producer.close(); producer.thread.join()
+    >>> producer.close(); producer.task.join()
     unregistered producer
     loseConnection
 
@@ -243,6 +246,365 @@ and resume:
 
 """
 
+def primary_read_ahead():
+    """
+Producers catching up can read ahead of what they send.  A reader
+task reads and encodes transactions, and queues their messages, while
+the producer sends them:
+
+    >>> import logging
+    >>> logging.getLogger('zc.zrs').setLevel(logging.WARNING)
+
+    >>> class Reactor:
+    ...     def callFromThread(self, f, *args, **kw):
+    ...         f(*args, **kw)
+
+    >>> class Transport:
+    ...     def __init__(self):
+    ...         self.reactor = Reactor()
+    ...     def writeSequence(self, data):
+    ...         messages = [cPickle.loads(message) for message in data[1::2]]
+    ...         print(' '.join(message[0] for message in messages
+    ...                        if type(message) is tuple))
+    ...     def registerProducer(self, producer, streaming):
+    ...         pass
+    ...     def unregisterProducer(self):
+    ...         pass
+    ...     def loseConnection(self):
+    ...         print('loseConnection')
+
+    >>> fs = ZODB.FileStorage.FileStorage('Data.fs')
+    >>> db = ZODB.DB(fs)
+    >>> conn = db.open()
+    >>> producer = zc.zrs.primary.PrimaryProducer(
+    ...            (fs, None, ZODB.utils.z64), Transport(), 'test',
+    ...            read_ahead_size=1000); time.sleep(0.1)
+    T S C
+
+    >>> def wait_for(cond):
+    ...     for i in range(100):
+    ...         if cond():
+    ...             return
+    ...         time.sleep(0.01)
+    ...     print('timed out')
+
+While the connection is paused, the next transaction waits to be
+sent, and later ones are read:
+
+    >>> producer.pauseProducing()
+    >>> def commit_some(n):
+    ...     for i in range(n):
+    ...         conn.root()[i] = i
+    ...         commit()
+    ...         producer.iterator.notify()
+    >>> commit_some(1)
+    >>> time.sleep(0.1)
+    >>> commit_some(2)
+    >>> wait_for(lambda : producer.read_ahead_stats()['queued'] == 567)
+    >>> producer.read_ahead.full()
+    False
+
+The reader stops reading when the queue is full:
+
+    >>> commit_some(4)
+    >>> wait_for(lambda : producer.read_ahead.full())
+    >>> stats = producer.read_ahead_stats()
+    >>> stats['queued']
+    1063
+
+
+The time each stage spends in each of its states is recorded, as
+shares of the time since it started catching up:
+
+    >>> sorted(stats['reader']), sorted(stats['sender'])
+    (['blocked', 'idle', 'reading'], ['busy', 'sending', 'starved'])
+    >>> 0 < sum(stats['reader'].values()) <= 1
+    True
+    >>> stats['reader']['blocked'] > 0, stats['sender']['sending'] > 0
+    (True, True)
+
+When the connection resumes, everything is sent, in order:
+
+    >>> producer.resumeProducing(); time.sleep(0.1)
+    T S C
+    T S C T S C T S C T S C T S C T S C
+    >>> producer.last_tid == fs.lastTransaction()
+    True
+    >>> producer.read_ahead_stats()['queued']
+    0
+
+Primaries report read-ahead statistics for secondaries catching up:
+
+    >>> producer.close(); producer.task.join()
+    loseConnection
+    >>> producer.read_ahead_stats()
+
+    >>> ps = zc.zrs.primary.Primary(
+    ...     fs, ('', 8000), reactor, read_ahead_queue_size=1 << 20)
+    >>> connection = reactor.connect(('', 8000))
+    >>> connection.send(b"zrs2.0")
+    >>> connection.send(b"\\0"*8)
+    >>> tids = [trans.tid for trans in fs.iterator()]
+    >>> def read_transaction(connection):
+    ...     tid = connection.read()[1][0]
+    ...     while connection.read()[0] != 'C':
+    ...         pass
+    ...     return tid
+    >>> [read_transaction(connection) for tid in tids] == tids
+    True
+    >>> [sorted(stats) for stats in ps.getReadAheadStats().values()]
+    [['items', 'queued', 'reader', 'sender']]
+
+    >>> connection.close()
+    >>> ps.close()
+    """
+
+def primary_batches_writes():
+    """
+The primary producer collects messages for the transactions it has
+available and hands them to the reactor in a single writeSequence call.
+
+    >>> import ZODB.FileStorage
+    >>> fs = ZODB.FileStorage.FileStorage('Data.fs')
+    >>> from ZODB.DB import DB
+    >>> db = DB(fs)
+    >>> conn = db.open()
+    >>> for i in range(3):
+    ...     conn.root()[i] = i
+    ...     commit()
+
+    >>> class Reactor:
+    ...     def callFromThread(self, f, *args, **kw):
+    ...         f(*args, **kw)
+
+    >>> class Transport:
+    ...     def __init__(self):
+    ...         self.reactor = Reactor()
+    ...         self.writes = []
+    ...     def writeSequence(self, data):
+    ...         self.writes.append(data)
+    ...     def registerProducer(self, producer, streaming):
+    ...         pass
+    ...     def unregisterProducer(self):
+    ...         pass
+    ...     def loseConnection(self):
+    ...         pass
+
+    >>> import time
+    >>> transport = Transport()
+    >>> producer = zc.zrs.primary.PrimaryProducer(
+    ...            (fs, None, ZODB.utils.z64), transport, 'test'
+    ...            ); time.sleep(0.1)
+
+We got all 4 transactions, 4 messages each, in one write:
+
+    >>> [len(data) // 2 for data in transport.writes]
+    [16]
+
+    >>> producer.close(); producer.task.join()
+
+Batches are also bounded by size:
+
+    >>> class SmallBatchProducer(zc.zrs.primary.PrimaryProducer):
+    ...     batch_size = 100
+    >>> transport = Transport()
+    >>> producer = SmallBatchProducer(
+    ...            (fs, None, ZODB.utils.z64), transport, 'test'
+    ...            ); time.sleep(0.1)
+    >>> len(transport.writes) > 1
+    True
+    >>> producer.close(); producer.task.join()
+
+    >>> db.close()
+"""
+
+def primary_flow_control():
+    """
+Data handed to the reactor, but not yet written, counts against a
+high watermark.  When it's reached, the producer stops sending until
+the amount falls to the low watermark:
+
+    >>> import logging
+    >>> logging.getLogger('zc.zrs').setLevel(logging.INFO)
+
+    >>> import ZODB.FileStorage
+    >>> fs = ZODB.FileStorage.FileStorage('Data.fs')
+    >>> from ZODB.DB import DB
+    >>> db = DB(fs)
+    >>> conn = db.open()
+    >>> for i in range(20):
+    ...     conn.root()[i] = 'x' * 1000
+    ...     commit()
+
+We'll use a reactor that queues calls until we run them:
+
+    >>> class Reactor:
+    ...     def __init__(self):
+    ...         self.calls = []
+    ...     def callFromThread(self, f, *args):
+    ...         self.calls.append((f, args))
+    ...     def run(self):
+    ...         calls = self.calls
+    ...         self.calls = []
+    ...         for f, args in calls:
+    ...             f(*args)
+
+    >>> class Transport:
+    ...     def __init__(self):
+    ...         self.reactor = Reactor()
+    ...         self.written = 0
+    ...     def writeSequence(self, data):
+    ...         self.written += sum(map(len, data))
+    ...     def registerProducer(self, producer, streaming):
+    ...         self.producer = producer
+    ...     def unregisterProducer(self):
+    ...         print('unregistered producer')
+    ...     def loseConnection(self):
+    ...         print('loseConnection')
+
+    >>> class SmallBatchProducer(zc.zrs.primary.PrimaryProducer):
+    ...     batch_size = 100
+
+    >>> transport = Transport()
+    >>> producer = SmallBatchProducer(
+    ...            (fs, None, ZODB.utils.z64), transport, 'test',
+    ...            high_watermark=5000, low_watermark=2000,
+    ...            ); time.sleep(0.1)
+
+    >>> producer.throttled, 5000 <= producer.in_flight < 7000
+    (True, True)
+    >>> in_flight = producer.in_flight
+    >>> time.sleep(0.1)
+    >>> producer.in_flight == in_flight
+    True
+
+Once the reactor writes the data, the producer resumes:
+
+    >>> while producer.in_flight:
+    ...     transport.reactor.run()
+    ...     time.sleep(0.01)
+    >>> transport.written > 20000
+    True
+    >>> producer.throttled
+    False
+
+    >>> producer.close(); producer.task.join(); transport.reactor.run()
+    unregistered producer
+    loseConnection
+
+Data written while the transport is paused is buffered in the
+transport, and also counts.  If too much data is in flight, the
+secondary isn't keeping up, and it's disconnected:
+
+    >>> class PausingTransport(Transport):
+    ...     def writeSequence(self, data):
+    ...         Transport.writeSequence(self, data)
+    ...         self.producer.pauseProducing()
+
+    >>> transport = PausingTransport()
+    >>> producer = SmallBatchProducer(
+    ...            (fs, None, ZODB.utils.z64), transport, 'test',
+    ...            max_in_flight=5000,
+    ...            ); time.sleep(0.1)
+    >>> transport.reactor.run() # doctest: +ELLIPSIS
+    ERROR zc.zrs.primary:
+    test too much data in flight (... bytes). Disconnecting.
+    unregistered producer
+    loseConnection
+
+    >>> producer.task.join(); transport.reactor.run()
+    >>> producer.stopped
+    True
+
+    >>> db.close()
+"""
+
+def primary_rate_limits():
+    """
+Token buckets limit rates, in bytes per second.  A bucket holds a
+second's worth of data. Senders take what they send, possibly going
+into debt, and then have to wait:
+
+    >>> import zc.zrs.ratelimit
+    >>> bucket = zc.zrs.ratelimit.TokenBucket(1000)
+    >>> bucket.delay()
+    0
+    >>> bucket.take(1500)
+    >>> 0.4 < bucket.delay() <= 0.5
+    True
+    >>> bucket.set_rate(None)
+    >>> bucket.delay()
+    0
+
+A producer's catch-up data are limited by its own bucket, and by a
+bucket shared with other producers, if it's given one:
+
+    >>> import logging
+    >>> logging.getLogger('zc.zrs').setLevel(logging.INFO)
+
+    >>> import ZODB.FileStorage
+    >>> fs = ZODB.FileStorage.FileStorage('Data.fs')
+    >>> from ZODB.DB import DB
+    >>> db = DB(fs)
+    >>> conn = db.open()
+    >>> for i in range(100):
+    ...     conn.root()[i] = 'x' * 1000
+    ...     commit()
+
+    >>> class Reactor:
+    ...     def callFromThread(self, f, *args):
+    ...         f(*args)
+
+    >>> class Transport:
+    ...     def __init__(self):
+    ...         self.reactor = Reactor()
+    ...         self.written = 0
+    ...     def writeSequence(self, data):
+    ...         self.written += sum(map(len, data))
+    ...     def registerProducer(self, producer, streaming):
+    ...         pass
+    ...     def unregisterProducer(self):
+    ...         pass
+    ...     def loseConnection(self):
+    ...         pass
+
+    >>> class SmallBatchProducer(zc.zrs.primary.PrimaryProducer):
+    ...     batch_size = 1000
+
+    >>> total = zc.zrs.ratelimit.TokenBucket(40000)
+    >>> transport = Transport()
+    >>> producer = SmallBatchProducer(
+    ...            (fs, None, ZODB.utils.z64), transport, 'test',
+    ...            rate_limit=1000000, total_bucket=total,
+    ...            ); time.sleep(0.2)
+
+We got the first second's worth of data right away, and then have to
+wait:
+
+    >>> 40000 < transport.written < 60000
+    True
+
+Limits can be changed while producers are running:
+
+    >>> total.set_rate(None)
+    >>> producer.set_rate_limit(None); time.sleep(0.1)
+    >>> transport.written > 100000
+    True
+
+Once a secondary has caught up, new transactions aren't limited:
+
+    >>> producer.set_rate_limit(1)
+    >>> producer.bucket.take(1000000)
+    >>> written = transport.written
+    >>> conn.root()['x'] = 'x' * 10000
+    >>> commit(); producer.iterator.notify(); time.sleep(0.1)
+    >>> transport.written - written > 10000
+    True
+
+    >>> producer.close(); producer.task.join()
+    >>> db.close()
+"""
+
 def secondary_close_edge_cases():
     r"""
 There a number of cases to consider when closing a secondary:
@@ -412,6 +774,40 @@ There a number of cases to consider when closing a secondary:
 
 """
 
+def sizedmessage_stream():
+    r"""
+    A stream splits incoming data into sized messages, regardless of
+    how the data are chunked:
+
+    >>> messages = []
+    >>> stream = zc.zrs.sizedmessage.Stream(messages.append)
+    >>> data = b''.join(map(zc.zrs.sizedmessage.marshal,
+    ...                     [b'a', b'', b'bcd', b'x'*1000, b'ef']))
+
+    >>> for i in range(0, len(data), 3):
+    ...     stream(data[i:i+3])
+    >>> [len(m) for m in messages]
+    [1, 0, 3, 1000, 2]
+
+    >>> del messages[:]
+    >>> stream(data)
+    >>> [len(m) for m in messages]
+    [1, 0, 3, 1000, 2]
+
+    Messages are always delivered as bytes:
+
+    >>> set(type(m) for m in messages) == set([bytes])
+    True
+
+    A message longer than the limit is an error:
+
+    >>> stream = zc.zrs.sizedmessage.Stream(messages.append, 8)
+    >>> stream(zc.zrs.sizedmessage.marshal(b'x'*9))
+    Traceback (most recent call last):
+    ...
+    LimitExceeded: (8, 9)
+    """
+
 def primary_data_input_errors():
     r"""
     There is no good reason for a primary to get a data input error. If
@@ -654,238 +1050,3263 @@ def leaking_file_handles_when_secondaries_disconnect():
     >>> sys.getrefcount(zc.zrs.primary.FileStorageIterator) == oldrc
     True
 
-    >>> db.close() # doctest: +ELLIPSIS
-    INFO ...
+    >>> db.close() # doctest: +ELLIPSIS
+    INFO ...
+
+    """
+
+def close_writes_new_transactions():
+    r"""
+    We want close to try to write pending transactions, even if it
+    means that close will take a long time.
+
+    >>> import ZODB.FileStorage, zc.zrs.primary, persistent.dict
+    >>> fs = ZODB.FileStorage.FileStorage('Data.fs')
+    >>> ps = zc.zrs.primary.Primary(fs, ('', 8000), reactor)
+    INFO zc.zrs.primary:
+    Opening Data.fs ('', 8000)
+
+    >>> db = ZODB.DB(ps)
+    >>> conn = db.open()
+    >>> ob = conn.root()
+    >>> ob.x = 0
+    >>> commit()
+
+    >>> committed = 2
+
+    We'll open lots of connections: :)
+
+    >>> nconnections = 10
+    >>> connections = []
+    >>> for i in range(nconnections):
+    ...     connection = reactor.connect(('', 8000))
+    ...     connection.send(b"zrs2.0")
+    ...     connection.send(b"\0"*8)
+    ...     connections.append(connection)
+    ...     # doctest: +ELLIPSIS
+    INFO zc.zrs.primary:...
+
+    >>> import time
+    >>> time.sleep(.1)
+
+    >>> for i in range(300):
+    ...     ob[i] = persistent.dict.PersistentDict()
+
+    >>> commit()
+    >>> committed += 1
+
+    >>> db.close()
+    ...     # doctest: +ELLIPSIS
+    INFO zc.zrs.primary:...
+
+    >>> for i in range(nconnections):
+    ...     connection = connections[i]
+    ...     trans = message_type = x = None
+    ...     ntrans = 0
+    ...     while connection.have_data():
+    ...         message_type, data = connection.read()
+    ...         if message_type == 'T':
+    ...             trans = data
+    ...             ntrans += 1
+    ...         elif message_type == 'S':
+    ...             x = connection.read(True)
+    ...     if message_type != 'C' or ntrans != committed:
+    ...         print(i, message_type, ntrans)
+
+    """
+
+def secondary_gives_a_tid_that_is_too_high():
+    r"""
+    We should error and close the connection if a secondary presents a
+    tid that is higher than the largest tid seen by the primary.
+
+    >>> import ZODB.FileStorage
+    >>> fs = ZODB.FileStorage.FileStorage('Data.fs')
+    >>> import zc.zrs.primary
+    >>> ps = zc.zrs.primary.Primary(fs, ('', 8000), reactor)
+    INFO zc.zrs.primary:
+    Opening Data.fs ('', 8000)
+
+    >>> from ZODB.DB import DB
+    >>> import persistent.dict
+    >>> db = DB(ps)
+    >>> conn = db.open()
+    >>> ob = conn.root()
+    >>> ob.x = persistent.dict.PersistentDict()
+    >>> commit()
+
+    >>> import ZODB.utils
+    >>> too_high_tid = ZODB.utils.p64(ZODB.utils.u64(ob._p_serial)+1)
+
+    >>> connection = reactor.connect(('', 8000))
+    INFO zc.zrs.primary:
+    IPv4Address(TCP, '127.0.0.1', 47245): Connected
+
+    >>> connection.send(b"zrs2.0") # doctest: +NORMALIZE_WHITESPACE
+    >>> connection.send(too_high_tid); time.sleep(.01) # wait for thread :(
+    ... # doctest: +NORMALIZE_WHITESPACE +ELLIPSIS
+    INFO zc.zrs.primary:
+    IPv4Address(TCP, '127.0.0.1', 47245):
+    start b'\x03lk\x90\xf7wwx' (2007-03-21 20:32:58.000000)
+    ERROR zc.zrs.primary:
+    IPv4Address(TCP, '127.0.0.1', 47245):
+    Traceback (most recent call last):
+    ...
+    zc.zrs.primary.TidTooHigh: b'\x03lk\x90\xf7wwx'
+    INFO zc.zrs.primary:
+    IPv4Address(TCP, '127.0.0.1', 47245):
+    Disconnected
+    <twisted.python.failure.Failure
+      twisted.internet.error.ConnectionDone: Connection was closed cleanly.>
+
+    """
+
+
+class FauxScanControl(object):
+    _v = True
+    _n = 0
+    def get(self):
+        self._n += 1
+        if self._n > 10:
+            time.sleep(.01)
+        if self._n > 20:
+           print(self._n)
+        return self._v
+    def set(self, v):
+        self._v = v
+    not_stopped = property(get, set)
+
+def scan_control_stops_scans_on_client_disconnects():
+    r"""
+    We want to be able to limit iterator scans if a client disconnects, for
+    example, to limit impact on the server if a large scan is required.
+
+    >>> fs = ZODB.FileStorage.FileStorage('Data.fs')
+    >>> import persistent.dict
+    >>> db = ZODB.DB(fs)
+    >>> conn = db.open()
+    >>> ob = conn.root()
+    >>> for i in range(100):
+    ...     ob[i] = persistent.dict.PersistentDict()
+    ...     commit()
+    >>> tid1 = ob._p_serial
+    >>> for i in range(100, 200):
+    ...     ob[i] = persistent.dict.PersistentDict()
+    ...     commit()
+    >>> tid2 = ob._p_serial
+    >>> for i in range(200, 300):
+    ...     ob[i] = persistent.dict.PersistentDict()
+    ...     commit()
+
+    >>> ps = zc.zrs.primary.Primary(fs, ('', 8000), reactor)
+    INFO zc.zrs.primary:
+    Opening Data.fs ('', 8000)
+
+    >>> import time
+    >>> ScanControl = zc.zrs.primary.ScanControl
+    >>> zc.zrs.primary.ScanControl = FauxScanControl
+
+    >>> connection = reactor.connect(('', 8000))
+    INFO zc.zrs.primary:
+    IPv4Address(TCP, '127.0.0.1', 47245): Connected
+
+    >>> connection.send(b"zrs2.0") # doctest: +NORMALIZE_WHITESPACE
+    >>> connection.send(tid1) # doctest: +NORMALIZE_WHITESPACE
+    INFO zc.zrs.primary:
+    IPv4Address(TCP, '127.0.0.1', 47245):
+    start b'\x03lk\x92\x9d\xdd\xdd\xdd' (2007-03-21 20:34:37.000000)
+    >>> connection.loseConnection() # doctest: +NORMALIZE_WHITESPACE
+    INFO zc.zrs.primary:
+    IPv4Address(TCP, '127.0.0.1', 47245): Disconnected
+    <twisted.python.failure.Failure
+      twisted.internet.error.ConnectionDone: Connection was closed cleanly.>
+
+
+    >>> connection = reactor.connect(('', 8000))
+    INFO zc.zrs.primary:
+    IPv4Address(TCP, '127.0.0.1', 47246): Connected
+
+    >>> connection.send(b"zrs2.0") # doctest: +NORMALIZE_WHITESPACE
+    >>> connection.send(tid2) # doctest: +NORMALIZE_WHITESPACE
+    INFO zc.zrs.primary:
+    IPv4Address(TCP, '127.0.0.1', 47246):
+    start b'\x03lk\x94H\x88\x88\x88' (2007-03-21 20:36:17.000000)
+
+    >>> connection.loseConnection() # doctest: +NORMALIZE_WHITESPACE
+    INFO zc.zrs.primary:
+    IPv4Address(TCP, '127.0.0.1', 47246): Disconnected
+    <twisted.python.failure.Failure
+      twisted.internet.error.ConnectionDone: Connection was closed cleanly.>
+
+    >>> time.sleep(.1)
+    >>> zc.zrs.primary.ScanControl = ScanControl
+    """
+
+def record_iternext():
+    """
+    >>> fs = ZODB.FileStorage.FileStorage('Data.fs')
+    >>> ps = zc.zrs.primary.Primary(fs, ('', 8000), reactor)
+    INFO zc.zrs.primary:
+    Opening Data.fs ('', 8000)
+    >>> ss = zc.zrs.secondary.Secondary(ps, ('', 9000), reactor)
+    INFO zc.zrs.secondary:
+    Opening Data.fs ('', 9000)
+    INFO zc.zrs.reactor:
+    Starting factory <zc.zrs.secondary.SecondaryFactory instance at 0xb654796c>
+
+    >>> ps.record_iternext == fs.record_iternext
+    True
+
+    >>> ss.record_iternext == fs.record_iternext
+    True
+
+    """
+
+def is_blob_record():
+    r"""
+    >>> fs = ZODB.FileStorage.FileStorage('Data.fs', blob_dir='blobs')
+    >>> db = ZODB.DB(fs)
+    >>> conn = db.open()
+    >>> conn.root()['blob'] = ZODB.blob.Blob()
+    >>> transaction.commit()
+    >>> zc.zrs.primary.is_blob_record(fs.load(ZODB.utils.p64(0), '')[0])
+    False
+    >>> zc.zrs.primary.is_blob_record(fs.load(ZODB.utils.p64(1), '')[0])
+    True
+
+    An invalid pickle yields a false value:
+
+    >>> zc.zrs.primary.is_blob_record("Hello world!")
+    False
+    >>> zc.zrs.primary.is_blob_record('c__main__\nC\nq\x01.')
+    False
+
+    Only the class pickle at the start of the record is examined,
+    without unpickling it.  It must be just a reference to the blob
+    class, in any pickle protocol:
+
+    >>> record = fs.load(ZODB.utils.p64(1), '')[0]
+    >>> zc.zrs.primary.is_blob_record(memoryview(record))
+    True
+    >>> for protocol in range(cPickle.HIGHEST_PROTOCOL + 1):
+    ...     for meta in (ZODB.blob.Blob, (ZODB.blob.Blob, None),
+    ...                  ZODB.blob.BlobFile, 'ZODB.blob.Blob'):
+    ...         data = cPickle.dumps(meta, protocol) + record
+    ...         if (zc.zrs.primary.is_blob_record(data)
+    ...             != (meta is ZODB.blob.Blob)):
+    ...             print(protocol, meta)
+
+    >>> zc.zrs.primary.is_blob_record(b'\x80\x09cZODB.blob\nBlob\nq\x00.')
+    False
+    >>> zc.zrs.primary.is_blob_record(b'cZODB.blob\nBlob\npx\n.')
+    False
+    >>> zc.zrs.primary.is_blob_record(b'\x80\x04\x8c\tZODB.blob\x8c\x04Bl')
+    False
+
+    Records transformed by an XformStorage aren't blob records:
+
+    >>> zc.zrs.primary.is_blob_record(b'.h' + binascii.b2a_hex(record))
+    False
+
+    >>> db.close()
+    """
+
+def primary_compression():
+    r"""
+    Secondaries can ask for compressed data by using a zrs3 protocol
+    and offering compression:
+
+    >>> fs = ZODB.FileStorage.FileStorage('Data.fs')
+    >>> ps = zc.zrs.primary.Primary(fs, ('', 8000), reactor)
+    INFO zc.zrs.primary:
+    Opening Data.fs ('', 8000)
+    >>> db = ZODB.DB(ps)
+    >>> conn = db.open()
+    >>> conn.root()['x'] = 'x' * 10000
+    >>> commit()
+
+    >>> connection = reactor.connect(('', 8000))
+    INFO zc.zrs.primary:
+    IPv4Address(TCP, '127.0.0.1', 47245): Connected
+
+    >>> connection.send(b"zrs3.0")
+    >>> connection.send(b"compress=snappy,zlib:9,lzma") # doctest: +ELLIPSIS
+    INFO zc.zrs.primary:
+    IPv4Address(TCP, '127.0.0.1', 47245): features {'compress': 'zlib:9'}
+
+    The primary chose the first codec it knows and tells us so:
+
+    >>> connection.read(True)
+    b'compress=zlib:9'
+
+    >>> connection.send(b"\0"*8) # doctest: +NORMALIZE_WHITESPACE
+    INFO zc.zrs.primary:
+    IPv4Address(TCP, '127.0.0.1', 47245):
+    start b'\x00\x00\x00\x00\x00\x00\x00\x00' (1900-01-01 00:00:00.000000)
+
+    Now, data are sent as compressed batches of sized messages.  Both
+    of the transactions we committed were available, so they were sent
+    in the same batch:
+
+    >>> import zlib
+    >>> decompress = zlib.decompressobj().decompress
+    >>> messages = []
+    >>> stream = zc.zrs.sizedmessage.Stream(messages.append)
+    >>> frame = connection.read(True)
+    >>> stream(decompress(frame))
+    >>> [cPickle.loads(messages[i])[0] for i in (0, 1, 3, 4, 5, 7)]
+    ['T', 'S', 'C', 'T', 'S', 'C']
+    >>> max(map(len, messages)) > 10000 > len(frame)
+    True
+
+    The checksum is computed from the uncompressed messages:
+
+    >>> checksum = md5(b"\0"*8)
+    >>> for m in messages[:-1]:
+    ...     checksum.update(m)
+    >>> cPickle.loads(messages[-1]) == ('C', (checksum.digest(), ))
+    True
+
+    Bad offers are rejected:
+
+    >>> connection = reactor.connect(('', 8000))
+    INFO zc.zrs.primary:
+    IPv4Address(TCP, '127.0.0.1', 47246): Connected
+    >>> connection.send(b"zrs3.0")
+    >>> connection.send(b"compress") # doctest: +ELLIPSIS
+    ERROR zc.zrs.primary:
+    IPv4Address(TCP, '127.0.0.1', 47246): Invalid features b'compress'
+    ...
+
+    >>> db.close() # doctest: +ELLIPSIS
+    INFO zc.zrs.primary:
+    Closing Data.fs ('', 8000)
+    ...
+    """
+
+def secondary_compression():
+    r"""
+    Secondaries can be configured to ask for compression:
+
+    >>> fs = ZODB.FileStorage.FileStorage('Data.fs')
+    >>> ss = zc.zrs.secondary.Secondary(fs, ('', 8000), reactor,
+    ...                                 compression='lzma zlib:1')
+    INFO zc.zrs.secondary:
+    Opening Data.fs ('', 8000)
+    INFO zc.zrs.reactor:
+    Starting factory <zc.zrs.secondary.SecondaryFactory>
+
+    >>> connection = reactor.accept()
+    INFO zc.zrs.secondary:
+    IPv4Address(TCP, '127.0.0.1', 47245): Connected
+
+    >>> connection.read()
+    b'zrs3.0'
+    >>> connection.read()
+    b'compress=lzma:1,zlib:1'
+    >>> connection.read()
+    b'\x00\x00\x00\x00\x00\x00\x00\x00'
+
+    >>> connection.send(b'compress=zlib:1', raw=True)
+    INFO zc.zrs.secondary:
+    IPv4Address(TCP, '127.0.0.1', 47245): features {'compress': ['zlib:1']}
+
+    >>> primary_fs = ZODB.FileStorage.FileStorage('primary.fs')
+    >>> primary_db = ZODB.DB(primary_fs)
+    >>> trans = zc.zrs.primary.FileStorageIterator(primary_fs).next()
+
+    >>> messages = [cPickle.dumps(('T', (trans.tid, trans.status, trans.user,
+    ...                                  trans.description, trans._extension)))]
+    >>> for record in trans:
+    ...     messages.append(cPickle.dumps(('S', (record.oid, record.tid,
+    ...                                   record.version, record.data_txn))))
+    ...     messages.append(record.data)
+    >>> checksum = md5(b'\0'*8)
+    >>> for m in messages:
+    ...     checksum.update(m)
+    >>> messages.append(cPickle.dumps(('C', (checksum.digest(), ))))
+
+    >>> import zlib
+    >>> compress = zlib.compressobj(1)
+    >>> data = b''.join(map(zc.zrs.sizedmessage.marshal, messages))
+    >>> connection.send(compress.compress(data[:100]) +
+    ...                 compress.flush(zlib.Z_SYNC_FLUSH), raw=True)
+    >>> connection.send(compress.compress(data[100:]) +
+    ...                 compress.flush(zlib.Z_SYNC_FLUSH), raw=True)
+
+    >>> fs.lastTransaction() == trans.tid
+    True
+
+    If a primary hangs up on an offer, the secondary assumes it's too
+    old to negotiate features and falls back to the basic protocol:
+
+    >>> connection.fail() # doctest: +NORMALIZE_WHITESPACE
+    INFO zc.zrs.secondary:
+    IPv4Address(TCP, '127.0.0.1', 47245): Disconnected 'failed'
+    INFO zc.zrs.reactor:
+    Stopping factory <zc.zrs.secondary.SecondaryFactory>
+    >>> reactor.doLater()
+    INFO zc.zrs.reactor:
+    Starting factory <zc.zrs.secondary.SecondaryFactory>
+    >>> connection = reactor.accept()
+    INFO zc.zrs.secondary:
+    IPv4Address(TCP, '127.0.0.1', 47246): Connected
+    >>> connection.read()
+    b'zrs3.0'
+    >>> _ = connection.read(), connection.read()
+    >>> connection.fail() # doctest: +NORMALIZE_WHITESPACE
+    WARNING zc.zrs.secondary:
+    IPv4Address(TCP, '127.0.0.1', 47246): Primary didn't accept features.
+    Falling back to b'zrs2.0'
+    INFO zc.zrs.secondary:
+    IPv4Address(TCP, '127.0.0.1', 47246): Disconnected 'failed'
+    INFO zc.zrs.reactor:
+    Stopping factory <zc.zrs.secondary.SecondaryFactory>
+    >>> reactor.doLater()
+    INFO zc.zrs.reactor:
+    Starting factory <zc.zrs.secondary.SecondaryFactory>
+    >>> connection = reactor.accept()
+    INFO zc.zrs.secondary:
+    IPv4Address(TCP, '127.0.0.1', 47247): Connected
+    >>> connection.read()
+    b'zrs2.0'
+
+    >>> ss.close() # doctest: +ELLIPSIS
+    INFO zc.zrs.secondary:
+    Closing Data.fs ('', 8000)
+    ...
+    >>> primary_db.close()
+    """
+
+def primary_binary_headers():
+    r"""
+    Secondaries can ask for control messages to be encoded in binary,
+    rather than pickled:
+
+    >>> fs = ZODB.FileStorage.FileStorage('Data.fs')
+    >>> ps = zc.zrs.primary.Primary(fs, ('', 8000), reactor)
+    INFO zc.zrs.primary:
+    Opening Data.fs ('', 8000)
+    >>> db = ZODB.DB(ps)
+    >>> conn = db.open()
+    >>> conn.root()['x'] = 1
+    >>> transaction.get().note(u'test')
+    >>> transaction.get().setExtendedInfo('foo', 'bar')
+    >>> commit()
+
+    >>> connection = reactor.connect(('', 8000))
+    INFO zc.zrs.primary:
+    IPv4Address(TCP, '127.0.0.1', 47245): Connected
+    >>> connection.send(b"zrs3.0")
+    >>> connection.send(b"headers=binary")
+    INFO zc.zrs.primary:
+    IPv4Address(TCP, '127.0.0.1', 47245): features {'headers': 'binary'}
+    >>> connection.read(True)
+    b'headers=binary'
+    >>> connection.send(b"\0"*8) # doctest: +ELLIPSIS
+    INFO zc.zrs.primary:
+    IPv4Address(TCP, '127.0.0.1', 47245):
+    start b'\x00\x00\x00\x00\x00\x00\x00\x00' (1900-01-01 00:00:00.000000)
+
+    >>> from zc.zrs.messages import decode_binary
+    >>> def read():
+    ...     message = connection.read(True)
+    ...     return message, decode_binary(message)
+
+    >>> message, (message_type, data) = read()
+    >>> message_type, len(message)
+    ('T', 41)
+    >>> tid, status, user, description, extension = data
+    >>> str(TimeStamp(tid)), status, user, description, extension
+    ('2007-03-21 20:32:57.000000', ' ', b'', b'initial database creation', b'')
+
+    >>> message, (message_type, data) = read()
+    >>> message_type, len(message)
+    ('S', 25)
+    >>> oid, serial, version, data_txn = data
+    >>> oid == ZODB.utils.z64, serial == tid, version, data_txn
+    (True, True, '', None)
+    >>> _ = connection.read(True)
+    >>> message, (message_type, data) = read()
+    >>> message_type, len(data[0])
+    ('C', 16)
+
+    >>> message, (message_type, data) = read()
+    >>> tid, status, user, description, extension = data
+    >>> str(TimeStamp(tid)), status, user, description
+    ('2007-03-21 20:32:58.000000', ' ', b'', b'test')
+    >>> cPickle.loads(extension)
+    {'foo': 'bar'}
+
+    >>> db.close() # doctest: +ELLIPSIS
+    INFO zc.zrs.primary:
+    Closing Data.fs ('', 8000)
+    ...
+    """
+
+def secondary_binary_headers():
+    r"""
+    >>> fs = ZODB.FileStorage.FileStorage('Data.fs')
+    >>> ss = zc.zrs.secondary.Secondary(fs, ('', 8000), reactor,
+    ...                                 binary_headers=True)
+    INFO zc.zrs.secondary:
+    Opening Data.fs ('', 8000)
+    INFO zc.zrs.reactor:
+    Starting factory <zc.zrs.secondary.SecondaryFactory>
+
+    >>> connection = reactor.accept()
+    INFO zc.zrs.secondary:
+    IPv4Address(TCP, '127.0.0.1', 47245): Connected
+    >>> connection.read(), connection.read(), connection.read()
+    (b'zrs3.0', b'headers=binary', b'\x00\x00\x00\x00\x00\x00\x00\x00')
+    >>> connection.send(b'headers=binary', raw=True)
+    INFO zc.zrs.secondary:
+    IPv4Address(TCP, '127.0.0.1', 47245): features {'headers': ['binary']}
+
+    >>> primary_fs = ZODB.FileStorage.FileStorage('primary.fs')
+    >>> primary_db = ZODB.DB(primary_fs)
+    >>> primary_conn = primary_db.open()
+    >>> primary_conn.root()['x'] = 1
+    >>> transaction.get().setExtendedInfo('foo', 'bar')
+    >>> commit()
+    >>> primary_data = zc.zrs.primary.FileStorageIterator(primary_fs)
+
+    >>> encoder = zc.zrs.messages.BinaryEncoder()
+    >>> connection.init_md5(b'\0'*8)
+    >>> for i in range(2):
+    ...     trans = primary_data.next()
+    ...     connection.send(encoder.transaction(trans), raw=True)
+    ...     for record in trans:
+    ...         connection.send(encoder.store(record), raw=True)
+    ...         connection.send(record.data, raw=True)
+    ...     connection.send(encoder.commit(connection.md5.digest()), raw=True)
+
+    >>> fs.lastTransaction() == primary_fs.lastTransaction()
+    True
+    >>> fs.undoLog()[0]['foo']
+    'bar'
+
+    Malformed messages are errors:
+
+    >>> connection.send(b'S' + b'\0' * 8, raw=True) # doctest: +ELLIPSIS
+    CRITICAL zc.zrs.secondary:
+    IPv4Address(TCP, '127.0.0.1', 47245): Input data error
+    Traceback (most recent call last):
+    ...
+    ValueError: ('Invalid store message', b'S\x00\x00\x00\x00\x00\x00\x00\x00')
+    ...
+
+    >>> ss.close() # doctest: +ELLIPSIS
+    INFO zc.zrs.secondary:
+    Closing Data.fs ('', 8000)
+    ...
+    >>> primary_db.close()
+    """
+
+def primary_checksum_algorithms():
+    r"""
+    Secondaries can negotiate checksum algorithms and ask for
+    checksums to cover individual transactions:
+
+    >>> import logging
+    >>> logging.getLogger('zc.zrs').setLevel(logging.INFO)
+
+    >>> fs = ZODB.FileStorage.FileStorage('Data.fs')
+    >>> ps = zc.zrs.primary.Primary(fs, ('', 8000), reactor)
+    INFO zc.zrs.primary:
+    Opening Data.fs ('', 8000)
+    >>> db = ZODB.DB(ps)
+    >>> conn = db.open()
+    >>> conn.root()['x'] = 1
+    >>> commit()
+
+    >>> connection = reactor.connect(('', 8000))
+    INFO zc.zrs.primary:
+    IPv4Address(TCP, '127.0.0.1', 47245): Connected
+    >>> connection.send(b"zrs3.0")
+    >>> connection.send(b"checksum=sha1,crc32 checksum-scope=transaction")
+    ... # doctest: +NORMALIZE_WHITESPACE
+    INFO zc.zrs.primary:
+    IPv4Address(TCP, '127.0.0.1', 47245):
+    features {'checksum': 'crc32', 'checksum-scope': 'transaction'}
+    >>> connection.read(True)
+    b'checksum=crc32 checksum-scope=transaction'
+    >>> connection.send(b"\0"*8) # doctest: +ELLIPSIS
+    INFO zc.zrs.primary:
+    ...
+
+    >>> import zlib
+    >>> for i in range(2):
+    ...     checksum = 0
+    ...     while 1:
+    ...         message = connection.read(True)
+    ...         if message[:1] == b'(':
+    ...             message_type, data = cPickle.loads(message)
+    ...             if message_type == 'C':
+    ...                 break
+    ...         checksum = zlib.crc32(message, checksum)
+    ...     print(data == (struct.pack(">I", checksum), ))
+    True
+    True
+
+    >>> db.close() # doctest: +ELLIPSIS
+    INFO zc.zrs.primary:
+    Closing Data.fs ('', 8000)
+    ...
+    """
+
+def secondary_checksum_algorithms():
+    r"""
+    >>> fs = ZODB.FileStorage.FileStorage('Data.fs')
+    >>> ss = zc.zrs.secondary.Secondary(fs, ('', 8000), reactor,
+    ...                                 checksum_algorithm='blake2b',
+    ...                                 per_transaction_checksums=True)
+    INFO zc.zrs.secondary:
+    Opening Data.fs ('', 8000)
+    INFO zc.zrs.reactor:
+    Starting factory <zc.zrs.secondary.SecondaryFactory>
+
+    >>> connection = reactor.accept()
+    INFO zc.zrs.secondary:
+    IPv4Address(TCP, '127.0.0.1', 47245): Connected
+    >>> _ = connection.read()
+    >>> connection.read()
+    b'checksum=blake2b checksum-scope=transaction'
+    >>> _ = connection.read()
+    >>> connection.send(b'checksum=blake2b checksum-scope=transaction',
+    ...                 raw=True) # doctest: +NORMALIZE_WHITESPACE
+    INFO zc.zrs.secondary:
+    IPv4Address(TCP, '127.0.0.1', 47245):
+    features {'checksum': ['blake2b'], 'checksum-scope': ['transaction']}
+
+    >>> primary_fs = ZODB.FileStorage.FileStorage('primary.fs')
+    >>> primary_db = ZODB.DB(primary_fs)
+    >>> primary_conn = primary_db.open()
+    >>> primary_conn.root()['x'] = 1
+    >>> commit()
+    >>> primary_data = zc.zrs.primary.FileStorageIterator(primary_fs)
+
+    >>> import hashlib
+    >>> def send(trans, bad=False):
+    ...     checksum = hashlib.blake2b(digest_size=16)
+    ...     def send(data):
+    ...         checksum.update(data)
+    ...         connection.send(data, raw=True)
+    ...     send(cPickle.dumps(('T', (trans.tid, trans.status, trans.user,
+    ...                               trans.description, trans._extension))))
+    ...     for record in trans:
+    ...         send(cPickle.dumps(('S', (record.oid, record.tid,
+    ...                                   record.version, record.data_txn))))
+    ...         send(record.data)
+    ...     if bad:
+    ...         checksum.update(b'x')
+    ...     connection.send(('C', (checksum.digest(), )))
+
+    >>> trans = primary_data.next()
+    >>> send(trans)
+    >>> fs.lastTransaction() == trans.tid
+    True
+
+    If a checksum is wrong, the error identifies the transaction:
+
+    >>> send(primary_data.next(), True) # doctest: +ELLIPSIS
+    CRITICAL zc.zrs.secondary:
+    IPv4Address(TCP, '127.0.0.1', 47245): Input data error
+    Traceback (most recent call last):
+    ...
+    AssertionError: ('Bad checksum', ..., '0x036c6b90f7777777')
+    ...
+
+    >>> ss.close() # doctest: +ELLIPSIS
+    INFO zc.zrs.secondary:
+    Closing Data.fs ('', 8000)
+    ...
+    >>> primary_db.close()
+    """
+
+def primary_chunked_records():
+    r"""
+    Secondaries can ask for records larger than a chunk size to be
+    sent in chunks:
+
+    >>> fs = ZODB.FileStorage.FileStorage('Data.fs')
+    >>> ps = zc.zrs.primary.Primary(fs, ('', 8000), reactor)
+    INFO zc.zrs.primary:
+    Opening Data.fs ('', 8000)
+    >>> db = ZODB.DB(ps)
+    >>> conn = db.open()
+    >>> conn.root()['x'] = b'x' * 25000
+    >>> commit()
+
+    >>> connection = reactor.connect(('', 8000))
+    INFO zc.zrs.primary:
+    IPv4Address(TCP, '127.0.0.1', 47245): Connected
+    >>> connection.send(b"zrs3.0")
+    >>> connection.send(b"chunk-size=10000")
+    INFO zc.zrs.primary:
+    IPv4Address(TCP, '127.0.0.1', 47245): features {'chunk-size': '10000'}
+    >>> connection.read(True)
+    b'chunk-size=10000'
+    >>> connection.send(b"\0"*8) # doctest: +ELLIPSIS
+    INFO zc.zrs.primary:
+    ...
+
+    The first transaction is small, so its record is sent as usual:
+
+    >>> message_type, data = connection.read()
+    >>> message_type
+    'T'
+    >>> message_type, data = connection.read()
+    >>> message_type
+    'S'
+    >>> _ = connection.read(True)
+    >>> message_type, data = connection.read()
+    >>> message_type
+    'C'
+
+    The second transaction's record is sent with an 'L' message
+    giving the size of the data, followed by the data in chunks:
+
+    >>> message_type, data = connection.read()
+    >>> message_type
+    'T'
+    >>> message_type, (oid, serial, version, data_txn, size) = (
+    ...     connection.read())
+    >>> message_type, oid == ZODB.utils.z64, data_txn, size
+    ('L', True, None, 25080)
+    >>> chunks = [connection.read(True) for i in range(3)]
+    >>> [len(chunk) for chunk in chunks]
+    [10000, 10000, 5080]
+    >>> b''.join(chunks) == fs.load(ZODB.utils.z64)[0]
+    True
+    >>> message_type, data = connection.read()
+    >>> message_type
+    'C'
+
+    >>> db.close() # doctest: +ELLIPSIS
+    INFO zc.zrs.primary:
+    Closing Data.fs ('', 8000)
+    ...
+
+    The iterator also streams data found through backpointers, as
+    written by undo:
+
+    >>> db = ZODB.DB('Data.fs')
+    >>> conn = db.open()
+    >>> conn.root()['x'] = 1
+    >>> commit()
+    >>> db.undo(db.undoLog(0, 1)[0]['id'])
+    >>> commit()
+    >>> db.close()
+
+    >>> fs = ZODB.FileStorage.FileStorage('Data.fs', read_only=True)
+    >>> it = zc.zrs.primary.FileStorageIterator(fs, chunk_size=10000)
+    >>> for trans in it:
+    ...     for record in trans:
+    ...         if isinstance(record, zc.zrs.primary.LargeRecord):
+    ...             data = b''.join(record.chunks(10000))
+    ...             print(record.size, record.data_txn is not None,
+    ...                   data == fs.load(ZODB.utils.z64)[0])
+    ...         else:
+    ...             print(len(record.data))
+    ...     if trans.tid == fs.lastTransaction():
+    ...         break
+    64
+    25080 False True
+    75
+    25080 True True
+
+    Records read whole are chunked when they're encoded:
+
+    >>> it = zc.zrs.primary.FileStorageIterator(fs)
+    >>> trans = it.next()
+    >>> trans = it.next()
+    >>> messages = list(zc.zrs.primary.transaction_messages(
+    ...     fs, trans, trans, zc.zrs.messages.PickleEncoder(), 10000))
+    >>> cPickle.loads(messages[1])[0], [len(m) for m in messages[2:]]
+    ('L', [10000, 10000, 5080])
+    >>> fs.close()
+    """
+
+def primary_catch_up_io():
+    r"""
+    Primaries can read for secondaries that are catching up without
+    pushing other data out of the page cache:
+
+    >>> import logging, os
+    >>> logging.getLogger('zc.zrs').setLevel(logging.WARNING)
+
+    >>> advice = []
+    >>> names = dict((getattr(os, name), name) for name in dir(os)
+    ...              if name.startswith('POSIX_FADV_'))
+    >>> def fadvise(fd, offset, length, advice_):
+    ...     advice.append(names[advice_])
+    >>> real_fadvise = zc.zrs.fileio.fadvise
+    >>> zc.zrs.fileio.fadvise = fadvise
+
+    >>> fs = ZODB.FileStorage.FileStorage('Data.fs')
+    >>> ps = zc.zrs.primary.Primary(
+    ...     fs, ('', 8000), reactor, catch_up_io='sequential',
+    ...     catch_up_read_ahead=10000)
+    >>> db = ZODB.DB(ps)
+    >>> conn = db.open()
+    >>> for i in range(20):
+    ...     conn.root()[i] = b'x' * 1000
+    ...     commit()
+    >>> tids = [trans.tid for trans in fs.iterator()]
+
+    >>> def read_transaction(connection):
+    ...     tid = connection.read()[1][0]
+    ...     while connection.read()[0] != 'C':
+    ...         _ = connection.read(True)
+    ...     return tid
+
+    >>> connection = reactor.connect(('', 8000))
+    >>> connection.send(b"zrs2.0")
+    >>> connection.send(b"\0"*8)
+    >>> [read_transaction(connection) for tid in tids] == tids
+    True
+
+    The storage file was read sequentially, in blocks, and data read
+    were dropped from the page cache.  When the secondary caught up,
+    reading went back to normal:
+
+    >>> advice[0], advice[-1]
+    ('POSIX_FADV_SEQUENTIAL', 'POSIX_FADV_NORMAL')
+    >>> 'POSIX_FADV_DONTNEED' in advice
+    True
+
+    >>> stats = ps.getIOStats()
+    >>> stats['sequential'] >= fs.getSize(), stats['normal']
+    (True, 0)
+
+    New transactions are read normally:
+
+    >>> conn.root()['x'] = 1
+    >>> commit()
+    >>> read_transaction(connection) == fs.lastTransaction()
+    True
+    >>> ps.getIOStats()['normal'] > 0
+    True
+
+    >>> zc.zrs.fileio.fadvise = real_fadvise
+
+    Catch-up reads can also be done at a lower I/O priority.  The
+    thread's priority is restored after each read:
+
+    >>> priorities = []
+    >>> def set_io_priority(priority):
+    ...     priorities.append(priority)
+    >>> real = (zc.zrs.fileio.io_priorities_supported,
+    ...         zc.zrs.fileio.get_io_priority,
+    ...         zc.zrs.fileio.set_io_priority)
+    >>> zc.zrs.fileio.io_priorities_supported = lambda : True
+    >>> zc.zrs.fileio.get_io_priority = lambda : 42
+    >>> zc.zrs.fileio.set_io_priority = set_io_priority
+
+    >>> it = zc.zrs.primary.FileStorageIterator(
+    ...     fs, io_policy=zc.zrs.fileio.IOPolicy(priority='idle'))
+    >>> while it.poll() is not None:
+    ...     pass
+    >>> priorities[:4] == [zc.zrs.fileio.priorities['idle'], 42] * 2
+    True
+    >>> del priorities[:]
+    >>> conn.root()['x'] = 2
+    >>> commit()
+    >>> it.poll().tid == fs.lastTransaction()
+    True
+    >>> priorities
+    []
+
+    Where I/O priorities aren't supported, they're ignored:
+
+    >>> zc.zrs.fileio.io_priorities_supported = lambda : False
+    >>> zc.zrs.fileio.IOPolicy(priority='idle').priority
+    WARNING zc.zrs.fileio:
+    I/O priorities aren't supported here
+
+    >>> (zc.zrs.fileio.io_priorities_supported,
+    ...  zc.zrs.fileio.get_io_priority,
+    ...  zc.zrs.fileio.set_io_priority) = real
+
+    >>> it._file.close()
+    >>> db.close()
+    """
+
+def primary_backpointer_cache():
+    r"""
+    Records written by undo have no data of their own, but point back
+    to earlier records.  Primaries can cache what these backpointers
+    resolve to, for all of their secondaries:
+
+    >>> import logging, persistent.mapping
+    >>> from pprint import pprint
+    >>> logging.getLogger('zc.zrs').setLevel(logging.WARNING)
+
+    >>> fs = ZODB.FileStorage.FileStorage('Data.fs')
+    >>> ps = zc.zrs.primary.Primary(
+    ...     fs, ('', 8000), reactor, backpointer_cache_size=1 << 20)
+    >>> db = ZODB.DB(ps)
+    >>> conn = db.open()
+    >>> for i in range(3):
+    ...     conn.root()[i] = persistent.mapping.PersistentMapping(
+    ...         data=b'x' * 1000 * i)
+    ...     commit()
+    >>> for i in range(3):
+    ...     conn.root()[i]['data'] = b'y' * 1000 * (i + 1)
+    ...     commit()
+
+    We undo the changes, and then the undos:
+
+    >>> def undo(i=0):
+    ...     db.undo(db.undoLog(i, i + 1)[0]['id'])
+    ...     commit()
+    >>> for i in (0, 2, 4, 0, 2, 4):
+    ...     undo(i)
+
+    >>> def read(it):
+    ...     records = []
+    ...     while 1:
+    ...         trans = it.poll()
+    ...         if trans is None:
+    ...             it._file.close()
+    ...             return records
+    ...         for record in trans:
+    ...             if isinstance(record, zc.zrs.primary.LargeRecord):
+    ...                 data = b''.join(record.chunks(100))
+    ...             else:
+    ...                 data = record.data
+    ...             records.append(
+    ...                 (record.oid, record.tid, data, record.data_txn))
+
+    >>> expected = read(zc.zrs.primary.FileStorageIterator(fs))
+    >>> len([r for r in expected if r[3] is not None])
+    6
+
+    >>> cache = ps._back_cache
+    >>> read(zc.zrs.primary.FileStorageIterator(
+    ...     fs, back_cache=cache)) == expected
+    True
+    >>> pprint(ps.getBackpointerCacheStats())
+    {'entries': 6, 'hits': 0, 'misses': 6, 'resets': 0, 'size': 10641}
+
+    Iterators that read records again find them in the cache, whatever
+    the size of records they read in chunks:
+
+    >>> read(zc.zrs.primary.FileStorageIterator(
+    ...     fs, back_cache=cache, chunk_size=1500)) == expected
+    True
+    >>> ps.getBackpointerCacheStats()['hits']
+    6
+
+    Secondaries' producers use the cache:
+
+    >>> def read_transaction(connection):
+    ...     tid = connection.read()[1][0]
+    ...     while connection.read()[0] != 'C':
+    ...         _ = connection.read(True)
+    ...     return tid
+    >>> connection = reactor.connect(('', 8000))
+    >>> connection.send(b"zrs2.0")
+    >>> connection.send(b"\0"*8)
+    >>> tids = [trans.tid for trans in fs.iterator()]
+    >>> [read_transaction(connection) for tid in tids] == tids
+    True
+    >>> ps.getBackpointerCacheStats()['hits']
+    12
+
+    The cache is bounded in bytes, and the least recently used entries
+    are dropped.  Data larger than an eighth of the bound aren't kept,
+    only where they are:
+
+    >>> small = zc.zrs.backpointers.BackpointerCache(fs, 1000)
+    >>> read(zc.zrs.primary.FileStorageIterator(
+    ...     fs, back_cache=small)) == expected
+    True
+    >>> pprint(small.stats())
+    {'entries': 4, 'hits': 0, 'misses': 6, 'resets': 0, 'size': 871}
+    >>> list(small.entries) == list(cache.entries)[-4:]
+    True
+    >>> [data is not None for (_, _, _, _, data) in small.entries.values()]
+    [True, False, False, False]
+
+    Positions change when the storage is packed.  The cache is cleared
+    when it's used with the new file, and isn't used with the old one:
+
+    >>> old_file = fs._file
+    >>> ps.pack(time.time(), ZODB.serialize.referencesf)
+    >>> conn.root()[0]['data'] = b'z'
+    >>> commit()
+    >>> undo()
+    >>> expected = read(zc.zrs.primary.FileStorageIterator(fs))
+    >>> read(zc.zrs.primary.FileStorageIterator(
+    ...     fs, back_cache=cache)) == expected
+    True
+    >>> stats = ps.getBackpointerCacheStats()
+    >>> stats['resets'], stats['entries']
+    (1, 1)
+    >>> cache.get(old_file, sorted(cache.entries)[0])
+
+    >>> ps.getBackpointerCacheStats() == stats
+    True
+
+    Without a cache, there are no statistics:
+
+    >>> zc.zrs.primary.Primary(
+    ...     ZODB.FileStorage.FileStorage('Other.fs'), ('', 8001), reactor
+    ...     ).getBackpointerCacheStats()
+
+    >>> connection.close()
+    >>> db.close()
+    """
+
+def primary_commit_notification():
+    r"""
+    Primaries count commits, and call callbacks registered by those
+    waiting for them, once, after the next commit:
+
+    >>> changes = zc.zrs.primary.Changes()
+    >>> woken = []
+    >>> changes.wait_for(changes.sequence, lambda : woken.append(1))
+    True
+
+    A callback isn't registered if there's been a commit since the
+    sequence it was given:
+
+    >>> sequence = changes.sequence
+    >>> changes.committed()
+    >>> changes.wait_for(sequence, lambda : woken.append(2))
+    False
+
+    >>> changes.notify_waiters()
+    >>> woken
+    [1]
+    >>> changes.notify_waiters()
+    >>> woken
+    [1]
+
+    Only secondaries that have nothing left to send wait for commits:
+
+    >>> import logging
+    >>> logging.getLogger('zc.zrs').setLevel(logging.WARNING)
+
+    >>> fs = ZODB.FileStorage.FileStorage('Data.fs')
+    >>> ps = zc.zrs.primary.Primary(fs, ('', 8000), reactor)
+    >>> db = ZODB.DB(ps)
+    >>> conn = db.open()
+    >>> for i in range(10):
+    ...     conn.root()['x'] = i
+    ...     commit()
+
+    >>> def read_transaction(connection):
+    ...     tid = connection.read()[1][0]
+    ...     while connection.read()[0] != 'C':
+    ...         _ = connection.read(True)
+    ...     return tid
+
+    >>> connection = reactor.connect(('', 8000))
+    >>> connection.send(b"zrs2.0")
+    >>> connection.send(b"\0"*8)
+    >>> tids = [read_transaction(connection) for i in range(11)]
+    >>> for i in range(500):
+    ...     if ps._changed.waiting:
+    ...         break
+    ...     time.sleep(.01)
+    >>> len(ps._changed.waiting)
+    1
+
+    Those waiting are woken by the reactor, rather than by the
+    committing thread, which may be holding a commit lock:
+
+    >>> calls = []
+    >>> callFromThread = reactor.callFromThread
+    >>> reactor.callFromThread = lambda f, *args: calls.append(f)
+    >>> conn.root()['x'] = 10
+    >>> commit()
+    >>> reactor.callFromThread = callFromThread
+    >>> calls == [ps._changed.notify_waiters]
+    True
+    >>> len(ps._changed.waiting)
+    1
+
+    >>> calls[0]()
+    >>> read_transaction(connection) == fs.lastTransaction()
+    True
+
+    Threads blocked reading iterators register to be woken too, so
+    stopping one iterator doesn't wake threads reading others:
+
+    >>> changes = zc.zrs.primary.Changes()
+    >>> iterators = [
+    ...     zc.zrs.primary.FileStorageIterator(
+    ...         fs, changes, fs.lastTransaction())
+    ...     for i in range(2)]
+    >>> read = {}
+    >>> def read_iterator(i):
+    ...     read[i] = [trans.tid for trans in iterators[i]]
+    >>> threads = [threading.Thread(target=read_iterator, args=(i,))
+    ...            for i in range(2)]
+    >>> for thread in threads:
+    ...     thread.start()
+    >>> for i in range(500):
+    ...     if len(changes.waiting) == 2:
+    ...         break
+    ...     time.sleep(.01)
+
+    >>> iterators[0].stop()
+    >>> threads[0].join(5)
+    >>> read[0], len(changes.waiting), iterators[1]._woken.is_set()
+    ([], 1, False)
+
+    The other thread is woken by the next commit:
+
+    >>> conn.root()['x'] = 11
+    >>> commit()
+    >>> changes.committed()
+    >>> changes.notify_waiters()
+    >>> iterators[1].catch_up_then_stop()
+    >>> threads[1].join(5)
+    >>> read[1] == [fs.lastTransaction()]
+    True
+
+    >>> db.close()
+    """
+
+def primary_memory_mapped_iterator():
+    r"""
+    Primaries can read from a memory mapping of the storage file.  The
+    mapped iterator provides the same transactions and records as the
+    regular one:
+
+    >>> db = ZODB.DB('Data.fs')
+    >>> conn = db.open()
+    >>> for i in range(10):
+    ...     conn.root()[i] = b'x' * (i * 5000)
+    ...     commit()
+    >>> db.undo(db.undoLog(0, 1)[0]['id'])
+    >>> commit()
+    >>> fs = db.storage
+
+    >>> def read(it):
+    ...     result = []
+    ...     while 1:
+    ...         trans = it.poll()
+    ...         if trans is None:
+    ...             return result
+    ...         records = []
+    ...         for record in trans:
+    ...             if isinstance(record, zc.zrs.primary.LargeRecord):
+    ...                 data = b''.join(record.chunks(10000))
+    ...             else:
+    ...                 data = record.data and bytes(record.data)
+    ...             records.append(
+    ...                 (record.oid, record.tid, record.data_txn, data))
+    ...         result.append((trans.tid, trans.status, trans.user,
+    ...                        trans.description, trans._extension, records))
+
+    >>> expected = read(zc.zrs.primary.FileStorageIterator(
+    ...     fs, chunk_size=20000))
+    >>> len(expected)
+    12
+    >>> mapped = zc.zrs.primary.MappedFileStorageIterator(
+    ...     fs, chunk_size=20000)
+    >>> read(mapped) == expected
+    True
+
+    Record data are views of the mapping, and records are compact:
+
+    >>> trans = zc.zrs.primary.MappedFileStorageIterator(fs).next()
+    >>> record = next(trans)
+    >>> type(record.data).__name__
+    'memoryview'
+    >>> hasattr(record, '__dict__')
+    False
+
+    Iterators can start after a given transaction:
+
+    >>> it = zc.zrs.primary.MappedFileStorageIterator(
+    ...     fs, start=expected[5][0], chunk_size=20000)
+    >>> read(it) == expected[6:]
+    True
+
+    The file is remapped as transactions are committed:
+
+    >>> conn.root()['y'] = 1
+    >>> commit()
+    >>> [trans[0] for trans in read(mapped)] == [fs.lastTransaction()]
+    True
+
+    And reopened after packs:
+
+    >>> db.pack()
+    >>> conn.root()['y'] = 2
+    >>> commit()
+    >>> [trans[0] for trans in read(mapped)] == [fs.lastTransaction()]
+    True
+
+    >>> db.close()
+    """
+
+def primary_raw_transactions():
+    r"""
+    Secondaries with file storages can ask for transactions to be
+    sent as they are in the primary's storage file:
+
+    >>> fs = ZODB.FileStorage.FileStorage('Data.fs')
+    >>> ps = zc.zrs.primary.Primary(fs, ('', 8000), reactor)
+    INFO zc.zrs.primary:
+    Opening Data.fs ('', 8000)
+    >>> db = ZODB.DB(ps)
+    >>> conn = db.open()
+    >>> conn.root()['x'] = 1
+    >>> commit()
+    >>> conn.root()['x'] = 2
+    >>> commit()
+
+    Undoing a transaction writes a backpointer to an earlier record:
+
+    >>> db.undo(db.undoLog()[0]['id'])
+    >>> commit()
+
+    >>> connection = reactor.connect(('', 8000))
+    INFO zc.zrs.primary:
+    IPv4Address(TCP, '127.0.0.1', 47245): Connected
+    >>> connection.send(b"zrs3.0")
+    >>> connection.send(b"headers=binary transfer=raw")
+    INFO zc.zrs.primary:
+    IPv4Address(TCP, '127.0.0.1', 47245): features {'headers': 'binary', 'transfer': 'raw'}
+    >>> connection.read(True)
+    b'headers=binary transfer=raw'
+    >>> connection.send(b"\0"*8) # doctest: +ELLIPSIS
+    INFO zc.zrs.primary:
+    IPv4Address(TCP, '127.0.0.1', 47245):
+    start b'\x00\x00\x00\x00\x00\x00\x00\x00' (1900-01-01 00:00:00.000000)
+
+    Each transaction is sent as an 'R' message, giving its id, the
+    size of its transaction record, and the ids of the transactions
+    its backpointers point into, followed by the transaction record
+    and a commit message:
+
+    >>> from zc.zrs.messages import decode_binary
+    >>> with open('Data.fs', 'rb') as f:
+    ...     file_data = f.read()
+    >>> pos = 4
+    >>> for i in range(4):
+    ...     message_type, (tid, size, back_tids) = decode_binary(
+    ...         connection.read(True))
+    ...     record = connection.read(True)
+    ...     print(message_type, str(TimeStamp(tid)), size,
+    ...           [str(TimeStamp(t)) for t in back_tids],
+    ...           record == file_data[pos:pos+size])
+    ...     pos += size
+    ...     message_type, data = decode_binary(connection.read(True))
+    ...     print(message_type)
+    R 2007-03-21 20:32:57.000000 162 [] True
+    C
+    R 2007-03-21 20:32:58.000000 148 [] True
+    C
+    R 2007-03-21 20:32:59.000000 148 [] True
+    C
+    R 2007-03-21 20:33:00.000000 81 ['2007-03-21 20:32:58.000000'] True
+    C
+    >>> pos == len(file_data)
+    True
+    >>> connection.close() # doctest: +ELLIPSIS
+    INFO zc.zrs.primary:
+    IPv4Address(TCP, '127.0.0.1', 47245): Disconnected ...
+
+    Raw transactions are held in memory by secondaries until they're
+    committed, so they aren't sent to secondaries that ask for large
+    records to be sent in chunks:
+
+    >>> connection = reactor.connect(('', 8000))
+    INFO zc.zrs.primary:
+    IPv4Address(TCP, '127.0.0.1', 47246): Connected
+    >>> connection.send(b"zrs3.0")
+    >>> connection.send(b"headers=binary chunk-size=1000 transfer=raw")
+    INFO zc.zrs.primary:
+    IPv4Address(TCP, '127.0.0.1', 47246):
+    features {'headers': 'binary', 'chunk-size': '1000'}
+    >>> connection.read(True)
+    b'headers=binary chunk-size=1000'
+
+    Primaries with blobs don't send raw transactions, as blob records
+    need blob data:
+
+    >>> blob_fs = ZODB.FileStorage.FileStorage('blobs.fs', blob_dir='blobs')
+    >>> blob_ps = zc.zrs.primary.Primary(blob_fs, ('', 8001), reactor)
+    INFO zc.zrs.primary:
+    Opening blobs.fs ('', 8001)
+    >>> connection = reactor.connect(('', 8001))
+    INFO zc.zrs.primary:
+    IPv4Address(TCP, '127.0.0.1', 47247): Connected
+    >>> connection.send(b"zrs3.1")
+    >>> connection.send(b"headers=binary transfer=raw")
+    INFO zc.zrs.primary:
+    IPv4Address(TCP, '127.0.0.1', 47247): features {'headers': 'binary'}
+    >>> connection.read(True)
+    b'headers=binary'
+
+    >>> blob_ps.close() # doctest: +ELLIPSIS
+    INFO zc.zrs.primary:
+    Closing blobs.fs ('', 8001)
+    ...
+    >>> db.close() # doctest: +ELLIPSIS
+    INFO zc.zrs.primary:
+    Closing Data.fs ('', 8000)
+    ...
+    """
+
+def primary_snapshot_bootstrap():
+    r"""
+    Empty secondaries can ask for a snapshot of the primary's storage,
+    rather than for every transaction since the beginning of time:
+
+    >>> import zc.zrs.snapshot
+    >>> block_size = zc.zrs.snapshot.block_size
+    >>> zc.zrs.snapshot.block_size = 200
+
+    The indexes of snapshots being sent are saved next to the storage
+    file while they're sent.  Any left behind by a primary that
+    crashed are removed when a primary is opened:
+
+    >>> with open('.Data.fs.snapshotxyz.index', 'w') as f:
+    ...     _ = f.write('stale')
+    >>> fs = ZODB.FileStorage.FileStorage('Data.fs', blob_dir='blobs')
+    >>> ps = zc.zrs.primary.Primary(fs, ('', 8000), reactor)
+    ... # doctest: +ELLIPSIS
+    INFO zc.zrs.snapshot:
+    Removing stale snapshot index .../.Data.fs.snapshotxyz.index
+    INFO zc.zrs.primary:
+    Opening Data.fs ('', 8000)
+    >>> os.path.exists('.Data.fs.snapshotxyz.index')
+    False
+
+    >>> db = ZODB.DB(ps)
+    >>> conn = db.open()
+    >>> conn.root()['x'] = 1
+    >>> commit()
+    >>> conn.root()['b'] = ZODB.blob.Blob(b'blob data')
+    >>> commit()
+    >>> with open('Data.fs', 'rb') as f:
+    ...     file_data = f.read()
+
+    >>> from zc.zrs.messages import decode_binary
+    >>> def connect(port, spec):
+    ...     connection = reactor.connect(('', 8000))
+    ...     connection.send(b"zrs3.1")
+    ...     connection.send(b"headers=binary bootstrap=" + spec)
+    ...     print(connection.read(True))
+    ...     connection.send(b"\0"*8)
+    ...     return connection
+    >>> def read_blocks(connection):
+    ...     while 1:
+    ...         message_type, (kind, key, pos, size) = decode_binary(
+    ...             connection.read(True))
+    ...         if kind in ('index', 'data', 'blob'):
+    ...             data = connection.read(True)
+    ...             print(message_type, kind, pos, size, len(data))
+    ...         else:
+    ...             print(message_type, kind, pos, size)
+    ...         if kind == 'data':
+    ...             assert data == file_data[pos:pos+size]
+    ...         if kind == 'blob':
+    ...             print(data)
+    ...         assert decode_binary(connection.read(True))[0] == 'C'
+    ...         if kind == 'end':
+    ...             return
+
+    The snapshot is sent as a sequence of file blocks, each followed
+    by a commit message.  The start block gives the last transaction
+    in the snapshot, the position the secondary is to start at and
+    the size of the file prefix.  It's followed by the storage index,
+    the file data, in blocks of at most a block size, and blob files:
+
+    >>> connection = connect(8000, b'snapshot') # doctest: +ELLIPSIS
+    INFO zc.zrs.primary:
+    IPv4Address(TCP, '127.0.0.1', 47245): Connected
+    INFO zc.zrs.primary:
+    IPv4Address(TCP, '127.0.0.1', 47245):
+    features {'headers': 'binary', 'bootstrap': 'snapshot'}
+    b'headers=binary bootstrap=snapshot'
+    INFO zc.zrs.primary:
+    IPv4Address(TCP, '127.0.0.1', 47245):
+    start b'\x00\x00\x00\x00\x00\x00\x00\x00' (1900-01-01 00:00:00.000000)
+    >>> read_blocks(connection)
+    INFO zc.zrs.primary:
+    IPv4Address(TCP, '127.0.0.1', 47245):
+    sending snapshot at 0x036c6b90fbbbbbbb from 0
+    F start 0 572
+    F index 0 40 40
+    F data 0 200 200
+    F data 200 200 200
+    F data 400 172 172
+    F blob 0 9 9
+    b'blob data'
+    F end 0 572
+
+    Transactions committed after the snapshot are sent as usual:
+
+    >>> tid = fs.lastTransaction()
+    >>> conn.root()['x'] = 2
+    >>> commit()
+    >>> message_type, data = decode_binary(connection.read(True))
+    >>> message_type, data[0] == fs.lastTransaction()
+    ('T', True)
+
+    The index is saved from a copy taken when the snapshot is, so
+    commits aren't held up while it's saved, and it's removed once
+    the snapshot's been sent:
+
+    >>> [name for name in os.listdir('.') if 'snapshot' in name]
+    []
+    >>> connection.close() # doctest: +ELLIPSIS
+    INFO zc.zrs.primary:
+    IPv4Address(TCP, '127.0.0.1', 47245): Disconnected ...
+
+    A secondary that was disconnected asks for the rest of the
+    snapshot it was sent:
+
+    >>> spec = zc.zrs.snapshot.format_spec(tid, 572, 200).encode('ascii')
+    >>> connection = connect(8000, spec) # doctest: +ELLIPSIS
+    INFO zc.zrs.primary:
+    ...
+    >>> read_blocks(connection)
+    INFO zc.zrs.primary:
+    IPv4Address(TCP, '127.0.0.1', 47246):
+    sending snapshot at 0x036c6b90fbbbbbbb from 200
+    F start 200 572
+    F data 200 200 200
+    F data 400 172 172
+    F blob 0 9 9
+    b'blob data'
+    F end 0 572
+    >>> connection.close() # doctest: +ELLIPSIS
+    INFO zc.zrs.primary:
+    IPv4Address(TCP, '127.0.0.1', 47246): Disconnected ...
+
+    Blobs already sent aren't sent again:
+
+    >>> blob_key = conn.root()['b']._p_oid + tid
+    >>> spec = zc.zrs.snapshot.format_spec(tid, 572, 572, blob_key)
+    >>> connection = connect(8000, spec.encode('ascii'))
+    ... # doctest: +ELLIPSIS
+    INFO zc.zrs.primary:
+    ...
+    >>> read_blocks(connection)
+    INFO zc.zrs.primary:
+    IPv4Address(TCP, '127.0.0.1', 47247):
+    sending snapshot at 0x036c6b90fbbbbbbb from 572
+    F start 572 572
+    F end 0 572
+    >>> connection.close() # doctest: +ELLIPSIS
+    INFO zc.zrs.primary:
+    IPv4Address(TCP, '127.0.0.1', 47247): Disconnected ...
+
+    If the primary was packed since, its file prefix has changed, and
+    a new snapshot is sent:
+
+    >>> conn.root()['x'] = 3
+    >>> ps.pack(time.time(), ZODB.serialize.referencesf); commit()
+    >>> with open('Data.fs', 'rb') as f:
+    ...     file_data = f.read()
+    >>> connection = connect(8000, spec.encode('ascii'))
+    ... # doctest: +ELLIPSIS
+    INFO zc.zrs.primary:
+    ...
+    >>> read_blocks(connection)
+    INFO zc.zrs.primary:
+    IPv4Address(TCP, '127.0.0.1', 47248):
+    sending snapshot at 0x036c6b9104444444 from 0
+    F start 0 484
+    F index 0 40 40
+    F data 0 200 200
+    F data 200 200 200
+    F data 400 84 84
+    F blob 0 9 9
+    b'blob data'
+    F end 0 484
+
+    >>> zc.zrs.snapshot.block_size = block_size
+    >>> db.close() # doctest: +ELLIPSIS
+    INFO zc.zrs.primary:
+    Closing Data.fs ('', 8000)
+    ...
+    """
+
+def primary_blob_links():
+    r"""
+    Primaries send blob data in blocks of a configurable size:
+
+    >>> fs = ZODB.FileStorage.FileStorage('Data.fs', blob_dir='blobs')
+    >>> ps = zc.zrs.primary.Primary(fs, ('', 8000), reactor,
+    ...                             blob_block_size=4)
+    INFO zc.zrs.primary:
+    Opening Data.fs ('', 8000)
+    >>> db = ZODB.DB(ps)
+    >>> conn = db.open()
+    >>> conn.root()['b'] = ZODB.blob.Blob(b'blob data')
+    >>> commit()
+
+    >>> connection = reactor.connect(('', 8000))
+    INFO zc.zrs.primary:
+    IPv4Address(TCP, '127.0.0.1', 47245): Connected
+    >>> connection.send(b"zrs2.1")
+    >>> connection.send(ZODB.utils.z64) # doctest: +ELLIPSIS
+    INFO zc.zrs.primary:
+    ...
+    >>> for i in range(4):
+    ...     _ = connection.read(True)
+    >>> connection.read()[0]
+    'T'
+    >>> connection.read()[0] # The root
+    'S'
+    >>> _ = connection.read(True)
+    >>> message_type, data = connection.read()
+    >>> message_type, data[-1]
+    ('B', 3)
+    >>> _ = connection.read(True)
+    >>> [connection.read(True) for i in range(3)]
+    [b'blob', b' dat', b'a']
+    >>> connection.read()[0]
+    'C'
+
+    Secondaries whose blob directories are on the same file system
+    can ask to be sent the names of blob files instead, which they
+    link into their blob directories.  They offer the device and
+    inode numbers and the name of their blob temporary directory,
+    which the primary checks:
+
+    >>> import zc.zrs.bloblinks
+    >>> os.makedirs(os.path.join('secondary-blobs', 'tmp'))
+    >>> offer = zc.zrs.bloblinks.offer(os.path.join('secondary-blobs', 'tmp'))
+    >>> connection = reactor.connect(('', 8000))
+    INFO zc.zrs.primary:
+    IPv4Address(TCP, '127.0.0.1', 47246): Connected
+    >>> connection.send(b"zrs3.1")
+    >>> connection.send(b"blobs=" + offer.encode('ascii'))
+    INFO zc.zrs.primary:
+    IPv4Address(TCP, '127.0.0.1', 47246): features {'blobs': 'link'}
+    >>> connection.read(True)
+    b'blobs=link'
+    >>> connection.send(ZODB.utils.z64) # doctest: +ELLIPSIS
+    INFO zc.zrs.primary:
+    ...
+
+    Blob records are sent with an 'H' message, followed by the record
+    data and the name of the committed blob file:
+
+    >>> for i in range(4):
+    ...     _ = connection.read(True)
+    >>> connection.read()[0]
+    'T'
+    >>> connection.read()[0]
+    'S'
+    >>> _ = connection.read(True)
+    >>> message_type, (oid, serial, version, data_txn) = connection.read()
+    >>> message_type, oid == conn.root()['b']._p_oid
+    ('H', True)
+    >>> _ = connection.read(True)
+    >>> name = connection.read(True).decode('utf-8')
+    >>> name == fs.loadBlob(oid, serial)
+    True
+    >>> connection.read()[0]
+    'C'
+
+    Offers for directories the primary can't find aren't accepted:
+
+    >>> kind, dev, ino, name = offer.split(':')
+    >>> connection = reactor.connect(('', 8000))
+    INFO zc.zrs.primary:
+    IPv4Address(TCP, '127.0.0.1', 47247): Connected
+    >>> connection.send(b"zrs3.1")
+    >>> connection.send(('blobs=link:%s:%s:%s' % (
+    ...     dev, ino, binascii.hexlify(b'/no/such/dir').decode('ascii'))
+    ...     ).encode('ascii'))
+    INFO zc.zrs.primary:
+    IPv4Address(TCP, '127.0.0.1', 47247): features {}
+    >>> connection = reactor.connect(('', 8000))
+    INFO zc.zrs.primary:
+    IPv4Address(TCP, '127.0.0.1', 47248): Connected
+    >>> connection.send(b"zrs3.1")
+    >>> connection.send(('blobs=link:%s:%x:%s' % (dev, int(ino, 16) + 1, name)
+    ...     ).encode('ascii'))
+    INFO zc.zrs.primary:
+    IPv4Address(TCP, '127.0.0.1', 47248): features {}
+
+    >>> db.close() # doctest: +ELLIPSIS
+    INFO zc.zrs.primary:
+    Closing Data.fs ('', 8000)
+    ...
+    """
+
+def primary_blob_channels():
+    r"""
+    Secondaries can fetch blob files over separate blob channels:
+
+    >>> fs = ZODB.FileStorage.FileStorage('Data.fs', blob_dir='blobs')
+    >>> ps = zc.zrs.primary.Primary(fs, ('', 8000), reactor,
+    ...                             blob_block_size=4)
+    INFO zc.zrs.primary:
+    Opening Data.fs ('', 8000)
+    >>> db = ZODB.DB(ps)
+    >>> conn = db.open()
+    >>> conn.root()['b'] = ZODB.blob.Blob(b'blob data')
+    >>> commit()
+
+    Blob records are then sent with a 'D' message, giving the size of
+    the blob file, followed by the record data only:
+
+    >>> connection = reactor.connect(('', 8000))
+    INFO zc.zrs.primary:
+    IPv4Address(TCP, '127.0.0.1', 47245): Connected
+    >>> connection.send(b"zrs3.1")
+    >>> connection.send(b"blobs=fetch")
+    INFO zc.zrs.primary:
+    IPv4Address(TCP, '127.0.0.1', 47245): features {'blobs': 'fetch'}
+    >>> connection.read(True)
+    b'blobs=fetch'
+    >>> connection.send(ZODB.utils.z64) # doctest: +ELLIPSIS
+    INFO zc.zrs.primary:
+    ...
+
+    >>> for i in range(4):
+    ...     _ = connection.read(True)
+    >>> connection.read()[0]
+    'T'
+    >>> connection.read()[0]
+    'S'
+    >>> _ = connection.read(True)
+    >>> message_type, (oid, serial, version, data_txn, size) = (
+    ...     connection.read())
+    >>> message_type, oid == conn.root()['b']._p_oid, size
+    ('D', True, 9)
+    >>> _ = connection.read(True)
+    >>> connection.read()[0]
+    'C'
+
+    A blob channel is opened with a feature offer that includes
+    ``channel=blobs``:
+
+    >>> channel = reactor.connect(('', 8000))
+    INFO zc.zrs.primary:
+    IPv4Address(TCP, '127.0.0.1', 47246): Connected
+    >>> channel.send(b"zrs3.1")
+    >>> channel.send(b"channel=blobs")
+    INFO zc.zrs.primary:
+    IPv4Address(TCP, '127.0.0.1', 47246): features {'channel': 'blobs'}
+    >>> channel.read(True)
+    b'channel=blobs'
+
+    Requests are an oid followed by a tid.  Each is answered with a
+    'G' message, giving the number of blob-data messages, the blob
+    data, and a 'C' message with a checksum of the blob data:
+
+    >>> channel.send(oid + serial)
+    >>> message_type, (blob_oid, blob_serial, blocks) = channel.read()
+    >>> message_type, (blob_oid, blob_serial) == (oid, serial), blocks
+    ('G', True, 3)
+    >>> [channel.read(True) for i in range(3)]
+    [b'blob', b' dat', b'a']
+    >>> channel.read() == ('C', (md5(b'blob data').digest(), ))
+    True
+
+    If the primary no longer has a blob file, as when it has been
+    packed away, -1 is sent for the number of blocks:
+
+    >>> channel.send(oid + ZODB.utils.p64(1))
+    >>> channel.read()[1][2]
+    -1
+    >>> channel.read() == ('C', (md5().digest(), ))
+    True
+
+    Invalid requests close the channel:
+
+    >>> channel.send(b'x')
+    ERROR zc.zrs.primary:
+    IPv4Address(TCP, '127.0.0.1', 47246): Invalid blob request, b'x'
+    INFO zc.zrs.primary:
+    IPv4Address(TCP, '127.0.0.1', 47246): Closed
+    >>> for i in range(500):
+    ...     if channel.closed:
+    ...         break
+    ...     time.sleep(.01) # doctest: +ELLIPSIS
+    INFO zc.zrs.primary:
+    IPv4Address(TCP, '127.0.0.1', 47246): Disconnected ...
+
+    >>> db.close() # doctest: +ELLIPSIS
+    INFO zc.zrs.primary:
+    Closing Data.fs ('', 8000)
+    ...
+    """
+
+def secondary_raw_transactions():
+    r"""
+    Secondaries with file storages can ask for transactions to be
+    sent raw:
+
+    >>> fs = ZODB.FileStorage.FileStorage('Data.fs')
+    >>> ss = zc.zrs.secondary.Secondary(fs, ('', 8000), reactor,
+    ...                                 binary_headers=True,
+    ...                                 raw_transactions=True)
+    INFO zc.zrs.secondary:
+    Opening Data.fs ('', 8000)
+    INFO zc.zrs.reactor:
+    Starting factory <zc.zrs.secondary.SecondaryFactory>
+
+    >>> connection = reactor.accept()
+    INFO zc.zrs.secondary:
+    IPv4Address(TCP, '127.0.0.1', 47245): Connected
+    >>> connection.read(), connection.read(), connection.read()
+    (b'zrs3.0', b'headers=binary transfer=raw', b'\x00\x00\x00\x00\x00\x00\x00\x00')
+    >>> connection.send(b'headers=binary transfer=raw', raw=True)
+    INFO zc.zrs.secondary:
+    IPv4Address(TCP, '127.0.0.1', 47245): features {'headers': ['binary'], 'transfer': ['raw']}
+
+    >>> primary_fs = ZODB.FileStorage.FileStorage('primary.fs')
+    >>> primary_db = ZODB.DB(primary_fs)
+    >>> primary_conn = primary_db.open()
+    >>> import persistent.mapping
+    >>> root = primary_conn.root()
+    >>> root['a'] = persistent.mapping.PersistentMapping()
+    >>> root['b'] = persistent.mapping.PersistentMapping()
+    >>> commit()
+    >>> root['a']['x'] = 1
+    >>> commit()
+    >>> root['b']['x'] = 1
+    >>> commit()
+
+    >>> encoder = zc.zrs.messages.BinaryEncoder()
+    >>> connection.init_md5(b'\0'*8)
+    >>> def send(start, n):
+    ...     it = zc.zrs.primary.FileStorageIterator(primary_fs, start=start)
+    ...     for i in range(n):
+    ...         trans = it.next()
+    ...         for message in zc.zrs.primary.transaction_messages(
+    ...                 primary_fs, trans, trans, encoder, 100, True):
+    ...             connection.send(message, raw=True)
+    ...         connection.send(encoder.commit(connection.md5.digest()),
+    ...                         raw=True)
+
+    >>> send(ZODB.utils.z64, 4)
+    >>> fs.lastTransaction() == primary_fs.lastTransaction()
+    True
+    >>> with open('Data.fs', 'rb') as f1, open('primary.fs', 'rb') as f2:
+    ...     f1.read() == f2.read()
+    True
+
+    The secondary fixes the file positions in the records it writes.
+    To see that, we'll pack the primary, which moves its records, and
+    then undo a change, which writes a backpointer:
+
+    >>> tid4 = primary_fs.lastTransaction()
+    >>> primary_fs.pack(TimeStamp(tid4).timeTime() + .5,
+    ...                 ZODB.serialize.referencesf)
+    >>> os.path.getsize('primary.fs') < os.path.getsize('Data.fs')
+    True
+    >>> root['a']['x'] = 2
+    >>> commit()
+    >>> primary_db.undo(primary_db.undoLog()[0]['id'])
+    >>> commit()
+    >>> send(tid4, 2)
+
+    >>> a = root['a']._p_oid
+    >>> fs.load(a) == primary_fs.load(a)
+    True
+    >>> record = fs._read_data_header(fs._index[a])
+    >>> record.plen, fs._read_data_header(record.back).tid == record.tid
+    (0, False)
+    >>> fs.loadSerial(a, fs._read_data_header(record.back).tid
+    ...               ) == fs.load(a)[0]
+    True
+
+    The secondary's file is consistent:
+
+    >>> import ZODB.scripts.fstest
+    >>> ZODB.scripts.fstest.check('Data.fs')
+
+    If the secondary was packed separately, it may not have records
+    that backpointers point to.  It then asks for transactions to be
+    sent record by record, which takes a new connection:
+
+    >>> root['b']['x'] = 2
+    >>> commit()
+    >>> tid7 = primary_fs.lastTransaction()
+    >>> send(fs.lastTransaction(), 1)
+    >>> fs.pack(TimeStamp(tid7).timeTime() + .5, ZODB.serialize.referencesf)
+    >>> primary_db.undo(primary_db.undoLog()[0]['id'])
+    >>> commit()
+    >>> send(tid7, 1) # doctest: +ELLIPSIS
+    WARNING zc.zrs.secondary:
+    IPv4Address(TCP, '127.0.0.1', 47245): Can't resolve backpointers
+    in 0x036c6b9111111111. Falling back to sending records.
+    CRITICAL zc.zrs.secondary:
+    IPv4Address(TCP, '127.0.0.1', 47245): Input data error
+    Traceback (most recent call last):
+    ...
+    zc.zrs.rawtxn.UnresolvedBackpointer: ('0x02', '0x036c6b9100000000')
+    INFO zc.zrs.secondary:
+    IPv4Address(TCP, '127.0.0.1', 47245): Disconnected ...
+    >>> ss._factory.features
+    {'headers': 'binary'}
+
+    >>> ss.close() # doctest: +ELLIPSIS
+    INFO zc.zrs.secondary:
+    Closing Data.fs ('', 8000)
+    ...
+    >>> primary_db.close()
+
+    Raw transactions are held in memory until they're committed, so
+    they aren't asked for by secondaries that ask for large records to
+    be sent in chunks:
+
+    >>> ss = zc.zrs.secondary.Secondary(
+    ...     ZODB.FileStorage.FileStorage('Data.fs'), ('', 8000), reactor,
+    ...     raw_transactions=True, chunk_size=1000)
+    WARNING zc.zrs.secondary:
+    Can't receive raw transactions in chunks for Data.fs
+    INFO zc.zrs.secondary:
+    Opening Data.fs ('', 8000)
+    INFO zc.zrs.reactor:
+    Starting factory <zc.zrs.secondary.SecondaryFactory>
+    >>> ss._factory.features
+    {'chunk-size': '1000'}
+    >>> ss.close() # doctest: +ELLIPSIS
+    INFO zc.zrs.secondary:
+    Closing Data.fs ('', 8000)
+    ...
+    """
+
+def raw_transaction_backpointers():
+    r"""
+    Secondaries writing raw transactions find the records backpointers
+    point to by following the objects' records back from their current
+    ones, rather than by searching their files for the transactions
+    the primary said they're in.
+
+    We'll change an object, commit many other transactions, and then
+    undo the change, which writes a backpointer to the object's first
+    record:
+
+    >>> import persistent.mapping
+    >>> import zc.zrs.rawtxn
+    >>> fs = ZODB.FileStorage.FileStorage('Data.fs')
+    >>> db = ZODB.DB(fs)
+    >>> conn = db.open()
+    >>> conn.root()['a'] = a = persistent.mapping.PersistentMapping()
+    >>> commit()
+    >>> tid = fs.lastTransaction()
+    >>> a['x'] = 1
+    >>> commit()
+    >>> for i in range(500):
+    ...     conn.root()['b'] = i
+    ...     commit()
+    >>> undo_id = [d['id'] for d in db.undoLog(0, 1000)][500]
+    >>> db.undo(undo_id)
+    >>> commit()
+    >>> fs.getSize() > 50000
+    True
+
+    Only the object's records are read:
+
+    >>> reads = []
+    >>> read_data_header = fs._read_data_header
+    >>> def counted(pos, *args):
+    ...     reads.append(pos)
+    ...     return read_data_header(pos, *args)
+    >>> fs._read_data_header = counted
+    >>> fs._read_txn_header = None # Transactions aren't searched.
+    >>> with fs._lock:
+    ...     pos = zc.zrs.rawtxn._find_back(fs, a._p_oid, tid)
+    >>> fs._read_data_header = read_data_header
+    >>> del fs._read_txn_header
+    >>> len(reads)
+    3
+    >>> fs._read_data_header(pos).tid == tid
+    True
+
+    If the object has no record in the transaction, as when the
+    secondary was packed separately, the backpointer can't be
+    resolved:
+
+    >>> with fs._lock:
+    ...     zc.zrs.rawtxn._find_back(fs, a._p_oid, b'\0' * 8)
+    Traceback (most recent call last):
+    ...
+    zc.zrs.rawtxn.UnresolvedBackpointer: ('0x01', '0x0000000000000000')
+
+    >>> db.close()
+    """
+
+def secondary_snapshot_bootstrap():
+    r"""
+    Secondaries with empty file storages can ask for a snapshot of
+    the primary's storage:
+
+    >>> import zc.zrs.snapshot
+    >>> block_size = zc.zrs.snapshot.block_size
+    >>> zc.zrs.snapshot.block_size = 200
+
+    >>> fs = ZODB.FileStorage.FileStorage('Data.fs', blob_dir='blobs')
+    >>> ss = zc.zrs.secondary.Secondary(fs, ('', 8000), reactor,
+    ...                                 binary_headers=True,
+    ...                                 snapshot_bootstrap=True)
+    INFO zc.zrs.secondary:
+    Opening Data.fs ('', 8000)
+    INFO zc.zrs.reactor:
+    Starting factory <zc.zrs.secondary.SecondaryFactory>
+
+    >>> connection = reactor.accept()
+    INFO zc.zrs.secondary:
+    IPv4Address(TCP, '127.0.0.1', 47245): Connected
+    >>> connection.read(), connection.read(), connection.read()
+    (b'zrs3.1', b'headers=binary bootstrap=snapshot', b'\x00\x00\x00\x00\x00\x00\x00\x00')
+    >>> connection.send(b'headers=binary bootstrap=snapshot', raw=True)
+    INFO zc.zrs.secondary:
+    IPv4Address(TCP, '127.0.0.1', 47245): features {'headers': ['binary'], 'bootstrap': ['snapshot']}
+
+    >>> primary_fs = ZODB.FileStorage.FileStorage('primary.fs',
+    ...                                           blob_dir='primary-blobs')
+    >>> primary_db = ZODB.DB(primary_fs)
+    >>> primary_conn = primary_db.open()
+    >>> primary_conn.root()['x'] = 1
+    >>> commit()
+    >>> primary_conn.root()['b'] = ZODB.blob.Blob(b'blob data')
+    >>> commit()
+
+    >>> encoder = zc.zrs.messages.BinaryEncoder()
+    >>> connection.init_md5(b'\0'*8)
+    >>> def send(spec, blocks=None):
+    ...     snapshot = zc.zrs.snapshot.Snapshot(primary_fs, spec)
+    ...     for header, chunks in snapshot.blocks(encoder, 100):
+    ...         if blocks == 0:
+    ...             break
+    ...         connection.send(header, raw=True)
+    ...         for data in chunks:
+    ...             connection.send(data, raw=True)
+    ...         connection.send(encoder.commit(connection.md5.digest()),
+    ...                         raw=True)
+    ...         if blocks:
+    ...             blocks -= 1
+    ...     snapshot.close()
+
+    The secondary stages the blocks it receives next to its storage
+    file.  If it's disconnected, it asks for the rest of the snapshot
+    when it reconnects:
+
+    >>> send('snapshot', 4)
+    INFO zc.zrs.secondary:
+    IPv4Address(TCP, '127.0.0.1', 47245):
+    Receiving snapshot at 0x036c6b90fbbbbbbb from 0
+    >>> sorted(name for name in os.listdir('.') if 'snapshot' in name)
+    ['Data.fs.snapshot', 'Data.fs.snapshot.index', 'Data.fs.snapshot.state']
+    >>> fs.lastTransaction()
+    b'\x00\x00\x00\x00\x00\x00\x00\x00'
+
+    >>> connection.fail() # doctest: +NORMALIZE_WHITESPACE
+    INFO zc.zrs.secondary:
+    IPv4Address(TCP, '127.0.0.1', 47245): Disconnected 'failed'
+    INFO zc.zrs.reactor:
+    Stopping factory <zc.zrs.secondary.SecondaryFactory>
+    >>> reactor.doLater()
+    INFO zc.zrs.reactor:
+    Starting factory <zc.zrs.secondary.SecondaryFactory>
+    >>> connection = reactor.accept()
+    INFO zc.zrs.secondary:
+    IPv4Address(TCP, '127.0.0.1', 47246): Connected
+    >>> _ = connection.read()
+    >>> spec = connection.read().split(b'=')[-1]
+    >>> spec
+    b'snapshot:036c6b90fbbbbbbb:572:400'
+    >>> _ = connection.read()
+    >>> connection.send(b'headers=binary bootstrap=snapshot', raw=True)
+    ... # doctest: +ELLIPSIS
+    INFO zc.zrs.secondary:
+    ...
+    >>> connection.init_md5(b'\0'*8)
+
+    Once it has the whole snapshot, it installs it and replicates
+    later transactions as usual:
+
+    >>> send(spec.decode('ascii'))
+    INFO zc.zrs.secondary:
+    IPv4Address(TCP, '127.0.0.1', 47246):
+    Receiving snapshot at 0x036c6b90fbbbbbbb from 400
+    INFO zc.zrs.snapshot:
+    Installed snapshot of Data.fs at 0x036c6b90fbbbbbbb
+    >>> sorted(name for name in os.listdir('.') if 'snapshot' in name)
+    []
+    >>> fs.lastTransaction() == primary_fs.lastTransaction()
+    True
+    >>> with open('Data.fs', 'rb') as f1, open('primary.fs', 'rb') as f2:
+    ...     f1.read() == f2.read()
+    True
+
+    >>> primary_conn.root()['x'] = 2
+    >>> commit()
+    >>> it = zc.zrs.primary.FileStorageIterator(
+    ...     primary_fs, start=fs.lastTransaction())
+    >>> trans = it.next()
+    >>> for message in zc.zrs.primary.transaction_messages(
+    ...         primary_fs, trans, trans, encoder, None):
+    ...     connection.send(message, raw=True)
+    >>> connection.send(encoder.commit(connection.md5.digest()), raw=True)
+
+    >>> db = ZODB.DB(ss)
+    >>> conn = db.open()
+    >>> conn.root()['x'], conn.root()['b'].open().read()
+    (2, b'blob data')
+
+    The storage is no longer empty, so it won't ask for a snapshot
+    again:
+
+    >>> ss._factory.snapshot.offer()
+
+    >>> import ZODB.scripts.fstest
+    >>> ZODB.scripts.fstest.check('Data.fs')
+
+    >>> zc.zrs.snapshot.block_size = block_size
+    >>> db.close() # doctest: +ELLIPSIS
+    INFO zc.zrs.secondary:
+    Closing Data.fs ('', 8000)
+    ...
+    >>> primary_db.close()
+    """
+
+def secondary_blob_links():
+    r"""
+    Secondaries can offer to link blob files from primaries on the same
+    file system:
+
+    >>> fs = ZODB.FileStorage.FileStorage('Data.fs', blob_dir='blobs')
+    >>> ss = zc.zrs.secondary.Secondary(fs, ('', 8000), reactor,
+    ...                                 link_blobs=True)
+    INFO zc.zrs.secondary:
+    Opening Data.fs ('', 8000)
+    INFO zc.zrs.reactor:
+    Starting factory <zc.zrs.secondary.SecondaryFactory>
+
+    >>> connection = reactor.accept()
+    INFO zc.zrs.secondary:
+    IPv4Address(TCP, '127.0.0.1', 47245): Connected
+    >>> connection.read()
+    b'zrs3.1'
+    >>> offer = connection.read()
+    >>> offer == b'blobs=' + zc.zrs.bloblinks.offer(
+    ...     fs.temporaryDirectory()).encode('ascii')
+    True
+    >>> connection.read()
+    b'\x00\x00\x00\x00\x00\x00\x00\x00'
+    >>> connection.send(b'blobs=link', raw=True)
+    INFO zc.zrs.secondary:
+    IPv4Address(TCP, '127.0.0.1', 47245): features {'blobs': ['link']}
+
+    >>> primary_fs = ZODB.FileStorage.FileStorage(
+    ...     'primary.fs', blob_dir='primary-blobs')
+    >>> primary_db = ZODB.DB(primary_fs)
+    >>> primary_conn = primary_db.open()
+    >>> primary_conn.root()['b'] = ZODB.blob.Blob(b'blob data')
+    >>> commit()
+
+    >>> encoder = zc.zrs.messages.PickleEncoder()
+    >>> connection.init_md5(b'\0'*8)
+    >>> def send(start, n):
+    ...     it = zc.zrs.primary.FileStorageIterator(primary_fs, start=start)
+    ...     for i in range(n):
+    ...         trans = it.next()
+    ...         for message in zc.zrs.primary.transaction_messages(
+    ...                 primary_fs, trans, trans, encoder, None,
+    ...                 blobs='link'):
+    ...             connection.send(message, raw=True)
+    ...         connection.send(encoder.commit(connection.md5.digest()),
+    ...                         raw=True)
+
+    >>> send(ZODB.utils.z64, 2)
+    >>> fs.lastTransaction() == primary_fs.lastTransaction()
+    True
+
+    The secondary's blob file is a link to the primary's:
+
+    >>> oid = primary_conn.root()['b']._p_oid
+    >>> serial = primary_fs.lastTransaction()
+    >>> (os.stat(fs.loadBlob(oid, serial)).st_ino ==
+    ...  os.stat(primary_fs.loadBlob(oid, serial)).st_ino)
+    True
+    >>> with open(fs.loadBlob(oid, serial), 'rb') as f:
+    ...     f.read()
+    b'blob data'
+
+    If blob files can't be linked, the secondary asks for blob data
+    instead, which takes a new connection:
+
+    >>> with primary_conn.root()['b'].open('w') as f:
+    ...     _ = f.write(b'new blob data')
+    >>> commit()
+    >>> trans = zc.zrs.primary.FileStorageIterator(
+    ...     primary_fs, start=serial).next()
+    >>> messages = list(zc.zrs.primary.transaction_messages(
+    ...     primary_fs, trans, trans, encoder, None, blobs='link'))
+    >>> os.remove(primary_fs.loadBlob(oid, trans.tid))
+    >>> for message in messages:
+    ...     connection.send(message, raw=True) # doctest: +ELLIPSIS
+    WARNING zc.zrs.secondary:
+    IPv4Address(TCP, '127.0.0.1', 47245): Can't link blob files from
+    the primary. Falling back to sending blob data.
+    CRITICAL zc.zrs.secondary:
+    IPv4Address(TCP, '127.0.0.1', 47245): Input data error
+    Traceback (most recent call last):
+    ...
+    FileNotFoundError: ...
+    INFO zc.zrs.secondary:
+    IPv4Address(TCP, '127.0.0.1', 47245): Disconnected ...
+    >>> ss._factory.features
+    {}
+
+    >>> ss.close() # doctest: +ELLIPSIS
+    INFO zc.zrs.secondary:
+    Closing Data.fs ('', 8000)
+    ...
+    >>> primary_db.close()
+
+    Blob files are linked under new temporary names.  If someone else
+    takes a name before it's linked, another is tried:
+
+    >>> with open('original.blob', 'wb') as f:
+    ...     _ = f.write(b'data')
+    >>> os.mkdir('links')
+    >>> import errno
+    >>> link = os.link
+    >>> def taken(source, name):
+    ...     os.link = link
+    ...     raise OSError(errno.EEXIST, 'File exists', name)
+    >>> os.link = taken
+    >>> name = zc.zrs.bloblinks.link('original.blob', 'links')
+    >>> os.link is link
+    True
+    >>> os.listdir('links') == [os.path.basename(name)]
+    True
+    >>> with open(name, 'rb') as f:
+    ...     f.read()
+    b'data'
+    """
+
+def secondary_blob_channels():
+    r"""
+    Secondaries can fetch blob files over separate blob channels, so
+    that large blob files don't hold up the replication stream:
+
+    >>> fs = ZODB.FileStorage.FileStorage('Data.fs', blob_dir='blobs')
+    >>> ss = zc.zrs.secondary.Secondary(fs, ('', 8000), reactor,
+    ...                                 blob_channels=2)
+    INFO zc.zrs.secondary:
+    Opening Data.fs ('', 8000)
+    INFO zc.zrs.reactor:
+    Starting factory <zc.zrs.secondary.SecondaryFactory>
+
+    >>> connection = reactor.accept()
+    INFO zc.zrs.secondary:
+    IPv4Address(TCP, '127.0.0.1', 47245): Connected
+    >>> connection.read(), connection.read(), connection.read()
+    (b'zrs3.1', b'blobs=fetch', b'\x00\x00\x00\x00\x00\x00\x00\x00')
+    >>> ss.getBlobChannelStats()
+
+    Once the primary agrees, the secondary opens its blob channels:
+
+    >>> connection.send(b'blobs=fetch', raw=True)
+    INFO zc.zrs.secondary:
+    IPv4Address(TCP, '127.0.0.1', 47245): features {'blobs': ['fetch']}
+    INFO zc.zrs.reactor:
+    Starting factory <zc.zrs.blobchannel.ChannelFactory>
+    INFO zc.zrs.reactor:
+    Starting factory <zc.zrs.blobchannel.ChannelFactory>
+    >>> channels = [reactor.accept(), reactor.accept()]
+    >>> [(channel.read(), channel.read()) for channel in channels]
+    [(b'zrs3.1', b'channel=blobs'), (b'zrs3.1', b'channel=blobs')]
+    >>> for channel in channels:
+    ...     channel.send(b'channel=blobs', raw=True)
+
+    We'll replicate a transaction with a blob, followed by one
+    without:
+
+    >>> primary_fs = ZODB.FileStorage.FileStorage(
+    ...     'primary.fs', blob_dir='primary-blobs')
+    >>> primary_db = ZODB.DB(primary_fs)
+    >>> primary_conn = primary_db.open()
+    >>> primary_conn.root()['b'] = ZODB.blob.Blob(b'blob data')
+    >>> commit()
+    >>> oid = primary_conn.root()['b']._p_oid
+    >>> serial = primary_fs.lastTransaction()
+    >>> primary_conn.root()['x'] = 1
+    >>> commit()
+
+    >>> encoder = zc.zrs.messages.PickleEncoder()
+    >>> connection.init_md5(b'\0'*8)
+    >>> it = zc.zrs.primary.FileStorageIterator(primary_fs)
+    >>> for i in range(3):
+    ...     trans = it.next()
+    ...     for message in zc.zrs.primary.transaction_messages(
+    ...             primary_fs, trans, trans, encoder, None, blobs='fetch'):
+    ...         connection.send(message, raw=True)
+    ...     connection.send(encoder.commit(connection.md5.digest()),
+    ...                     raw=True)
+
+    The first transaction, which created the root, has been committed,
+    but the others wait for the blob file, which has been requested
+    on the first channel:
+
+    >>> fs.lastTransaction() == primary_fs.lastTransaction()
+    False
+    >>> stats = ss.getBlobChannelStats()
+    >>> stats['received'] == primary_fs.lastTransaction()
+    True
+    >>> stats['lag'] > 0
+    True
+    >>> del stats['received'], stats['lag']
+    >>> from pprint import pprint
+    >>> pprint(stats)
+    {'blob_bytes': 9, 'blobs': 1, 'size': 250, 'transactions': 2}
+    >>> channels[0].read() == oid + serial
+    True
+    >>> channels[1].have_data()
+    False
+
+    Blob files for later transactions are requested as their records
+    arrive, on the channel with the least data outstanding:
+
+    >>> with primary_conn.root()['b'].open('w') as f:
+    ...     _ = f.write(b'new blob data')
+    >>> commit()
+    >>> serial2 = primary_fs.lastTransaction()
+    >>> def send():
+    ...     trans = it.next()
+    ...     for message in zc.zrs.primary.transaction_messages(
+    ...             primary_fs, trans, trans, encoder, None, blobs='fetch'):
+    ...         connection.send(message, raw=True)
+    ...     connection.send(encoder.commit(connection.md5.digest()),
+    ...                     raw=True)
+    >>> send()
+    >>> channels[1].read() == oid + serial2
+    True
+
+    Blob files may arrive out of order, but transactions are
+    committed in order, once the blob files they need have arrived:
+
+    >>> channels[1].send(('G', (oid, serial2, 1)))
+    >>> channels[1].send(b'new blob data', raw=True)
+    >>> channels[1].send(('C', (md5(b'new blob data').digest(), )))
+    >>> fs.lastTransaction() == serial
+    False
+    >>> channels[0].send(('G', (oid, serial, 2)))
+    >>> channels[0].send(b'blob', raw=True)
+    >>> channels[0].send(b' data', raw=True)
+    >>> channels[0].send(('C', (md5(b'blob data').digest(), )))
+    >>> fs.lastTransaction() == primary_fs.lastTransaction()
+    True
+    >>> with open(fs.loadBlob(oid, serial), 'rb') as f:
+    ...     f.read()
+    b'blob data'
+    >>> with open(fs.loadBlob(oid, serial2), 'rb') as f:
+    ...     f.read()
+    b'new blob data'
+    >>> pprint(ss.getBlobChannelStats()) # doctest: +ELLIPSIS
+    {'blob_bytes': 0,
+     'blobs': 0,
+     'lag': 0.0,
+     'received': ...,
+     'size': 0,
+     'transactions': 0}
+
+    Bad blob data cause the secondary to start over, discarding
+    transactions it hasn't committed:
+
+    >>> with primary_conn.root()['b'].open('w') as f:
+    ...     _ = f.write(b'newer blob data')
+    >>> commit()
+    >>> send()
+    >>> channels[0].read() == oid + primary_fs.lastTransaction()
+    True
+    >>> channels[0].send(('G', (oid, primary_fs.lastTransaction(), 1)))
+    >>> channels[0].send(b'newer blob data', raw=True)
+    >>> channels[0].send(('C', (md5(b'older blob data').digest(), )))
+    ... # doctest: +ELLIPSIS
+    CRITICAL zc.zrs.secondary:
+    IPv4Address(TCP, '127.0.0.1', 47245): Blob channel input data error
+    Traceback (most recent call last):
+    ...
+    AssertionError: ('Bad blob checksum', ...)
+    ...
+    >>> fs.lastTransaction() == serial2
+    True
+    >>> os.listdir(fs.temporaryDirectory())
+    []
+
+    >>> ss.close() # doctest: +ELLIPSIS
+    INFO zc.zrs.secondary:
+    Closing Data.fs ('', 8000)
+    ...
+    >>> primary_db.close()
+    """
+
+def secondary_apply_queue():
+    r"""
+    Secondaries can commit the transactions they receive in a
+    separate thread, so that slow commits don't hold up the reactor
+    thread.  We'll use a storage that commits when we let it:
+
+    >>> import threading
+    >>> fs = ZODB.FileStorage.FileStorage('Data.fs')
+    >>> go = threading.Event()
+    >>> vote = fs.tpc_vote
+    >>> def slow_vote(transaction):
+    ...     go.wait(10)
+    ...     return vote(transaction)
+    >>> fs.tpc_vote = slow_vote
+
+    >>> ss = zc.zrs.secondary.Secondary(fs, ('', 8000), reactor,
+    ...                                 apply_queue_size=500)
+    INFO zc.zrs.secondary:
+    Opening Data.fs ('', 8000)
+    INFO zc.zrs.reactor:
+    Starting factory <zc.zrs.secondary.SecondaryFactory>
+
+    >>> connection = reactor.accept()
+    INFO zc.zrs.secondary:
+    IPv4Address(TCP, '127.0.0.1', 47245): Connected
+    >>> connection.read(), connection.read()
+    (b'zrs2.0', b'\x00\x00\x00\x00\x00\x00\x00\x00')
+    >>> connection.pauseProducing = lambda : print('paused')
+    >>> connection.resumeProducing = lambda : print('resumed')
+
+    >>> primary_fs = ZODB.FileStorage.FileStorage('primary.fs')
+    >>> primary_db = ZODB.DB(primary_fs)
+    >>> primary_conn = primary_db.open()
+    >>> for i in range(8):
+    ...     primary_conn.root()[i] = 'x' * 100
+    ...     commit()
+    >>> tids = [trans.tid for trans in primary_fs.iterator()]
+
+    >>> encoder = zc.zrs.messages.PickleEncoder()
+    >>> connection.init_md5(b'\0'*8)
+    >>> it = zc.zrs.primary.FileStorageIterator(primary_fs)
+    >>> def send():
+    ...     trans = it.next()
+    ...     for message in zc.zrs.primary.transaction_messages(
+    ...             primary_fs, trans, trans, encoder, None):
+    ...         connection.send(message, raw=True)
+    ...     connection.send(encoder.commit(connection.md5.digest()),
+    ...                     raw=True)
+
+    Transactions are queued while they wait to be committed.  When
+    more than apply_queue_size bytes of record data are queued,
+    receiving is paused:
+
+    >>> for i in range(4):
+    ...     send()
+    paused
+    >>> fs.lastTransaction() == ZODB.utils.z64
+    True
+    >>> stats = ss.getApplyStats()
+    >>> stats['received'] == tids[3]
+    True
+    >>> stats['transactions'], stats['size'], stats['applied']
+    (4, 600, 0)
+
+    Once half of that is committed, receiving resumes:
+
+    >>> go.set(); time.sleep(0.1)
+    resumed
+    >>> fs.lastTransaction() == tids[3]
+    True
+    >>> stats = ss.getApplyStats()
+    >>> stats['transactions'], stats['size'], stats['applied']
+    (0, 0, 4)
+    >>> stats['received'], stats['latency'] > 0, stats['mean_latency'] > 0
+    (None, True, True)
+
+    A secondary that reconnects asks for the transactions after the
+    last one it received, committed or not:
+
+    >>> go.clear()
+    >>> send()
+    >>> connection.fail() # doctest: +NORMALIZE_WHITESPACE
+    INFO zc.zrs.secondary:
+    IPv4Address(TCP, '127.0.0.1', 47245): Disconnected 'failed'
+    INFO zc.zrs.reactor:
+    Stopping factory <zc.zrs.secondary.SecondaryFactory>
+    >>> reactor.doLater()
+    INFO zc.zrs.reactor:
+    Starting factory <zc.zrs.secondary.SecondaryFactory>
+    >>> connection = reactor.accept()
+    INFO zc.zrs.secondary:
+    IPv4Address(TCP, '127.0.0.1', 47246): Connected
+    >>> connection.read(), connection.read() == tids[4]
+    (b'zrs2.0', True)
+    >>> fs.lastTransaction() == tids[3]
+    True
+    >>> go.set(); time.sleep(0.1)
+    >>> fs.lastTransaction() == tids[4]
+    True
+
+    If a transaction can't be committed, the transactions received
+    after it are discarded, and the secondary starts over:
+
+    >>> go.clear()
+    >>> def bad_vote(transaction):
+    ...     go.wait(10)
+    ...     raise ValueError('No room')
+    >>> fs.tpc_vote = bad_vote
+    >>> connection.init_md5(tids[4])
+    >>> send(); send()
+    >>> go.set(); time.sleep(0.1) # doctest: +ELLIPSIS
+    CRITICAL zc.zrs.secondary:
+    IPv4Address(TCP, '127.0.0.1', 47246): Couldn't commit ...
+    Traceback (most recent call last):
+    ...
+    ValueError: No room
+    INFO zc.zrs.secondary:
+    IPv4Address(TCP, '127.0.0.1', 47246): Disconnected ...
+    >>> fs.lastTransaction() == tids[4]
+    True
+    >>> ss.getApplyStats()['transactions']
+    0
+    >>> ss._factory.applier.last_received() == tids[4]
+    True
+
+    >>> ss.close() # doctest: +ELLIPSIS
+    INFO zc.zrs.secondary:
+    Closing Data.fs ('', 8000)
+    ...
+    >>> primary_db.close()
+    """
+
+def secondary_group_sync():
+    r"""
+    Secondaries can sync their storage files for groups of
+    transactions, rather than for each:
+
+    >>> fs = ZODB.FileStorage.FileStorage('Data.fs')
+    >>> ss = zc.zrs.secondary.Secondary(fs, ('', 8000), reactor,
+    ...                                 group_sync_interval=60,
+    ...                                 group_sync_transactions=3)
+    INFO zc.zrs.secondary:
+    Opening Data.fs ('', 8000)
+    INFO zc.zrs.reactor:
+    Starting factory <zc.zrs.secondary.SecondaryFactory>
+    >>> class DB:
+    ...     def invalidate(self, tid, oids):
+    ...         print('invalidate', tids.index(tid), sorted(oids))
+    >>> ss.registerDB(DB())
+
+    >>> connection = reactor.accept()
+    INFO zc.zrs.secondary:
+    IPv4Address(TCP, '127.0.0.1', 47245): Connected
+    >>> connection.read(), connection.read()
+    (b'zrs2.0', b'\x00\x00\x00\x00\x00\x00\x00\x00')
+
+    The storage's own method commits transactions, with the file
+    storage module's fsync function skipping syncs of its file while
+    it does.  Other file storages still sync each transaction:
+
+    >>> synced = []
+    >>> original_fsync = zc.zrs.groupsync.original_fsync
+    >>> def record_fsync(fileno):
+    ...     synced.append(fileno)
+    ...     original_fsync(fileno)
+    >>> zc.zrs.groupsync.original_fsync = record_fsync
+
+    >>> primary_fs = ZODB.FileStorage.FileStorage('primary.fs')
+    >>> primary_db = ZODB.DB(primary_fs)
+    >>> primary_conn = primary_db.open()
+    >>> for i in range(5):
+    ...     primary_conn.root()[i] = i
+    ...     commit()
+    >>> tids = [trans.tid for trans in primary_fs.iterator()]
+    >>> primary_fs._file.fileno() in synced
+    True
+
+    >>> encoder = zc.zrs.messages.PickleEncoder()
+    >>> connection.init_md5(b'\0'*8)
+    >>> it = zc.zrs.primary.FileStorageIterator(primary_fs)
+    >>> def send():
+    ...     trans = it.next()
+    ...     for message in zc.zrs.primary.transaction_messages(
+    ...             primary_fs, trans, trans, encoder, None):
+    ...         connection.send(message, raw=True)
+    ...     connection.send(encoder.commit(connection.md5.digest()),
+    ...                     raw=True)
+
+    Transactions are committed without syncing the file.  Until it's
+    synced, they aren't durable.  The secondary's lastTransaction
+    method doesn't return them and databases aren't told about them,
+    but the storage has them, and replication continues after them:
+
+    >>> send(); send()
+    >>> fs.lastTransaction() == tids[1]
+    True
+    >>> ss.lastTransaction() == ZODB.utils.z64
+    True
+    >>> fs._file.fileno() in synced
+    False
+
+    The file is synced once group_sync_transactions have been
+    committed since the last sync:
+
+    >>> send(); time.sleep(0.1)
+    invalidate 0 [b'\x00\x00\x00\x00\x00\x00\x00\x00']
+    invalidate 1 [b'\x00\x00\x00\x00\x00\x00\x00\x00']
+    invalidate 2 [b'\x00\x00\x00\x00\x00\x00\x00\x00']
+    >>> ss.lastTransaction() == tids[2]
+    True
+    >>> group_sync = ss._factory.group_sync
+    >>> group_sync.syncs, group_sync.synced
+    (1, 3)
+
+    or at most group_sync_interval seconds after the first of them was
+    committed:
+
+    >>> group_sync.interval = 0.05
+    >>> send(); ss.lastTransaction() == tids[2]
+    True
+    >>> time.sleep(0.2)
+    invalidate 3 [b'\x00\x00\x00\x00\x00\x00\x00\x00']
+    >>> ss.lastTransaction() == tids[3]
+    True
+
+    A reconnecting secondary asks for the transactions after the last
+    one its storage has, durable or not:
+
+    >>> group_sync.interval = 60
+    >>> send()
+    >>> connection.fail() # doctest: +NORMALIZE_WHITESPACE
+    INFO zc.zrs.secondary:
+    IPv4Address(TCP, '127.0.0.1', 47245): Disconnected 'failed'
+    INFO zc.zrs.reactor:
+    Stopping factory <zc.zrs.secondary.SecondaryFactory>
+    >>> reactor.doLater()
+    INFO zc.zrs.reactor:
+    Starting factory <zc.zrs.secondary.SecondaryFactory>
+    >>> connection = reactor.accept()
+    INFO zc.zrs.secondary:
+    IPv4Address(TCP, '127.0.0.1', 47246): Connected
+    >>> connection.read(), connection.read() == tids[4]
+    (b'zrs2.0', True)
+    >>> ss.lastTransaction() == tids[3]
+    True
+
+    Closing syncs what's been committed since the last sync:
+
+    >>> ss.close() # doctest: +ELLIPSIS
+    INFO zc.zrs.secondary:
+    Closing Data.fs ('', 8000)
+    ...
+    invalidate 4 [b'\x00\x00\x00\x00\x00\x00\x00\x00']
+    >>> group_sync.lastTransaction() == tids[4]
+    True
+
+    Group syncs need a file storage:
+
+    >>> import ZODB.MappingStorage
+    >>> ss = zc.zrs.secondary.Secondary(
+    ...     ZODB.MappingStorage.MappingStorage(), ('', 8000), reactor,
+    ...     group_sync_interval=1)
+    ... # doctest: +NORMALIZE_WHITESPACE
+    WARNING zc.zrs.secondary:
+    Can't group syncs for MappingStorage
+    INFO zc.zrs.secondary:
+    Opening MappingStorage ('', 8000)
+    INFO zc.zrs.reactor:
+    Starting factory <zc.zrs.secondary.SecondaryFactory>
+    >>> ss._factory.group_sync
+    >>> ss.close() # doctest: +ELLIPSIS
+    INFO zc.zrs.secondary:
+    Closing MappingStorage ('', 8000)
+    ...
+    >>> primary_db.close()
+    >>> zc.zrs.groupsync.original_fsync = original_fsync
+
+    Snapshots don't need group syncs, so secondaries that can't group
+    syncs can still ask for them:
+
+    >>> supported = zc.zrs.groupsync.supported
+    >>> zc.zrs.groupsync.supported = lambda fs: False
+    >>> ss = zc.zrs.secondary.Secondary(
+    ...     ZODB.FileStorage.FileStorage('Empty.fs'), ('', 8000), reactor,
+    ...     group_sync_interval=1, snapshot_bootstrap=True)
+    WARNING zc.zrs.secondary:
+    Can't group syncs for Empty.fs
+    INFO zc.zrs.secondary:
+    Opening Empty.fs ('', 8000)
+    INFO zc.zrs.reactor:
+    Starting factory <zc.zrs.secondary.SecondaryFactory>
+    >>> ss._factory.features
+    {'bootstrap': 'snapshot'}
+    >>> ss.close() # doctest: +ELLIPSIS
+    INFO zc.zrs.secondary:
+    Closing Empty.fs ('', 8000)
+    ...
+    >>> zc.zrs.groupsync.supported = supported
+    """
+
+def secondary_chunked_records():
+    r"""
+    >>> fs = ZODB.FileStorage.FileStorage('Data.fs')
+    >>> ss = zc.zrs.secondary.Secondary(fs, ('', 8000), reactor,
+    ...                                 chunk_size=10000)
+    INFO zc.zrs.secondary:
+    Opening Data.fs ('', 8000)
+    INFO zc.zrs.reactor:
+    Starting factory <zc.zrs.secondary.SecondaryFactory>
+
+    >>> connection = reactor.accept()
+    INFO zc.zrs.secondary:
+    IPv4Address(TCP, '127.0.0.1', 47245): Connected
+    >>> connection.read(), connection.read(), connection.read()
+    (b'zrs3.0', b'chunk-size=10000', b'\x00\x00\x00\x00\x00\x00\x00\x00')
+    >>> connection.send(b'chunk-size=10000', raw=True)
+    INFO zc.zrs.secondary:
+    IPv4Address(TCP, '127.0.0.1', 47245): features {'chunk-size': ['10000']}
+
+    >>> primary_fs = ZODB.FileStorage.FileStorage('primary.fs')
+    >>> primary_db = ZODB.DB(primary_fs)
+    >>> primary_conn = primary_db.open()
+    >>> primary_conn.root()['x'] = b'x' * 25000
+    >>> commit()
+    >>> primary_data = zc.zrs.primary.FileStorageIterator(
+    ...     primary_fs, chunk_size=10000)
+
+    >>> encoder = zc.zrs.messages.PickleEncoder()
+    >>> connection.init_md5(b'\0'*8)
+    >>> for i in range(2):
+    ...     trans = primary_data.next()
+    ...     connection.send(encoder.transaction(trans), raw=True)
+    ...     for record in trans:
+    ...         if isinstance(record, zc.zrs.primary.LargeRecord):
+    ...             connection.send(encoder.large(record, record.size),
+    ...                             raw=True)
+    ...             for chunk in record.chunks(10000):
+    ...                 connection.send(chunk, raw=True)
+    ...         else:
+    ...             connection.send(encoder.store(record), raw=True)
+    ...             connection.send(record.data, raw=True)
+    ...     connection.send(encoder.commit(connection.md5.digest()), raw=True)
+
+    >>> fs.lastTransaction() == primary_fs.lastTransaction()
+    True
+    >>> fs.load(ZODB.utils.z64) == primary_fs.load(ZODB.utils.z64)
+    True
+
+    Sending more data than announced is an error:
+
+    >>> primary_conn.root()['x'] = b'y' * 25000
+    >>> commit()
+    >>> trans = primary_data.next()
+    >>> connection.send(encoder.transaction(trans), raw=True)
+    >>> record = trans.next()
+    >>> connection.send(encoder.large(record, record.size), raw=True)
+    >>> connection.send(b'x' * 30000, raw=True) # doctest: +ELLIPSIS
+    CRITICAL zc.zrs.secondary:
+    IPv4Address(TCP, '127.0.0.1', 47245): Input data error
+    Traceback (most recent call last):
+    ...
+    ValueError: Too much record data
+    ...
+
+    >>> ss.close() # doctest: +ELLIPSIS
+    INFO zc.zrs.secondary:
+    Closing Data.fs ('', 8000)
+    ...
+    >>> primary_db.close()
+    """
+
+def secondary_queue_notices():
+    r"""
+    Secondaries can ask to be told when they have to wait to catch up:
+
+    >>> fs = ZODB.FileStorage.FileStorage('Data.fs')
+    >>> ss = zc.zrs.secondary.Secondary(fs, ('', 8000), reactor,
+    ...                                 binary_headers=True,
+    ...                                 queue_notices=True)
+    INFO zc.zrs.secondary:
+    Opening Data.fs ('', 8000)
+    INFO zc.zrs.reactor:
+    Starting factory <zc.zrs.secondary.SecondaryFactory>
+
+    >>> connection = reactor.accept()
+    INFO zc.zrs.secondary:
+    IPv4Address(TCP, '127.0.0.1', 47245): Connected
+    >>> connection.read(), connection.read(), connection.read()
+    (b'zrs3.0', b'headers=binary notices=queue', b'\x00\x00\x00\x00\x00\x00\x00\x00')
+    >>> connection.send(b'headers=binary notices=queue', raw=True)
+    INFO zc.zrs.secondary:
+    IPv4Address(TCP, '127.0.0.1', 47245): features {'headers': ['binary'], 'notices': ['queue']}
+
+    Notices are logged:
+
+    >>> encoder = zc.zrs.messages.BinaryEncoder()
+    >>> connection.init_md5(b'\0'*8)
+    >>> connection.send(encoder.queued(2, 0), raw=True)
+    INFO zc.zrs.secondary:
+    IPv4Address(TCP, '127.0.0.1', 47245): Waiting to catch up, at position 2, after 0 seconds
+    >>> connection.send(encoder.queued(1, 30), raw=True)
+    INFO zc.zrs.secondary:
+    IPv4Address(TCP, '127.0.0.1', 47245): Waiting to catch up, at position 1, after 30 seconds
+    >>> connection.send(encoder.queued(0, 42), raw=True)
+    INFO zc.zrs.secondary:
+    IPv4Address(TCP, '127.0.0.1', 47245): Catching up after waiting 42 seconds
+
+    and are covered by checksums, like other messages:
+
+    >>> primary_fs = ZODB.FileStorage.FileStorage('primary.fs')
+    >>> primary_db = ZODB.DB(primary_fs)
+    >>> primary_data = zc.zrs.primary.FileStorageIterator(primary_fs)
+    >>> trans = primary_data.next()
+    >>> connection.send(encoder.transaction(trans), raw=True)
+    >>> for record in trans:
+    ...     connection.send(encoder.store(record), raw=True)
+    ...     connection.send(record.data, raw=True)
+    >>> connection.send(encoder.commit(connection.md5.digest()), raw=True)
+    >>> fs.lastTransaction() == primary_fs.lastTransaction()
+    True
+
+    >>> ss.close() # doctest: +ELLIPSIS
+    INFO zc.zrs.secondary:
+    Closing Data.fs ('', 8000)
+    ...
+    >>> primary_db.close()
+    """
+
+def primary_shared_tail():
+    r"""
+    Once secondaries that use per-transaction checksums have caught
+    up, they follow a shared tail, which encodes each new transaction
+    once for each encoding in use:
+
+    >>> import logging
+    >>> logging.getLogger('zc.zrs').setLevel(logging.INFO)
+
+    >>> fs = ZODB.FileStorage.FileStorage('Data.fs')
+    >>> ps = zc.zrs.primary.Primary(fs, ('', 8000), reactor)
+    INFO zc.zrs.primary:
+    Opening Data.fs ('', 8000)
+    >>> db = ZODB.DB(ps)
+    >>> conn = db.open()
+    >>> conn.root()['x'] = 1
+    >>> commit()
+
+    >>> def connect(offers):
+    ...     connection = reactor.connect(('', 8000))
+    ...     connection.send(b"zrs3.0")
+    ...     connection.send(offers)
+    ...     _ = connection.read(True)
+    ...     connection.send(b"\0"*8)
+    ...     return connection
+
+    >>> def read_transaction(connection, decode=cPickle.loads):
+    ...     messages = [connection.read(True)]
+    ...     while 1:
+    ...         message = connection.read(True)
+    ...         messages.append(message)
+    ...         if decode(message)[0] == 'C':
+    ...             break
+    ...         messages.append(connection.read(True))
+    ...     checksum = md5(b''.join(messages[:-1])).digest()
+    ...     print(decode(messages[-1])[1] == (checksum, ))
+    ...     return messages
+
+    >>> c1 = connect(b"checksum-scope=transaction") # doctest: +ELLIPSIS
+    INFO zc.zrs.primary:
+    ...
+    >>> c2 = connect(b"checksum-scope=transaction") # doctest: +ELLIPSIS
+    INFO zc.zrs.primary:
+    ...
+    >>> c3 = connect(b"checksum-scope=transaction headers=binary")
+    ... # doctest: +ELLIPSIS
+    INFO zc.zrs.primary:
+    ...
+
+    >>> from zc.zrs.messages import decode_binary
+    >>> for i in range(2):
+    ...     _ = read_transaction(c1), read_transaction(c2)
+    ...     _ = read_transaction(c3, decode_binary)
+    True
+    True
+    True
+    True
+    True
+    True
+
+    >>> tail = ps._factory.tail
+    >>> def wait_for_followers(n):
+    ...     for i in range(500):
+    ...         if len(tail.followers) == n:
+    ...             break
+    ...         time.sleep(.01)
+    ...     print(len(tail.followers))
+    >>> wait_for_followers(3)
+    3
+
+    >>> encodings = []
+    >>> encode = tail.encode
+    >>> def count_encode(encoding, *args):
+    ...     encodings.append(encoding)
+    ...     return encode(encoding, *args)
+    >>> tail.encode = count_encode
+
+    >>> conn.root()['x'] = 2
+    >>> commit()
+    >>> m1, m2 = read_transaction(c1), read_transaction(c2)
+    True
+    True
+    >>> m3 = read_transaction(c3, decode_binary)
+    True
+    >>> m1 == m2, m1 == m3
+    (True, False)
+    >>> sorted(encodings)
+    [(False, 'md5', None, None, False), (True, 'md5', None, None, False)]
+
+    Followers with too much waiting to be sent are detached.  They
+    catch up on their own and then follow the tail again:
+
+    >>> tail.max_queued = 10
+    >>> conn.root()['x'] = 3
+    >>> commit()
+    >>> _ = read_transaction(c1), read_transaction(c2)
+    True
+    True
+    >>> _ = read_transaction(c3, decode_binary)
+    True
+    >>> wait_for_followers(3)
+    3
+
+    Secondaries that checksum the whole stream don't follow the tail:
 
+    >>> c4 = connect(b"checksum=md5") # doctest: +ELLIPSIS
+    INFO zc.zrs.primary:
+    ...
+    >>> for i in range(3):
+    ...     _ = c4.read()
+    ...     while c4.read()[0] != 'C':
+    ...         _ = c4.read(True)
+    >>> wait_for_followers(3)
+    3
+
+    >>> db.close() # doctest: +ELLIPSIS
+    INFO zc.zrs.primary:
+    Closing Data.fs ('', 8000)
+    ...
     """
 
-def close_writes_new_transactions():
+def primary_transaction_buffer():
     r"""
-    We want close to try to write pending transactions, even if it
-    means that close will take a long time.
+    Primaries can keep recent transactions in memory, encoded for
+    sending, for secondaries that use per-transaction checksums:
+
+    >>> import logging
+    >>> logging.getLogger('zc.zrs').setLevel(logging.INFO)
 
-    >>> import ZODB.FileStorage, zc.zrs.primary, persistent.dict
     >>> fs = ZODB.FileStorage.FileStorage('Data.fs')
-    >>> ps = zc.zrs.primary.Primary(fs, ('', 8000), reactor)
+    >>> ps = zc.zrs.primary.Primary(fs, ('', 8000), reactor,
+    ...                             transaction_buffer_size=1<<20)
     INFO zc.zrs.primary:
     Opening Data.fs ('', 8000)
-
     >>> db = ZODB.DB(ps)
     >>> conn = db.open()
-    >>> ob = conn.root()
-    >>> ob.x = 0
+    >>> conn.root()['x'] = 0
     >>> commit()
 
-    >>> committed = 2
+    >>> def connect(tid=b"\0"*8):
+    ...     connection = reactor.connect(('', 8000))
+    ...     connection.send(b"zrs3.0")
+    ...     connection.send(b"checksum-scope=transaction")
+    ...     _ = connection.read(True)
+    ...     connection.send(tid)
+    ...     return connection
 
-    We'll open lots of connections: :)
+    >>> def read_transaction(connection):
+    ...     tid = connection.read()[1][0]
+    ...     while connection.read()[0] != 'C':
+    ...         _ = connection.read(True)
+    ...     return tid
 
-    >>> nconnections = 10
-    >>> connections = []
-    >>> for i in range(nconnections):
-    ...     connection = reactor.connect(('', 8000))
-    ...     connection.send(b"zrs2.0")
-    ...     connection.send(b"\0"*8)
-    ...     connections.append(connection)
-    ...     # doctest: +ELLIPSIS
-    INFO zc.zrs.primary:...
+    The buffer is empty until a secondary has caught up:
 
-    >>> import time
-    >>> time.sleep(.1)
+    >>> c1 = connect() # doctest: +ELLIPSIS
+    INFO zc.zrs.primary:
+    ...
+    >>> tids = [read_transaction(c1), read_transaction(c1)]
+    >>> ps.getTransactionBufferStats()
+    {'size': 0, 'transactions': 0, 'hits': 0, 'misses': 1}
+
+    >>> tail = ps._factory.tail
+    >>> for i in range(500):
+    ...     if tail.followers:
+    ...         break
+    ...     time.sleep(.01)
+
+    >>> for i in range(3):
+    ...     conn.root()['x'] = i + 1
+    ...     commit()
+    ...     tids.append(read_transaction(c1))
+    >>> stats = ps.getTransactionBufferStats()
+    >>> stats['transactions'], stats['size'] > 0
+    (3, True)
 
-    >>> for i in range(300):
-    ...     ob[i] = persistent.dict.PersistentDict()
+    A secondary that's missing only buffered transactions gets them
+    from the buffer:
 
-    >>> commit()
-    >>> committed += 1
+    >>> c2 = connect(tids[1]) # doctest: +ELLIPSIS
+    INFO zc.zrs.primary:
+    ...
+    >>> [read_transaction(c2) for i in range(3)] == tids[2:]
+    True
+    >>> ps.getTransactionBufferStats()['hits']
+    1
 
-    >>> db.close()
-    ...     # doctest: +ELLIPSIS
-    INFO zc.zrs.primary:...
+    One that's missing more reads the file:
 
-    >>> for i in range(nconnections):
-    ...     connection = connections[i]
-    ...     trans = message_type = x = None
-    ...     ntrans = 0
-    ...     while connection.have_data():
-    ...         message_type, data = connection.read()
-    ...         if message_type == 'T':
-    ...             trans = data
-    ...             ntrans += 1
-    ...         elif message_type == 'S':
-    ...             x = connection.read(True)
-    ...     if message_type != 'C' or ntrans != committed:
-    ...         print(i, message_type, ntrans)
+    >>> c3 = connect(tids[0]) # doctest: +ELLIPSIS
+    INFO zc.zrs.primary:
+    ...
+    >>> [read_transaction(c3) for i in range(4)] == tids[1:]
+    True
+    >>> stats = ps.getTransactionBufferStats()
+    >>> stats['hits'], stats['misses']
+    (1, 2)
 
+    Old transactions are discarded to keep the buffer within its size:
+
+    >>> tail.buffer_size = stats['size'] // 3 * 2
+    >>> conn.root()['x'] = 9
+    >>> commit()
+    >>> for c in c1, c2, c3:
+    ...     _ = read_transaction(c)
+    >>> ps.getTransactionBufferStats()['transactions']
+    2
+
+    >>> db.close() # doctest: +ELLIPSIS
+    INFO zc.zrs.primary:
+    Closing Data.fs ('', 8000)
+    ...
     """
 
-def secondary_gives_a_tid_that_is_too_high():
+def primary_worker_pool():
     r"""
-    We should error and close the connection if a secondary presents a
-    tid that is higher than the largest tid seen by the primary.
+    Primaries send data to secondaries using a bounded pool of
+    threads.  Each secondary is served by a task:
+
+    >>> import logging
+    >>> logging.getLogger('zc.zrs').setLevel(logging.INFO)
 
-    >>> import ZODB.FileStorage
     >>> fs = ZODB.FileStorage.FileStorage('Data.fs')
-    >>> import zc.zrs.primary
-    >>> ps = zc.zrs.primary.Primary(fs, ('', 8000), reactor)
+    >>> ps = zc.zrs.primary.Primary(fs, ('', 8000), reactor,
+    ...                             worker_pool_size=2)
     INFO zc.zrs.primary:
     Opening Data.fs ('', 8000)
-
-    >>> from ZODB.DB import DB
-    >>> import persistent.dict
-    >>> db = DB(ps)
+    >>> db = ZODB.DB(ps)
     >>> conn = db.open()
-    >>> ob = conn.root()
-    >>> ob.x = persistent.dict.PersistentDict()
-    >>> commit()
 
-    >>> import ZODB.utils
-    >>> too_high_tid = ZODB.utils.p64(ZODB.utils.u64(ob._p_serial)+1)
+    >>> def read_transaction(connection):
+    ...     tid = connection.read()[1][0]
+    ...     while connection.read()[0] != 'C':
+    ...         _ = connection.read(True)
+    ...     return tid
 
-    >>> connection = reactor.connect(('', 8000))
+    >>> connections = []
+    >>> for i in range(5):
+    ...     connection = reactor.connect(('', 8000))
+    ...     connection.send(b"zrs2.0")
+    ...     connection.send(b"\0"*8)
+    ...     connections.append(connection)
+    ...     # doctest: +ELLIPSIS
     INFO zc.zrs.primary:
-    IPv4Address(TCP, '127.0.0.1', 47245): Connected
+    ...
+    >>> len(set(read_transaction(c) for c in connections))
+    1
 
-    >>> connection.send(b"zrs2.0") # doctest: +NORMALIZE_WHITESPACE
-    >>> connection.send(too_high_tid); time.sleep(.01) # wait for thread :(
-    ... # doctest: +NORMALIZE_WHITESPACE +ELLIPSIS
+    Tasks waiting for transactions don't use threads, so 5
+    secondaries are served by 2 threads:
+
+    >>> stats = ps.getWorkerPoolStats()
+    >>> stats['size'], stats['tasks'], stats['threads'] <= 2
+    (2, 5, True)
+
+    >>> for i in range(3):
+    ...     conn.root()[i] = i
+    ...     commit()
+    >>> all(len(set(read_transaction(c) for c in connections)) == 1
+    ...     for i in range(3))
+    True
+
+    >>> db.close() # doctest: +ELLIPSIS
     INFO zc.zrs.primary:
-    IPv4Address(TCP, '127.0.0.1', 47245):
-    start b'\x03lk\x90\xf7wwx' (2007-03-21 20:32:58.000000)
-    ERROR zc.zrs.primary:
-    IPv4Address(TCP, '127.0.0.1', 47245):
-    Traceback (most recent call last):
+    Closing Data.fs ('', 8000)
     ...
-    zc.zrs.primary.TidTooHigh: b'\x03lk\x90\xf7wwx'
-    INFO zc.zrs.primary:
-    IPv4Address(TCP, '127.0.0.1', 47245):
-    Disconnected
-    <twisted.python.failure.Failure
-      twisted.internet.error.ConnectionDone: Connection was closed cleanly.>
-
-    """
 
+    Once the tasks are done, so are the threads:
 
-class FauxScanControl(object):
-    _v = True
-    _n = 0
-    def get(self):
-        self._n += 1
-        if self._n > 10:
-            time.sleep(.01)
-        if self._n > 20:
-           print(self._n)
-        return self._v
-    def set(self, v):
-        self._v = v
-    not_stopped = property(get, set)
+    >>> for i in range(500):
+    ...     if not ps.getWorkerPoolStats()['threads']:
+    ...         break
+    ...     time.sleep(.01)
+    >>> ps.getWorkerPoolStats()
+    {'size': 2, 'threads': 0, 'busy': 0, 'ready': 0, 'tasks': 0}
+    """
 
-def scan_control_stops_scans_on_client_disconnects():
+def primary_max_catch_ups():
     r"""
-    We want to be able to limit iterator scans if a client disconnects, for
-    example, to limit impact on the server if a large scan is required.
+    Primaries can limit the number of secondaries catching up from far
+    behind at once:
+
+    >>> import logging
+    >>> logging.getLogger('zc.zrs').setLevel(logging.WARNING)
 
     >>> fs = ZODB.FileStorage.FileStorage('Data.fs')
-    >>> import persistent.dict
-    >>> db = ZODB.DB(fs)
+    >>> ps = zc.zrs.primary.Primary(fs, ('', 8000), reactor,
+    ...                             max_catch_ups=1)
+    >>> db = ZODB.DB(ps)
     >>> conn = db.open()
-    >>> ob = conn.root()
     >>> for i in range(100):
-    ...     ob[i] = persistent.dict.PersistentDict()
-    ...     commit()
-    >>> tid1 = ob._p_serial
-    >>> for i in range(100, 200):
-    ...     ob[i] = persistent.dict.PersistentDict()
-    ...     commit()
-    >>> tid2 = ob._p_serial
-    >>> for i in range(200, 300):
-    ...     ob[i] = persistent.dict.PersistentDict()
+    ...     conn.root()['x'] = i
     ...     commit()
+    >>> tids = [trans.tid for trans in fs.iterator()]
 
-    >>> ps = zc.zrs.primary.Primary(fs, ('', 8000), reactor)
-    INFO zc.zrs.primary:
-    Opening Data.fs ('', 8000)
+    >>> def connect(tid, offers=b"notices=queue"):
+    ...     connection = reactor.connect(('', 8000))
+    ...     connection.send(b"zrs3.0")
+    ...     connection.send(offers)
+    ...     _ = connection.read(True)
+    ...     connection.send(tid)
+    ...     return connection
+
+    >>> def read_transaction(connection):
+    ...     tid = connection.read()[1][0]
+    ...     while connection.read()[0] != 'C':
+    ...         _ = connection.read(True)
+    ...     return tid
+
+    We'll take the only place ourselves:
+
+    >>> admission = ps._factory.admission
+    >>> ticket = admission.request(1000, lambda : None)
+    >>> ps.getCatchUpStats()
+    {'limit': 1, 'admitted': 1, 'waiting': 0}
+
+    Secondaries that are far behind have to wait.  Those that asked
+    are told where they are in the queue, and how many seconds they've
+    waited.  Those least far behind go first:
+
+    >>> c1 = connect(b"\0"*8)
+    >>> c1.read()
+    ('Q', (1, 0.0))
+    >>> c2 = connect(tids[10])
+    >>> c2.read()
+    ('Q', (1, 0.0))
+    >>> c1.read()
+    ('Q', (2, 0.0))
+    >>> ps.getCatchUpStats()
+    {'limit': 1, 'admitted': 1, 'waiting': 2}
+
+    Secondaries that are only a little behind don't wait:
+
+    >>> c3 = connect(tids[-2])
+    >>> read_transaction(c3) == tids[-1]
+    True
 
-    >>> import time
-    >>> ScanControl = zc.zrs.primary.ScanControl
-    >>> zc.zrs.primary.ScanControl = FauxScanControl
+    When a place is free, the next secondary is admitted.  When it has
+    caught up, it gives up its place:
 
-    >>> connection = reactor.connect(('', 8000))
-    INFO zc.zrs.primary:
-    IPv4Address(TCP, '127.0.0.1', 47245): Connected
+    >>> def admitted(connection):
+    ...     while 1:
+    ...         message_type, (position, waited) = connection.read()
+    ...         assert message_type == 'Q'
+    ...         if not position:
+    ...             return True
 
-    >>> connection.send(b"zrs2.0") # doctest: +NORMALIZE_WHITESPACE
-    >>> connection.send(tid1) # doctest: +NORMALIZE_WHITESPACE
-    INFO zc.zrs.primary:
-    IPv4Address(TCP, '127.0.0.1', 47245):
-    start b'\x03lk\x92\x9d\xdd\xdd\xdd' (2007-03-21 20:34:37.000000)
-    >>> connection.loseConnection() # doctest: +NORMALIZE_WHITESPACE
-    INFO zc.zrs.primary:
-    IPv4Address(TCP, '127.0.0.1', 47245): Disconnected
-    <twisted.python.failure.Failure
-      twisted.internet.error.ConnectionDone: Connection was closed cleanly.>
+    >>> admission.release(ticket)
+    >>> admitted(c2)
+    True
+    >>> [read_transaction(c2) for tid in tids[11:]] == tids[11:]
+    True
+    >>> admitted(c1)
+    True
+    >>> [read_transaction(c1) for tid in tids] == tids
+    True
 
+    >>> for i in range(500):
+    ...     if not ps.getCatchUpStats()['admitted']:
+    ...         break
+    ...     time.sleep(.01)
+    >>> ps.getCatchUpStats()
+    {'limit': 1, 'admitted': 0, 'waiting': 0}
 
-    >>> connection = reactor.connect(('', 8000))
-    INFO zc.zrs.primary:
-    IPv4Address(TCP, '127.0.0.1', 47246): Connected
+    The limit can be changed at run time:
 
-    >>> connection.send(b"zrs2.0") # doctest: +NORMALIZE_WHITESPACE
-    >>> connection.send(tid2) # doctest: +NORMALIZE_WHITESPACE
-    INFO zc.zrs.primary:
-    IPv4Address(TCP, '127.0.0.1', 47246):
-    start b'\x03lk\x94H\x88\x88\x88' (2007-03-21 20:36:17.000000)
+    >>> ps.setMaxCatchUps(None)
+    >>> ps.getCatchUpStats()
+    {'limit': None, 'admitted': 0, 'waiting': 0}
 
-    >>> connection.loseConnection() # doctest: +NORMALIZE_WHITESPACE
-    INFO zc.zrs.primary:
-    IPv4Address(TCP, '127.0.0.1', 47246): Disconnected
-    <twisted.python.failure.Failure
-      twisted.internet.error.ConnectionDone: Connection was closed cleanly.>
+    >>> db.close()
 
-    >>> time.sleep(.1)
-    >>> zc.zrs.primary.ScanControl = ScanControl
+    Waiting tickets are kept in order, and only those admitted, or
+    whose positions changed, are woken:
+
+    >>> import zc.zrs.admission
+    >>> scheduler = zc.zrs.admission.AdmissionScheduler(1, 0)
+    >>> woken = []
+    >>> def request(lag, name):
+    ...     return scheduler.request(lag, lambda : woken.append(name))
+    >>> a = request(10, 'a')
+    >>> b = request(30, 'b')
+    >>> c = request(20, 'c')
+    >>> d = request(40, 'd')
+    >>> woken
+    ['a', 'b']
+    >>> [scheduler.position(ticket) for ticket in (a, b, c, d)]
+    [0, 2, 1, 3]
+
+    >>> del woken[:]
+    >>> scheduler.release(b)
+    >>> woken
+    ['d']
+    >>> del woken[:]
+    >>> scheduler.release(a)
+    >>> woken
+    ['c', 'd']
+    >>> [scheduler.position(ticket) for ticket in (c, d)]
+    [0, 1]
     """
 
-def record_iternext():
-    """
+def primary_tid_index():
+    r"""
+    Primaries keep a sparse index of the positions of transactions in
+    their storage files, so they can find where to start sending to a
+    secondary without searching the file:
+
+    >>> import logging
+    >>> logging.getLogger('zc.zrs').setLevel(logging.WARNING)
+
+    Small files are indexed right away.  We'll index in the background,
+    as we would for large files:
+
+    >>> background_size = zc.zrs.tidindex.TidIndex.background_size
+    >>> zc.zrs.tidindex.TidIndex.background_size = 0
+
     >>> fs = ZODB.FileStorage.FileStorage('Data.fs')
-    >>> ps = zc.zrs.primary.Primary(fs, ('', 8000), reactor)
-    INFO zc.zrs.primary:
-    Opening Data.fs ('', 8000)
-    >>> ss = zc.zrs.secondary.Secondary(ps, ('', 9000), reactor)
-    INFO zc.zrs.secondary:
-    Opening Data.fs ('', 9000)
-    INFO zc.zrs.reactor:
-    Starting factory <zc.zrs.secondary.SecondaryFactory instance at 0xb654796c>
+    >>> ps = zc.zrs.primary.Primary(fs, ('', 8000), reactor,
+    ...                             tid_index_interval=1000)
+    >>> db = ZODB.DB(ps)
+    >>> conn = db.open()
+    >>> for i in range(100):
+    ...     conn.root()['x'] = i
+    ...     commit()
+    >>> tids = [trans.tid for trans in fs.iterator()]
+
+    Indexed transactions are at least tid_index_interval bytes apart:
+
+    >>> index = ps._tid_index
+    >>> index.thread.join()
+    >>> ps.getTidIndexStats()
+    {'entries': 15, 'building': False}
+    >>> index.positions[:3]
+    [4, 1054, 2090]
+
+    >>> def check(index):
+    ...     with open('Data.fs', 'rb') as f:
+    ...         for tid, pos in zip(index.tids, index.positions):
+    ...             f.seek(pos)
+    ...             assert f.read(8) == tid
+    ...     return len(index.positions)
+    >>> check(index)
+    15
+
+    Iterators use the index to find their starting positions:
+
+    >>> def check_starts(index, tids):
+    ...     for i, tid in enumerate(tids[:-1]):
+    ...         it = zc.zrs.primary.FileStorageIterator(
+    ...             fs, start=tid, index=index)
+    ...         assert next(it).tid == tids[i+1]
+    ...         it._file.close()
+    >>> check_starts(index, tids)
+
+    The index is saved next to the storage file and used when the
+    primary is reopened:
 
-    >>> ps.record_iternext == fs.record_iternext
-    True
+    >>> db.close()
+    >>> with open('Data.fs.tidindex', 'rb') as f:
+    ...     len(f.read())
+    248
 
-    >>> ss.record_iternext == fs.record_iternext
-    True
+    >>> fs = ZODB.FileStorage.FileStorage('Data.fs')
+    >>> ps = zc.zrs.primary.Primary(fs, ('', 8000), reactor,
+    ...                             tid_index_interval=1000)
+    >>> index = ps._tid_index
+    >>> index.thread.join()
+    >>> check(index)
+    15
 
-    """
+    If the storage file is packed, the index is rebuilt when it's next
+    used.  Commits only note transactions, so they aren't held up by
+    rebuilding the index, even right after a pack:
 
-def is_blob_record():
-    r"""
-    >>> fs = ZODB.FileStorage.FileStorage('Data.fs', blob_dir='blobs')
-    >>> db = ZODB.DB(fs)
+    >>> db = ZODB.DB(ps)
+    >>> db.pack()
     >>> conn = db.open()
-    >>> conn.root()['blob'] = ZODB.blob.Blob()
-    >>> transaction.commit()
-    >>> zc.zrs.primary.is_blob_record(fs.load(ZODB.utils.p64(0), '')[0])
-    False
-    >>> zc.zrs.primary.is_blob_record(fs.load(ZODB.utils.p64(1), '')[0])
+    >>> conn.root()['x'] = 100
+    >>> commit()
+    >>> index.thread is None or not index.thread.is_alive()
     True
+    >>> index.file is fs._file, index.pending
+    (False, None)
+    >>> len(index.added)
+    1
 
-    An invalid pickle yields a false value:
+    >>> _ = index.find(tids[-1])
+    >>> index.thread.join()
+    >>> tids = [trans.tid for trans in fs.iterator()]
+    >>> check(index), len(tids), len(index.added)
+    (1, 2, 0)
 
-    >>> zc.zrs.primary.is_blob_record("Hello world!")
-    False
-    >>> zc.zrs.primary.is_blob_record('c__main__\nC\nq\x01.')
-    False
+    If the index doesn't match the storage file, lookups fall back to
+    searching the file and the index is rebuilt:
+
+    >>> for i in range(100):
+    ...     conn.root()['x'] = i
+    ...     commit()
+    >>> tids = [trans.tid for trans in fs.iterator()]
+    >>> ps.getTidIndexStats()
+    {'entries': 15, 'building': False}
+    >>> index.positions[-1] += 1
+    >>> it = zc.zrs.primary.FileStorageIterator( # doctest: +ELLIPSIS
+    ...     fs, start=tids[-2], index=index)
+    WARNING zc.zrs.primary:
+    /tmp/.../Data.fs transaction index is wrong at ...
+    WARNING zc.zrs.tidindex:
+    Rebuilding /tmp/.../Data.fs.tidindex
+    >>> next(it).tid == tids[-1]
+    True
+    >>> it._file.close()
+    >>> index.thread.join()
+    >>> check(index)
+    15
+    >>> check_starts(index, tids)
+
+    Invalid index files are ignored:
 
     >>> db.close()
+    >>> with open('Data.fs.tidindex', 'wb') as f:
+    ...     _ = f.write(b'nonsense')
+    >>> fs = ZODB.FileStorage.FileStorage('Data.fs')
+    >>> ps = zc.zrs.primary.Primary( # doctest: +ELLIPSIS
+    ...     fs, ('', 8000), reactor, tid_index_interval=1000)
+    WARNING zc.zrs.tidindex:
+    Ignoring invalid /tmp/.../Data.fs.tidindex
+    >>> ps._tid_index.thread.join()
+    >>> check(ps._tid_index)
+    15
+    >>> ps.close()
+
+    >>> zc.zrs.tidindex.TidIndex.background_size = background_size
     """
 
 def secondary_replicate_from_old_zrs_that_doesnt_send_checksums():
@@ -1274,6 +4695,8 @@ class TestPrimary(zc.zrs.primary.Primary):
 class BasePrimaryStorageTests(StorageTestBase.StorageTestBase):
 
     use_blob_storage = False
+    primary_options = {}
+    secondary_options = {}
 
     def setUp(self):
         self.__pack = None
@@ -1329,9 +4752,10 @@ class BasePrimaryStorageTests(StorageTestBase.StorageTestBase):
             self.__pfs = ZODB.FileStorage.FileStorage('primary.fs', **kwargs)
             self.__sfs = ZODB.FileStorage.FileStorage('secondary.fs')
 
-        self._storage = self._wrap(TestPrimary(self.__pfs, addr, reactor))
+        self._storage = self._wrap(TestPrimary(self.__pfs, addr, reactor,
+                                               **self.primary_options))
         self.__ss = zc.zrs.secondary.Secondary(
-            self._wrap(self.__sfs), addr, reactor)
+            self._wrap(self.__sfs), addr, reactor, **self.secondary_options)
 
         p_pack = self._storage.pack
         def pack(*args, **kw):
@@ -1355,7 +4779,8 @@ class BasePrimaryStorageTests(StorageTestBase.StorageTestBase):
             else:
                 sfs = ZODB.FileStorage.FileStorage('secondary2.fs')
 
-            ss = zc.zrs.secondary.Secondary(sfs, addr, reactor)
+            ss = zc.zrs.secondary.Secondary(sfs, addr, reactor,
+                                            **self.secondary_options)
             self.catch_up(self.__pfs, sfs)
             self.__comparedbs(self.__pfs, sfs)
             ss.close()
@@ -1510,6 +4935,35 @@ class PrimaryStorageTestsWithBlobs(PrimaryStorageTests):
 
     use_blob_storage = True
 
+class PrimaryStorageTestsWithBlobLinks(PrimaryStorageTestsWithBlobs):
+
+    secondary_options = dict(link_blobs=True)
+
+class PrimaryStorageTestsWithBlobChannels(PrimaryStorageTestsWithBlobs):
+
+    secondary_options = dict(blob_channels=2)
+
+class PrimaryStorageTestsWithRawTransactions(PrimaryStorageTests):
+
+    secondary_options = dict(raw_transactions=True)
+
+class PrimaryStorageTestsWithApplyQueue(PrimaryStorageTestsWithBlobs):
+
+    secondary_options = dict(apply_queue_size=1 << 12)
+
+class PrimaryStorageTestsWithGroupSync(PrimaryStorageTestsWithBlobs):
+
+    secondary_options = dict(group_sync_interval=0.01,
+                             group_sync_transactions=10)
+
+class PrimaryStorageTestsWithBackpointerCache(PrimaryStorageTests):
+
+    primary_options = dict(backpointer_cache_size=1 << 16)
+
+class PrimaryStorageTestsWithReadAhead(PrimaryStorageTestsWithBlobs):
+
+    primary_options = dict(read_ahead_queue_size=1 << 12)
+
 class PrimaryHexStorageTestsWithBlobs(PrimaryStorageTestsWithBlobs):
 
     def _wrap(self, s):
@@ -1808,6 +5262,13 @@ def test_suite():
 
     make(PrimaryStorageTests, "check")
     make(PrimaryStorageTestsWithBlobs, "check")
+    make(PrimaryStorageTestsWithBlobLinks, "check")
+    make(PrimaryStorageTestsWithBlobChannels, "check")
+    make(PrimaryStorageTestsWithRawTransactions, "check")
+    make(PrimaryStorageTestsWithApplyQueue, "check")
+    make(PrimaryStorageTestsWithGroupSync, "check")
+    make(PrimaryStorageTestsWithBackpointerCache, "check")
+    make(PrimaryStorageTestsWithReadAhead, "check")
     make(ZEOTests, "check")
     make(BlobWritableCacheTests, "check")
 
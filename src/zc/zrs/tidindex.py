@@ -0,0 +1,305 @@
+##############################################################################
+#
+# Copyright (c) 2013 Zope Corporation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Sparse index of transaction positions in a file-storage file
+
+To start sending to a secondary, a primary has to find the first
+transaction after the secondary's last transaction.  Rather than
+search the storage file, we keep the ids and positions of
+transactions at least interval bytes apart, in memory and in a file
+next to the storage file.  Finding a start position is then a binary
+search followed by a short scan.
+
+The index is built, or brought up to date, when it's opened, and
+rebuilt when the storage file is packed or replaced.  Unless there's
+little to read, this is done by a background thread.  While that's
+happening, lookups return None and callers search the storage file as
+they would without an index.
+
+Transactions are noted as they're committed, but nothing else is done
+then, so commits aren't held up.  They're added to the index, and the
+index file, and the index is checked against the storage file, when
+the index is next used.
+"""
+
+import bisect
+import collections
+import logging
+import os
+import struct
+import threading
+
+logger = logging.getLogger(__name__)
+
+magic = b'ZRSTIDX1'
+entry = struct.Struct(">8sQ")
+header = struct.Struct(">8sQc") # transaction id, length, and status
+
+class TidIndex:
+
+    thread = None
+    out = None
+
+    # If there are fewer than this many bytes to index, we index them
+    # right away, rather than in a background thread.
+    background_size = 1 << 24
+
+    def __init__(self, fs, interval=1 << 20, path=None):
+        self.fs = fs
+        self.interval = interval
+        if path is None:
+            path = fs._file_name + '.tidindex'
+        self.path = path
+        self.lock = threading.Lock()
+        self.closed = False
+        self.tids = []
+        self.positions = []
+        self.pending = None
+        # Transactions noted by add, with the storage files they were
+        # committed to:
+        self.added = collections.deque()
+        self.added_file = self.added_pos = None
+        with self.lock:
+            file = self.fs._file
+            loaded = self._load()
+            if loaded:
+                self.tids, self.positions = loaded
+            self._update(file, fresh=not loaded)
+
+    def find(self, tid):
+        """Find the last indexed transaction at or before tid
+
+        Its id and position are returned.  None is returned if there
+        isn't one, or if the index is being built.
+        """
+        with self.lock:
+            self._check()
+            self._merge()
+            if self.pending is not None:
+                return None
+            i = bisect.bisect_right(self.tids, tid)
+            if not i:
+                return None
+            return self.tids[i-1], self.positions[i-1]
+
+    def add(self, tid, pos):
+        """Note that the transaction with the given id was committed at pos
+
+        This is called as transactions are committed, one at a time,
+        so it only notes transactions at least interval bytes after
+        the last one noted, to be indexed when the index is next used.
+        """
+        file = self.fs._file
+        if file is self.added_file and pos - self.added_pos < self.interval:
+            return
+        self.added_file = file
+        self.added_pos = pos
+        self.added.append((file, tid, pos))
+
+    def invalidate(self):
+        """Discard the index and rebuild it
+
+        Called when a lookup found that the index doesn't match the
+        storage file.
+        """
+        with self.lock:
+            if self.pending is None and not self.closed:
+                logger.warning("Rebuilding %s", self.path)
+                self._update(self.fs._file, fresh=True)
+
+    def stats(self):
+        with self.lock:
+            self._merge()
+            return dict(entries=len(self.positions),
+                        building=self.pending is not None)
+
+    def close(self, timeout=10):
+        with self.lock:
+            self._merge()
+            self.closed = True
+            thread = self.thread
+            if self.out is not None:
+                self.out.close()
+                self.out = None
+        if thread is not None:
+            thread.join(timeout)
+
+    def _append(self, tids, positions, tid, pos):
+        if positions and (pos - positions[-1] < self.interval
+                          or tid <= tids[-1]):
+            return False
+        tids.append(tid)
+        positions.append(pos)
+        return True
+
+    def _merge(self):
+        # Called with the lock held.  Index the transactions noted by
+        # add.  Those committed to other storage files are dropped.
+        # They're indexed when we're rebuilt for their file.
+        added = self.added
+        while added:
+            file, tid, pos = added.popleft()
+            if file is not self.file:
+                continue
+            if self.pending is not None:
+                self.pending.append((tid, pos))
+            elif self._append(self.tids, self.positions, tid, pos):
+                self._write(entry.pack(tid, pos))
+
+    def _check(self):
+        # Called with the lock held.  If the storage file has changed,
+        # as when it's packed, our positions are meaningless.
+        if self.pending is None and self.fs._file is not self.file:
+            logger.info("Storage file changed, rebuilding %s", self.path)
+            self._update(self.fs._file, fresh=True)
+
+    def _load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except IOError:
+            return None
+
+        if data[:len(magic)] != magic:
+            logger.warning("Ignoring invalid %s", self.path)
+            return None
+
+        tids = []
+        positions = []
+        for offset in range(len(magic), len(data) - entry.size + 1,
+                            entry.size):
+            tid, pos = entry.unpack_from(data, offset)
+            if positions and (tid <= tids[-1] or pos <= positions[-1]):
+                logger.warning("Ignoring unsorted %s", self.path)
+                return None
+            tids.append(tid)
+            positions.append(pos)
+
+        if positions:
+            # Make sure the index matches the storage file, by
+            # checking the first and last entries.
+            with open(self.fs._file_name, 'rb') as f:
+                for i in (0, -1):
+                    f.seek(positions[i])
+                    if f.read(8) != tids[i]:
+                        logger.warning("%s doesn't match %s",
+                                       self.path, self.fs._file_name)
+                        return None
+
+        return tids, positions
+
+    def _update(self, file, fresh):
+        # Called with the lock held.  Index the storage file from the
+        # last entry, or from the beginning, to the end.  If that's
+        # much, start a thread to do it.  Transactions committed
+        # meanwhile are held in pending and merged when the thread is
+        # done.
+        self.file = file
+        self.pending = []
+        if fresh:
+            tids, positions = [], []
+        else:
+            tids, positions = list(self.tids), list(self.positions)
+        self.tids, self.positions = [], []
+        if self.out is not None:
+            self.out.close()
+            self.out = None
+
+        try:
+            size = os.path.getsize(self.fs._file_name)
+        except OSError:
+            size = 0
+        if size - (positions[-1] if positions else 0) < self.background_size:
+            try:
+                self._finish(file, tids, positions,
+                             self._scan(tids, positions))
+            except Exception:
+                logger.exception("Couldn't index %s", self.fs._file_name)
+            return
+
+        thread = threading.Thread(
+            target=self._run, args=(file, tids, positions),
+            name='TidIndex(%s)' % self.fs._file_name)
+        thread.daemon = True
+        self.thread = thread
+        thread.start()
+
+    def _run(self, file, tids, positions):
+        try:
+            end = self._scan(tids, positions)
+        except Exception:
+            logger.exception("Couldn't index %s", self.fs._file_name)
+            return
+
+        with self.lock:
+            if self.closed or self.thread is not threading.current_thread():
+                return
+            self._finish(file, tids, positions, end)
+
+    def _finish(self, file, tids, positions, end):
+        # Called with the lock held, when we've indexed up to end.
+        if self.fs._file is not file:
+            # Packed while we were indexing. Start over.
+            return self._update(self.fs._file, fresh=True)
+
+        self._merge()
+        for tid, pos in self.pending:
+            if pos >= end:
+                self._append(tids, positions, tid, pos)
+
+        self.tids, self.positions = tids, positions
+        self.pending = None
+        self._save()
+
+    def _scan(self, tids, positions):
+        # Read transaction headers, from the last entry, or the
+        # beginning, to the end of the file or the transaction being
+        # committed, and return the position at which we stopped.
+        if positions:
+            pos = positions[-1]
+        else:
+            pos = 4
+        with open(self.fs._file_name, 'rb') as f:
+            while not self.closed:
+                f.seek(pos)
+                h = f.read(header.size)
+                if len(h) < header.size:
+                    break
+                tid, tlen, status = header.unpack(h)
+                if status == b'c' or tlen < header.size:
+                    break
+                self._append(tids, positions, tid, pos)
+                pos += tlen + 8
+        return pos
+
+    def _save(self):
+        # Called with the lock held.  Write the whole index.
+        tmp = self.path + '.tmp'
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(magic)
+                f.write(b''.join(entry.pack(tid, pos) for tid, pos
+                                 in zip(self.tids, self.positions)))
+            os.rename(tmp, self.path)
+        except (IOError, OSError):
+            logger.exception("Couldn't save %s", self.path)
+
+    def _write(self, data):
+        # Called with the lock held.  Append an entry.
+        try:
+            if self.out is None:
+                self.out = open(self.path, 'ab')
+            self.out.write(data)
+            self.out.flush()
+        except (IOError, OSError):
+            logger.exception("Couldn't update %s", self.path)
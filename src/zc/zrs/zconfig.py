@@ -35,7 +35,25 @@ class ZRS:
                         "Values for replicate-to and "
                         "replicate-from must be different.")
 
-            storage = zc.zrs.primary.Primary(storage, replicate_to.address)
+            storage = zc.zrs.primary.Primary(
+                storage, replicate_to.address,
+                transaction_buffer_size=self.config.transaction_buffer_size,
+                worker_pool_size=self.config.worker_pool_size,
+                high_watermark=self.config.high_watermark,
+                low_watermark=self.config.low_watermark,
+                max_in_flight=self.config.max_in_flight,
+                rate_limit=self.config.rate_limit,
+                total_rate_limit=self.config.total_rate_limit,
+                max_catch_ups=self.config.max_catch_ups,
+                catch_up_lag=self.config.catch_up_lag,
+                tid_index_interval=self.config.tid_index_interval,
+                memory_map=self.config.memory_map,
+                catch_up_io=self.config.catch_up_io,
+                catch_up_read_ahead=self.config.catch_up_read_ahead,
+                catch_up_io_priority=self.config.catch_up_io_priority,
+                blob_block_size=self.config.blob_block_size,
+                backpointer_cache_size=self.config.backpointer_cache_size,
+                read_ahead_queue_size=self.config.read_ahead_queue_size)
 
         elif replicate_from is None:
             raise ValueError(
@@ -45,6 +63,20 @@ class ZRS:
             storage = zc.zrs.secondary.Secondary(
                 storage, replicate_from.address,
                 keep_alive_delay=self.config.keep_alive_delay,
+                compression=self.config.compression,
+                binary_headers=self.config.binary_headers,
+                checksum_algorithm=self.config.checksum_algorithm,
+                per_transaction_checksums=(
+                    self.config.per_transaction_checksums),
+                chunk_size=self.config.chunk_size,
+                queue_notices=self.config.queue_notices,
+                raw_transactions=self.config.raw_transactions,
+                snapshot_bootstrap=self.config.snapshot_bootstrap,
+                link_blobs=self.config.link_blobs,
+                blob_channels=self.config.blob_channels,
+                apply_queue_size=self.config.apply_queue_size,
+                group_sync_interval=self.config.group_sync_interval,
+                group_sync_transactions=self.config.group_sync_transactions,
                 )
 
         return storage